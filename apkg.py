@@ -0,0 +1,263 @@
+import base64
+import hashlib
+import html
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import zipfile
+from typing import Any, Dict, Iterable, Iterator, List
+
+# 生成したカードからAnkiのパッケージ（.apkg）を直接作る
+# コレクション（SQLite）は一時ファイルに書き、MP3はカードを追加するたびにzipへ書き出すため、枚数が増えてもメモリ使用量は一定
+
+DESIGN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "AnkiCardDesign")
+
+NOTE_TYPE_NAME = "Immersion"
+# 同じノートタイプに取り込まれるよう、IDは名前から固定で決める
+NOTE_TYPE_ID = int(hashlib.sha1(f"anki-card-generator:{NOTE_TYPE_NAME}".encode("utf-8")).hexdigest()[:10], 16)
+
+# ノートタイプのフィールド（create_anki_template と同じ項目。重複チェックに使われる先頭はセリフ英文）
+NOTE_FIELDS = [
+    "Sentence", "Word", "Image", "NaturalJapanese", "Japanese", "IPA", "PartOfSpeech", "Definition",
+    "Synonyms", "Antonyms", "JapaneseMeaning", "ExampleSentence", "ExSentenceJapanese", "Core",
+    "MemoryAids", "JapaneseUsage", "Terminology", "Idioms", "Slang", "Rating", "Explanation",
+    "Voice", "ObsidianLink", "PlayPhraseMe",
+]
+
+# create_formatted_data の出力のキー（Sentence・Word・Image・Voice・リンクは別途組み立てる）
+FIELD_KEYS = {
+    "NaturalJapanese": "contextual_translation",
+    "Japanese": "japanese_translation",
+    "IPA": "ipa",
+    "PartOfSpeech": "part_of_speech",
+    "Definition": "english_definition",
+    "Synonyms": "synonyms_str",
+    "Antonyms": "antonyms_str",
+    "JapaneseMeaning": "japanese_meaning",
+    "ExampleSentence": "ex_sentence_english",
+    "ExSentenceJapanese": "ex_sentence_japanese",
+    "Core": "core_meaning",
+    "MemoryAids": "memory_aids",
+    "JapaneseUsage": "japanese_usage",
+    "Terminology": "terminology",
+    "Idioms": "idioms",
+    "Slang": "slang",
+    "Rating": "rating_star",
+    "Explanation": "explanation",
+}
+
+COLLECTION_SCHEMA = """
+CREATE TABLE col (id integer primary key, crt integer not null, mod integer not null, scm integer not null, ver integer not null, dty integer not null, usn integer not null, ls integer not null, conf text not null, models text not null, decks text not null, dconf text not null, tags text not null);
+CREATE TABLE notes (id integer primary key, guid text not null, mid integer not null, mod integer not null, usn integer not null, tags text not null, flds text not null, sfld integer not null, csum integer not null, flags integer not null, data text not null);
+CREATE TABLE cards (id integer primary key, nid integer not null, did integer not null, ord integer not null, mod integer not null, usn integer not null, type integer not null, queue integer not null, due integer not null, ivl integer not null, factor integer not null, reps integer not null, lapses integer not null, left integer not null, odue integer not null, odid integer not null, flags integer not null, data text not null);
+CREATE TABLE revlog (id integer primary key, cid integer not null, usn integer not null, ease integer not null, ivl integer not null, lastIvl integer not null, factor integer not null, time integer not null, type integer not null);
+CREATE TABLE graves (usn integer not null, oid integer not null, type integer not null);
+CREATE INDEX ix_notes_usn on notes (usn);
+CREATE INDEX ix_cards_usn on cards (usn);
+CREATE INDEX ix_revlog_usn on revlog (usn);
+CREATE INDEX ix_cards_nid on cards (nid);
+CREATE INDEX ix_cards_sched on cards (did, queue, due);
+CREATE INDEX ix_revlog_cid on revlog (cid);
+CREATE INDEX ix_notes_csum on notes (csum);
+"""
+
+DEFAULT_DECK_CONFIG = {
+    "id": 1, "name": "Default", "mod": 0, "usn": 0, "maxTaken": 60, "autoplay": True, "timer": 0, "replayq": True,
+    "new": {"bury": True, "delays": [1, 10], "initialFactor": 2500, "ints": [1, 4, 7], "order": 1, "perDay": 20, "separate": True},
+    "rev": {"bury": True, "ease4": 1.3, "fuzz": 0.05, "ivlFct": 1, "maxIvl": 36500, "minSpace": 1, "perDay": 100},
+    "lapse": {"delays": [10], "leechAction": 0, "leechFails": 8, "minInt": 1, "mult": 0},
+}
+
+def deck_id(name: str) -> int:
+    if name == "Default":
+        return 1
+    return int(hashlib.sha1(f"anki-card-generator:deck:{name}".encode("utf-8")).hexdigest()[:10], 16)
+
+def deck_entry(name: str, mod: int) -> Dict[str, Any]:
+    return {
+        "id": deck_id(name), "name": name, "mod": mod, "usn": -1, "desc": "", "dyn": 0, "conf": 1, "collapsed": False,
+        "browserCollapsed": False, "extendNew": 0, "extendRev": 0,
+        "newToday": [0, 0], "revToday": [0, 0], "lrnToday": [0, 0], "timeToday": [0, 0],
+    }
+
+def read_template(file_name: str) -> str:
+    with open(os.path.join(DESIGN_DIR, file_name), encoding="utf-8") as f:
+        return f.read()
+
+def note_type(mod: int) -> Dict[str, Any]:
+    return {
+        "id": NOTE_TYPE_ID, "name": NOTE_TYPE_NAME, "type": 0, "mod": mod, "usn": -1, "sortf": 0, "did": 1,
+        "tmpls": [{
+            "name": "Card 1", "ord": 0, "did": None, "bqfmt": "", "bafmt": "",
+            "qfmt": read_template("FrontTemplate.html"),
+            "afmt": read_template("BackTemplate.html"),
+        }],
+        "flds": [
+            {"name": name, "ord": index, "sticky": False, "rtl": False, "font": "Arial", "size": 20, "media": []}
+            for index, name in enumerate(NOTE_FIELDS)
+        ],
+        # スタイルは各テンプレートに含まれている
+        "css": "",
+        "latexPre": "\\documentclass[12pt]{article}\n\\special{papersize=3in,5in}\n\\usepackage[utf8]{inputenc}\n\\usepackage{amssymb,amsmath}\n\\pagestyle{empty}\n\\setlength{\\parindent}{0in}\n\\begin{document}\n",
+        "latexPost": "\\end{document}",
+        "latexsvg": False,
+        "req": [[0, "any", [0]]],
+        "tags": [],
+        "vers": [],
+    }
+
+# Obsidian向けのMarkdown（==ハイライト==）をAnkiのHTMLにする
+def to_html(value: Any) -> str:
+    if value is None:
+        return ""
+    text = html.escape(str(value), quote=False)
+    return re.sub(r"==(.+?)==", r"<b>\1</b>", text)
+
+def link_html(url: str) -> str:
+    return f'<a href="{html.escape(url)}">{html.escape(url)}</a>' if url else ""
+
+def field_checksum(value: str) -> int:
+    plain = re.sub(r"<[^>]+>", "", value)
+    return int(hashlib.sha1(plain.encode("utf-8")).hexdigest()[:8], 16)
+
+class AnkiPackageWriter:
+    def __init__(self, fileobj) -> None:
+        self._zip = zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_DEFLATED)
+        fd, self._db_path = tempfile.mkstemp(suffix=".anki2")
+        os.close(fd)
+        self._conn = sqlite3.connect(self._db_path)
+        self._conn.executescript(COLLECTION_SCHEMA)
+        self._media: Dict[str, str] = {}
+        self._decks: Dict[str, int] = {}
+        self._next_id = int(time.time() * 1000)
+        self.count = 0
+
+    def _new_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    # MP3は受け取った時点でzipに書き出す（圧縮済みのため無圧縮で格納）
+    def _add_media(self, file_name: str, data: bytes) -> None:
+        entry = str(len(self._media))
+        self._zip.writestr(entry, data, compress_type=zipfile.ZIP_STORED)
+        self._media[entry] = file_name
+
+    # Base64の音声をパッケージに同梱し、フィールドに埋め込む [sound:...] を返す（音声がなければ空）
+    def _add_sound(self, audio_base64: Any, file_name: str) -> str:
+        if not audio_base64:
+            return ""
+        self._add_media(file_name, base64.b64decode(audio_base64))
+        return f"[sound:{file_name}]"
+
+    # generate_card の結果（create_formatted_data の出力 + word・tag・音声）を1ノートとして追加
+    def add_card(self, card: Dict[str, Any]) -> None:
+        word = card["word"]
+        # ファイル名はObsidianの埋め込み（ex_audio_embed）と同じ
+        voice = self._add_sound(card.get("audio_base64"), f"{card['unique_file_name']}.mp3")
+        ex_voice = self._add_sound(card.get("ex_audio_base64"), f"{card['unique_file_name']}_example.mp3")
+
+        fields = {
+            "Sentence": to_html(card.get("highlighted_sentence") or card.get("sentence", "")),
+            "Word": to_html(word),
+            # 画像はObsidian側で追加するため空にしておく
+            "Image": "",
+            "Voice": voice,
+            "ObsidianLink": link_html(card.get("obsidian_uri", "")),
+            "PlayPhraseMe": link_html(card.get("playphrase_me_url", "")),
+            **{name: to_html(card.get(key)) for name, key in FIELD_KEYS.items()},
+        }
+        # 例文の音声は例文の欄に続けて置く（ノートタイプのフィールドは変えない）
+        if ex_voice:
+            fields["ExampleSentence"] = f"{fields['ExampleSentence']} {ex_voice}".strip()
+        values = [fields[name] for name in NOTE_FIELDS]
+        tags = " ".join(tag.replace(" ", "_") for tag in [card.get("tag", "")] if tag)
+
+        # target_deck（頻度ごとのサブデッキ）にそのまま振り分ける
+        deck_name = card.get("target_deck") or "Default"
+        did = self._decks.setdefault(deck_name, deck_id(deck_name))
+
+        now = int(time.time())
+        note_id = self._new_id()
+        guid = hashlib.sha1(str(card.get("job_id") or note_id).encode("utf-8")).hexdigest()[:16]
+        self._conn.execute(
+            "INSERT INTO notes VALUES (?, ?, ?, ?, -1, ?, ?, ?, ?, 0, '')",
+            (note_id, guid, NOTE_TYPE_ID, now, f" {tags} " if tags else "", "\x1f".join(values), values[0], field_checksum(values[0])),
+        )
+        self._conn.execute(
+            "INSERT INTO cards VALUES (?, ?, ?, 0, ?, -1, 0, 0, ?, 0, 0, 0, 0, 0, 0, 0, 0, '')",
+            (self._new_id(), note_id, did, now, self.count + 1),
+        )
+        self.count += 1
+
+    def _write_collection(self) -> None:
+        now = int(time.time())
+        decks = {"1": deck_entry("Default", now)}
+        decks.update({str(did): deck_entry(name, now) for name, did in self._decks.items()})
+        conf = {
+            "activeDecks": [1], "curDeck": 1, "newSpread": 0, "collapseTime": 1200, "timeLim": 0, "estTimes": True,
+            "dueCounts": True, "curModel": str(NOTE_TYPE_ID), "nextPos": self.count + 1, "sortType": "noteFld",
+            "sortBackwards": False, "addToCur": True,
+        }
+        self._conn.execute(
+            "INSERT INTO col VALUES (1, ?, ?, ?, 11, 0, 0, 0, ?, ?, ?, ?, '{}')",
+            (
+                now - now % 86400, now * 1000, now * 1000,
+                json.dumps(conf), json.dumps({str(NOTE_TYPE_ID): note_type(now)}),
+                json.dumps(decks), json.dumps({"1": DEFAULT_DECK_CONFIG}),
+            ),
+        )
+        self._conn.commit()
+        self._conn.close()
+
+    def close(self) -> None:
+        try:
+            self._write_collection()
+            self._zip.write(self._db_path, "collection.anki2")
+            self._zip.writestr("media", json.dumps(self._media))
+            self._zip.close()
+        finally:
+            self.discard()
+
+    # 一時ファイルを片付ける（途中で中断した場合も呼ぶ）
+    def discard(self) -> None:
+        try:
+            self._conn.close()
+        except sqlite3.Error:
+            pass
+        if os.path.exists(self._db_path):
+            os.remove(self._db_path)
+
+# 書き込まれたバイト列をためておき、カードを追加するたびに取り出す（シークできない出力先向け）
+class _StreamBuffer:
+    def __init__(self) -> None:
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+# カードを受け取りながら.apkgのバイト列を順に返す（HTTPのストリーミングレスポンス用）
+def stream_apkg(cards: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    buffer = _StreamBuffer()
+    writer = AnkiPackageWriter(buffer)
+    try:
+        for card in cards:
+            writer.add_card(card)
+            chunk = buffer.drain()
+            if chunk:
+                yield chunk
+        writer.close()
+        yield buffer.drain()
+    finally:
+        writer.discard()
@@ -0,0 +1,361 @@
+import argparse
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+# オフラインベンチマーク（Gemini・gTTS・Notion をスタブに置き換えて main_function を直接呼び出す）
+# 使い方: python benchmark.py --requests 200 --concurrency 16 --output baseline.json
+#         python benchmark.py --baseline baseline.json
+#         python benchmark.py --import-only   # インポート時間の予算だけを確認
+
+SAMPLE_INPUTS = [
+    {"sentence": "I can't believe you actually pulled it off.", "word": "pulled it off", "tag": "Suits"},
+    {"sentence": "We need to refactor this before it gets out of hand.", "word": "refactor", "tag": "Silicon Valley"},
+    {"sentence": "She's been really resilient through all of this.", "word": "resilient", "tag": "Other"},
+    {"sentence": "Don't jump to conclusions, let's hear him out.", "word": "hear him out", "tag": "Friends"},
+    {"sentence": "The deadline is tight, but it's doable.", "word": "doable", "tag": "Other"},
+    {"sentence": "He tends to procrastinate when he's stressed.", "word": "procrastinate", "tag": "The Office"},
+    {"sentence": "That plan is way too ambiguous to work.", "word": "ambiguous", "tag": "Other"},
+    {"sentence": "I'm swamped with work this week.", "word": "swamped", "tag": "Breaking Bad"},
+]
+
+# スタブの既定の遅延（秒）。環境変数で上書きできる
+STUB_LATENCY_DEFAULTS = {
+    "STUB_GEMINI_LATENCY": "1.5",
+    "STUB_TTS_LATENCY": "0.3",
+    "STUB_NOTION_LATENCY": "0.35",
+    "STUB_LATENCY_JITTER": "0.25",
+}
+
+# 比較対象の指標（値が大きいほど悪いものはTrue）
+COMPARED_METRICS = {
+    "latency.p50": True,
+    "latency.p95": True,
+    "latency.p99": True,
+    "throughput_rps": False,
+    "peak_rss_mb": True,
+    "import_ms": True,
+}
+
+# main のインポート時間の予算（ミリ秒）。コールドスタートの悪化を検出する
+IMPORT_TIME_BUDGET_MS = 600
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4) if values else 0.0,
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "max": round(max(values), 4) if values else 0.0,
+    }
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # LinuxはKB、macOSはバイト単位
+    if sys.platform != "darwin":
+        peak *= 1024
+    return round(peak / (1024 * 1024), 1)
+
+# python -X importtime で main のインポート時間（累計、ミリ秒）を別プロセスで測る（最小値を採用）
+def measure_import_ms(runs: int = 3) -> float:
+    env = dict(os.environ, WARMUP="false")
+    samples = []
+    for _ in range(runs):
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import main"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        for line in completed.stderr.splitlines():
+            parts = line.split("|")
+            if len(parts) == 3 and parts[2].rstrip() == " main":
+                samples.append(int(parts[1]) / 1000)
+    if not samples:
+        raise SystemExit("Could not find main in the importtime output")
+    return round(min(samples), 1)
+
+def load_inputs(path: Optional[str]) -> List[Dict[str, Any]]:
+    if path is None:
+        return SAMPLE_INPUTS
+    inputs = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            # カード生成の入力として使えない行は読み飛ばす
+            if isinstance(item, dict) and all(isinstance(item.get(key), str) for key in ("sentence", "word", "tag")):
+                inputs.append(item)
+    if not inputs:
+        raise SystemExit(f"No usable inputs (sentence/word/tag) in {path}")
+    return inputs
+
+# ステージごとの所要時間を記録する
+class StageTimer:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.durations: Dict[str, List[float]] = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.durations = {}
+
+    def wrap_async(self, stage: str, func):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return wrapper
+
+    def wrap_sync(self, stage: str, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return wrapper
+
+def configure_environment(args, workdir: str) -> None:
+    for name, value in STUB_LATENCY_DEFAULTS.items():
+        os.environ.setdefault(name, value)
+    os.environ["GEMINI_CLIENT"] = "stub"
+    os.environ.setdefault("TTS_ENGINE", "stub")
+    os.environ.setdefault("ANALYSIS_CACHE_DB", os.path.join(workdir, "analysis_cache.sqlite3"))
+    os.environ.setdefault("NOTION_OUTBOX_DB", os.path.join(workdir, "notion_outbox.sqlite3"))
+    os.environ.setdefault("NOTION_RATE_PER_SEC", "1000")
+    os.environ.setdefault("REQUEST_LOG", "false")
+    # 同じ入力を繰り返し送るため、本文から導いた冪等キーで保存済みの結果が返らないようにする（パイプラインを測る）
+    os.environ["IDEMPOTENCY_DERIVE_KEY"] = "false"
+    if args.cache == "cold":
+        # 音声キャッシュも無効にして毎回合成させる
+        os.environ["AUDIO_CACHE_DIR"] = ""
+        os.environ["AUDIO_CACHE_MAX_BYTES"] = "0"
+    else:
+        os.environ.setdefault("AUDIO_CACHE_DIR", os.path.join(workdir, "audio"))
+    if args.notion:
+        os.environ["USE_NOTION"] = "true"
+        os.environ.setdefault("NOTION_TOKEN", "benchmark-token")
+        os.environ.setdefault("NOTION_DB_ID", "benchmark-database")
+    else:
+        os.environ["USE_NOTION"] = "false"
+
+# スタブへの差し替えとステージ計測の組み込み
+def install_stubs(main, timer: StageTimer):
+    from stubs import StubNotionSession
+
+    notion_session = StubNotionSession()
+    main.NotionOutbox._get_session = lambda self: notion_session
+
+    main.analyze_word = timer.wrap_async("analysis", main.analyze_word)
+    main.synthesize_speech = timer.wrap_async("tts", main.synthesize_speech)
+    main.save_to_notion = timer.wrap_sync("notion_enqueue", main.save_to_notion)
+
+    # 送信するエントリがなかった呼び出しは計測に含めない
+    process_one = main.NotionOutbox.process_one
+    def timed_process_one(self):
+        start = time.perf_counter()
+        sent = process_one(self)
+        if sent:
+            timer.add("notion_send", time.perf_counter() - start)
+        return sent
+    main.NotionOutbox.process_one = timed_process_one
+    return notion_session
+
+def run_requests(main, app, inputs: List[Dict[str, Any]], total: int, concurrency: int, cache: str):
+    from flask import request
+
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    def call(index: int) -> None:
+        body = dict(inputs[index % len(inputs)])
+        if cache == "cold":
+            body["no_cache"] = True
+        start = time.perf_counter()
+        with app.test_request_context("/", method="POST", json=body):
+            response = app.make_response(main.main_function(request))
+        elapsed = time.perf_counter() - start
+        with lock:
+            if response.status_code == 200:
+                latencies.append(elapsed)
+            else:
+                errors[str(response.status_code)] = errors.get(str(response.status_code), 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, range(total)))
+    return latencies, errors, time.perf_counter() - started
+
+def wait_for_outbox(main, timeout: float) -> float:
+    outbox = main.NotionOutbox.get_instance()
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if outbox.counts().get("pending", 0) == 0:
+            break
+        time.sleep(0.05)
+    return time.perf_counter() - started
+
+def run_benchmark(args) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="anki-card-benchmark-")
+    configure_environment(args, workdir)
+    import_ms = measure_import_ms()
+
+    import main
+    from flask import Flask
+
+    timer = StageTimer()
+    notion_session = install_stubs(main, timer)
+    app = Flask("benchmark")
+    inputs = load_inputs(args.input)
+
+    if args.warmup:
+        run_requests(main, app, inputs, args.warmup, args.concurrency, args.cache)
+        if args.notion:
+            wait_for_outbox(main, args.notion_timeout)
+        timer.clear()
+        main.StageMetrics.reset()
+
+    latencies, errors, wall = run_requests(main, app, inputs, args.requests, args.concurrency, args.cache)
+    notion_drain = wait_for_outbox(main, args.notion_timeout) if args.notion else 0.0
+
+    return {
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "warmup": args.warmup,
+            "cache": args.cache,
+            "notion": args.notion,
+            "inputs": len(inputs),
+            "stub_latency": {name: float(os.environ[name]) for name in STUB_LATENCY_DEFAULTS},
+        },
+        "latency": summarize(latencies),
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall > 0 else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "import_ms": import_ms,
+        "stages": {stage: summarize(values) for stage, values in sorted(timer.durations.items())},
+        "server_stages": {
+            stage: {key: stats[key] for key in ("count", "mean", "p50", "p95", "p99")}
+            for stage, stats in main.StageMetrics.snapshot().items()
+        },
+        "notion": {"posted": notion_session.posted, "drain_seconds": round(notion_drain, 3)},
+        "cache_stats": {
+            "analysis": main.AnalysisCache.get_instance().snapshot(),
+            "audio": main.AudioCache.get_instance().snapshot(),
+            "gemini_tokens": main.TokenUsage.snapshot(),
+        },
+    }
+
+def metric_value(result: Dict[str, Any], path: str) -> Optional[float]:
+    value: Any = result
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+# ベースラインとの比較（悪化した割合が閾値を超えた指標を返す）
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    regressions = []
+    if baseline.get("config") != result["config"]:
+        print("\nWarning: baseline was recorded with a different configuration")
+    print(f"\n{'metric':<16}{'baseline':>12}{'current':>12}{'change':>10}")
+    for path, higher_is_worse in COMPARED_METRICS.items():
+        before, after = metric_value(baseline, path), metric_value(result, path)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before if before else 0.0
+        print(f"{path:<16}{before:>12}{after:>12}{change:>+10.1%}")
+        worse = change if higher_is_worse else -change
+        if worse > threshold:
+            regressions.append(path)
+    return regressions
+
+def print_report(result: Dict[str, Any]) -> None:
+    config = result["config"]
+    print(f"requests={config['requests']} concurrency={config['concurrency']} cache={config['cache']} notion={config['notion']}")
+    print(f"throughput: {result['throughput_rps']} req/s  wall: {result['wall_seconds']}s  peak RSS: {result['peak_rss_mb']} MB  import: {result['import_ms']} ms")
+    if result["errors"]:
+        print(f"errors: {result['errors']}")
+    print(f"\n{'stage':<16}{'count':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for stage, stats in [("latency", result["latency"]), *result["stages"].items()]:
+        print(f"{stage:<16}{stats['count']:>7}{stats['mean']:>9.3f}{stats['p50']:>9.3f}{stats['p95']:>9.3f}{stats['p99']:>9.3f}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Anki Card Generator offline benchmark")
+    parser.add_argument("--requests", type=int, default=100, help="計測するリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に送るリクエスト数")
+    parser.add_argument("--warmup", type=int, default=0, help="計測前に捨てるリクエスト数")
+    parser.add_argument("--input", help="sentence/word/tag を含むJSONLファイル（省略時は組み込みのサンプル）")
+    parser.add_argument("--cache", choices=["cold", "warm"], default="cold", help="cold: 分析・音声キャッシュを使わない")
+    parser.add_argument("--no-notion", dest="notion", action="store_false", help="Notionへの送信を含めない")
+    parser.add_argument("--notion-timeout", type=float, default=60.0, help="Notion送信キューが空になるまで待つ秒数")
+    parser.add_argument("--output", help="結果をJSONで保存するパス（ベースラインとして使える）")
+    parser.add_argument("--baseline", help="比較するベースラインJSONのパス")
+    parser.add_argument("--max-regression", type=float, default=0.1, help="この割合を超えて悪化したら終了コード1")
+    parser.add_argument("--import-budget-ms", type=float, default=IMPORT_TIME_BUDGET_MS, help="main のインポート時間がこれを超えたら終了コード1（0で無効）")
+    parser.add_argument("--import-only", action="store_true", help="インポート時間の予算だけを確認する")
+    return parser
+
+def check_import_budget(import_ms: float, budget_ms: float) -> bool:
+    if budget_ms and import_ms > budget_ms:
+        print(f"\nImport time {import_ms} ms exceeds the budget of {budget_ms} ms")
+        return False
+    return True
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    if args.import_only:
+        import_ms = measure_import_ms()
+        print(f"import main: {import_ms} ms (budget {args.import_budget_ms} ms)")
+        sys.exit(0 if check_import_budget(import_ms, args.import_budget_ms) else 1)
+
+    result = run_benchmark(args)
+    print_report(result)
+    within_budget = check_import_budget(result["import_ms"], args.import_budget_ms)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\nSaved results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.max_regression)
+        if regressions:
+            print(f"\nRegressed more than {args.max_regression:.0%}: {', '.join(regressions)}")
+            within_budget = False
+    # 送信キューのワーカーやイベントループのスレッドを待たずに終了する
+    sys.stdout.flush()
+    os._exit(0 if within_budget else 1)
@@ -0,0 +1,277 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+# CLIではサーバー用のバックグラウンドウォームアップとリクエストログは不要
+os.environ.setdefault("WARMUP", "false")
+os.environ.setdefault("REQUEST_LOG", "false")
+
+from apkg import AnkiPackageWriter
+from main import AnalysisProfile, EventLoopThread, Lexicon, NotionOutbox, PrewarmQueue, prewarm_subtitles, process_batch_item
+
+# Notionの未送信ページを再送する
+def notion_replay(args):
+    outbox = NotionOutbox.get_instance()
+    result = outbox.replay(include_failed=not args.pending_only)
+    print(json.dumps(result, ensure_ascii=False))
+
+# 処理済みの行の記録（先頭から連続して終わった行数と、それより後で終わった行だけを持つ）
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.next_line = 0
+        self.done = set()
+        self.failed = 0
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+            self.next_line = state.get("next_line", 0)
+            self.done = set(state.get("done", []))
+            self.failed = state.get("failed", 0)
+
+    def is_done(self, line_no):
+        return line_no < self.next_line or line_no in self.done
+
+    def mark(self, line_no):
+        self.done.add(line_no)
+        while self.next_line in self.done:
+            self.done.remove(self.next_line)
+            self.next_line += 1
+
+    # 途中で落ちても壊れないよう一時ファイルから置き換える
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"next_line": self.next_line, "done": sorted(self.done), "failed": self.failed}, f)
+        os.replace(tmp_path, self.path)
+
+# 入力を1行ずつ読む（ファイル全体をメモリに載せない）
+def iter_captures(path):
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        for line_no, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                yield line_no, None
+                continue
+            try:
+                yield line_no, json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_no, {"_parse_error": f"Invalid JSON line: {e.msg}"}
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def count_lines(path):
+    if path == "-":
+        return None
+    with open(path, "rb") as f:
+        return sum(1 for _ in f)
+
+def safe_file_name(name):
+    return re.sub(r'[\\/:*?"<>|]', "_", name).strip() or "card"
+
+# Obsidianのノート（単語ごと。同じ単語は追記）とMP3を保存
+def write_card(card, notes_dir, audio_dir):
+    for prefix, file_name in [("audio", card["unique_file_name"]), ("ex_audio", f"{card['unique_file_name']}_example")]:
+        audio_base64 = card.get(f"{prefix}_base64")
+        if audio_base64:
+            with open(os.path.join(audio_dir, f"{file_name}.mp3"), "wb") as f:
+                f.write(base64.b64decode(audio_base64))
+    note_path = os.path.join(notes_dir, f"{safe_file_name(card['word'])}.md")
+    with open(note_path, "a", encoding="utf-8") as f:
+        f.write(card["anki_template"])
+    return note_path
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m{seconds % 60:02d}s"
+
+# JSONLのキャプチャからカードを一括生成する（中断しても続きから再開できる）
+def generate(args):
+    if not args.vault and not args.apkg:
+        sys.exit("Specify --vault and/or --apkg")
+    if args.vault:
+        notes_dir = os.path.join(args.vault, args.notes_dir)
+        audio_dir = os.path.join(args.vault, args.audio_dir)
+        os.makedirs(notes_dir, exist_ok=True)
+        os.makedirs(audio_dir, exist_ok=True)
+    # .apkg には今回の実行で生成したカードだけが入る
+    apkg_file = open(args.apkg, "wb") if args.apkg else None
+    apkg_writer = AnkiPackageWriter(apkg_file) if apkg_file else None
+
+    checkpoint_path = args.checkpoint or (None if args.input == "-" else f"{args.input}.checkpoint.json")
+    checkpoint = Checkpoint(None if args.restart else checkpoint_path)
+    checkpoint.path = checkpoint_path
+    errors_path = f"{checkpoint_path}.errors.jsonl" if checkpoint_path else None
+    total = count_lines(args.input)
+    remaining = None if total is None else total - checkpoint.next_line - len(checkpoint.done)
+
+    runtime = EventLoopThread.get_instance()
+    concurrency = max(1, args.concurrency)
+    limit = asyncio.Semaphore(concurrency)
+    pending = {}
+    stats = {"cards": 0, "items": 0, "failed": 0}
+    stop_reason = None
+    started_at = time.monotonic()
+
+    def report():
+        elapsed = time.monotonic() - started_at
+        rate = stats["items"] / elapsed if elapsed > 0 else 0.0
+        progress = f"{stats['items']}" if remaining is None else f"{stats['items']}/{remaining}"
+        eta = ""
+        if remaining is not None and rate > 0:
+            eta = f" ETA {format_duration((remaining - stats['items']) / rate)}"
+        print(f"[{progress}] {rate:.2f} items/s, {stats['cards']} cards, {stats['failed']} failed{eta}", file=sys.stderr)
+
+    def handle(future):
+        nonlocal stop_reason
+        line_no, item = pending.pop(future)
+        result = future.result()
+        status = result.get("status", 200) if "error" in result else 200
+        # クォータ超過・タイムアウトは未処理のまま止め、再開時にやり直す
+        if status in (429, 503, 504):
+            stop_reason = stop_reason or f"line {line_no + 1}: {result['error']} ({status})"
+            return
+        if status == 200:
+            for card in result.get("cards", [result]):
+                if args.vault:
+                    write_card(card, notes_dir, audio_dir)
+                if apkg_writer:
+                    apkg_writer.add_card(card)
+                stats["cards"] += 1
+        else:
+            stats["failed"] += 1
+            checkpoint.failed += 1
+            print(f"line {line_no + 1}: {result['error']} ({status})", file=sys.stderr)
+            if errors_path:
+                with open(errors_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"line": line_no + 1, "status": status, "error": result["error"], "item": item}, ensure_ascii=False) + "\n")
+        stats["items"] += 1
+        checkpoint.mark(line_no)
+        checkpoint.save()
+        if stats["items"] % args.progress_every == 0:
+            report()
+
+    try:
+        for line_no, item in iter_captures(args.input):
+            if stop_reason is not None:
+                break
+            if checkpoint.is_done(line_no):
+                continue
+            if item is None:
+                stats["items"] += 1
+                checkpoint.mark(line_no)
+                continue
+            # 音声はファイルに書き出すためJSONに埋め込んで受け取る
+            request_item = {**item, "audio_mode": "inline"} if isinstance(item, dict) else item
+            pending[runtime.submit(process_batch_item(line_no, request_item, limit))] = (line_no, item)
+            # 同時に抱える件数を並列数までに抑え、メモリ使用量を一定に保つ
+            while len(pending) >= concurrency:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    handle(future)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                handle(future)
+    except KeyboardInterrupt:
+        stop_reason = "interrupted"
+    finally:
+        checkpoint.save()
+        if apkg_writer:
+            apkg_writer.close()
+            apkg_file.close()
+
+    report()
+    if stop_reason is not None:
+        print(f"Stopped: {stop_reason}. Run the same command again to resume.", file=sys.stderr)
+        sys.exit(2)
+    if stats["failed"] and errors_path:
+        print(f"Failed items were written to {errors_path}", file=sys.stderr)
+
+# 字幕ファイルの単語を事前に分析してキャッシュに載せる（キューが空になるまで待つ）
+def prewarm(args):
+    with open(args.subtitles, encoding="utf-8-sig") as f:
+        text = f.read()
+    known_words = None
+    if args.known_words:
+        from subtitles import load_known_words
+        known_words = list(load_known_words(args.known_words))
+    result = prewarm_subtitles(text, args.tag, AnalysisProfile.get(args.profile), known_words)
+    print(json.dumps(result, ensure_ascii=False))
+
+    queue = PrewarmQueue.get_instance()
+    started_at = time.monotonic()
+    while True:
+        time.sleep(args.progress_interval)
+        snapshot = queue.snapshot()
+        if snapshot["pending"] == 0 and snapshot["workers"] == 0:
+            break
+        finished = snapshot["completed"] + snapshot["failed"]
+        rate = finished / (time.monotonic() - started_at)
+        eta = f" ETA {format_duration(snapshot['pending'] / rate)}" if rate > 0 else ""
+        print(f"[{finished}/{result['queued']}] {rate:.2f} items/s, {snapshot['failed']} failed{eta}", file=sys.stderr)
+    print(json.dumps(queue.snapshot(), ensure_ascii=False))
+
+# TSV（単語・頻度順位・発音記号・見出し語。# で始まる行はコメント）から辞書の索引を作る
+def build_lexicon(args):
+    def rows():
+        with open(args.input, encoding="utf-8-sig") as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                columns = line.rstrip("\n").split("\t") + ["", "", ""]
+                rank = columns[1].strip()
+                yield columns[0], rank if rank.isdigit() else "", columns[2], columns[3]
+    count = Lexicon.build(rows(), args.output)
+    print(json.dumps({"entries": count, "output": args.output}, ensure_ascii=False))
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Anki Card Generator CLI")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = subparsers.add_parser("notion-replay", help="Notionへの未送信ページを再送する")
+    replay_parser.add_argument("--pending-only", action="store_true", help="failed状態のページは再送しない")
+    replay_parser.set_defaults(func=notion_replay)
+
+    generate_parser = subparsers.add_parser("generate", help="JSONLのキャプチャからカードを一括生成してObsidianのVault・.apkgに書き出す")
+    generate_parser.add_argument("input", help="1行1件のJSONL（sentence, word または words, tag）。- で標準入力")
+    generate_parser.add_argument("--vault", help="書き出し先のObsidian Vault")
+    generate_parser.add_argument("--apkg", help="Ankiに直接取り込める.apkgの出力先")
+    generate_parser.add_argument("--notes-dir", default="AnkiCard", help="ノートを置くVault内のフォルダ")
+    generate_parser.add_argument("--audio-dir", default="AnkiCard/audio", help="MP3を置くVault内のフォルダ")
+    generate_parser.add_argument("--concurrency", type=int, default=4, help="同時に処理する件数")
+    generate_parser.add_argument("--checkpoint", help="進捗ファイル（デフォルトは <input>.checkpoint.json）")
+    generate_parser.add_argument("--restart", action="store_true", help="進捗ファイルを無視して最初から処理する")
+    generate_parser.add_argument("--progress-every", type=int, default=10, help="進捗を表示する間隔（件数）")
+    generate_parser.set_defaults(func=generate)
+
+    prewarm_parser = subparsers.add_parser("prewarm", help="字幕ファイル（.srt / .vtt）の単語を事前に分析してキャッシュに載せる")
+    prewarm_parser.add_argument("subtitles", help="字幕ファイル")
+    prewarm_parser.add_argument("--tag", default="Other", help="作品名（カード生成時のtagと同じにする）")
+    prewarm_parser.add_argument("--profile", help="分析プロファイル（full / lite）")
+    prewarm_parser.add_argument("--known-words", help="既知語リスト（1行1語。KNOWN_WORDS_FILE に追加される）")
+    prewarm_parser.add_argument("--progress-interval", type=float, default=5.0, help="進捗を表示する間隔（秒）")
+    prewarm_parser.set_defaults(func=prewarm)
+
+    lexicon_parser = subparsers.add_parser("build-lexicon", help="TSVから単語の頻度・発音記号の辞書（LEXICON_PATH）を作る")
+    lexicon_parser.add_argument("input", help="1行1語のTSV（単語, 頻度順位, 発音記号, 見出し語）")
+    lexicon_parser.add_argument("output", help="索引ファイルの出力先")
+    lexicon_parser.set_defaults(func=build_lexicon)
+
+    return parser
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    args.func(args)
@@ -1,22 +1,38 @@
 import os
+import time
+import atexit
+import random
 import uuid
 import json
 import base64
 import asyncio
+import gzip
+import hashlib
+import sqlite3
+import shutil
+import copy
+import mmap
+import struct
 import functions_framework
-from flask import jsonify
-from google import genai
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any, Tuple
+from flask import jsonify, Response
+from pydantic import BaseModel, Field, create_model
+from typing import TYPE_CHECKING, List, Optional, Dict, Any, Tuple
 import textwrap
-from gtts import gTTS
 from io import BytesIO
 from datetime import datetime
 from urllib.parse import quote
-from distutils.util import strtobool
-import requests
+import re
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import signal
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from contextlib import contextmanager, nullcontext
+from bisect import bisect_left
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+if TYPE_CHECKING:
+    import requests
 
 # HTTP Functions向けのカスタム例外
 class HTTPException(Exception):
@@ -25,16 +41,103 @@ class HTTPException(Exception):
         self.detail = detail
         super().__init__(self.detail)
 
+# 真偽値の環境変数の解釈（distutils.util.strtobool の代わり）
+def parse_bool(value: str) -> bool:
+    value = value.strip().lower()
+    if value in ("y", "yes", "t", "true", "on", "1"):
+        return True
+    if value in ("n", "no", "f", "false", "off", "0"):
+        return False
+    raise ValueError(f"Invalid truth value: {value}")
+
+# ステージごとの同時実行数の上限（<STAGE>_CONCURRENCY環境変数で変更可能）
+STAGE_CONCURRENCY_DEFAULTS = {"gemini": 8, "tts": 8}
+
+# 環境変数による設定（起動時に1回だけ読み込み、リクエストごとには読まない）
+class Settings:
+    def __init__(self, environ) -> None:
+        self.gemini_client = environ.get("GEMINI_CLIENT", "genai")
+        self.gemini_api_key = environ.get("GEMINI_API_KEY", "your-gemini-api-key-here")
+        self.gemini_model = environ.get("GEMINI_MODEL", "gemini-2.0-flash")
+        self.gemini_streaming = parse_bool(environ.get("GEMINI_STREAMING", "false"))
+        self.gemini_context_cache = parse_bool(environ.get("GEMINI_CONTEXT_CACHE", "true"))
+        self.gemini_context_cache_ttl = int(environ.get("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+        self.gemini_context_cache_max_entries = max(1, int(environ.get("GEMINI_CONTEXT_CACHE_MAX_ENTRIES", "16")))
+        self.gemini_rpm = float(environ.get("GEMINI_RPM", "0"))
+        self.gemini_tpm = float(environ.get("GEMINI_TPM", "0"))
+        self.gemini_output_tokens_estimate = int(environ.get("GEMINI_OUTPUT_TOKENS_ESTIMATE", "1000"))
+        self.gemini_max_attempts = max(1, int(environ.get("GEMINI_MAX_ATTEMPTS", "4")))
+        self.gemini_attempt_timeout = float(environ.get("GEMINI_ATTEMPT_TIMEOUT", "60"))
+        self.gemini_deadline = float(environ.get("GEMINI_DEADLINE", "120"))
+        self.gemini_retry_base = float(environ.get("GEMINI_RETRY_BASE", "1"))
+        self.gemini_retry_max = float(environ.get("GEMINI_RETRY_MAX", "30"))
+        self.gemini_hedge = parse_bool(environ.get("GEMINI_HEDGE", "false"))
+        self.gemini_hedge_model = environ.get("GEMINI_HEDGE_MODEL", "")
+        self.gemini_hedge_percentile = float(environ.get("GEMINI_HEDGE_PERCENTILE", "0.95"))
+        self.gemini_hedge_delay = float(environ.get("GEMINI_HEDGE_DELAY", "5"))
+        self.gemini_hedge_min_delay = float(environ.get("GEMINI_HEDGE_MIN_DELAY", "0.5"))
+        self.gemini_hedge_budget = float(environ.get("GEMINI_HEDGE_BUDGET", "0.05"))
+        self.stage_concurrency = {
+            stage: max(1, int(environ.get(f"{stage.upper()}_CONCURRENCY", str(default))))
+            for stage, default in STAGE_CONCURRENCY_DEFAULTS.items()
+        }
+        self.batch_concurrency = max(1, int(environ.get("BATCH_CONCURRENCY", "4")))
+        self.max_words_per_request = max(1, int(environ.get("MAX_WORDS_PER_REQUEST", "8")))
+        self.analysis_cache_db = environ.get("ANALYSIS_CACHE_DB", "/tmp/anki-card-generator/analysis_cache.sqlite3")
+        self.analysis_cache_size = int(environ.get("ANALYSIS_CACHE_SIZE", "256"))
+        self.analysis_cache_max_rows = int(environ.get("ANALYSIS_CACHE_MAX_ROWS", "20000"))
+        self.audio_cache_dir = environ.get("AUDIO_CACHE_DIR", "/tmp/anki-card-generator/audio")
+        self.audio_cache_max_bytes = int(environ.get("AUDIO_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+        self.audio_disk_max_bytes = int(environ.get("AUDIO_DISK_MAX_BYTES", str(128 * 1024 * 1024)))
+        self.audio_ref_ttl = float(environ.get("AUDIO_REF_TTL", "600"))
+        self.audio_ref_max_bytes = int(environ.get("AUDIO_REF_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.tts_engine = environ.get("TTS_ENGINE", "gtts")
+        self.tts_local_engine = environ.get("TTS_LOCAL_ENGINE", "espeak-ng")
+        self.tts_local_voice = environ.get("TTS_LOCAL_VOICE", "en-us")
+        self.tts_piper_model = environ.get("TTS_PIPER_MODEL", "")
+        self.tts_ffmpeg = environ.get("TTS_FFMPEG", "ffmpeg")
+        self.tts_mp3_bitrate = environ.get("TTS_MP3_BITRATE", "64k")
+        self.use_notion = parse_bool(environ.get("USE_NOTION", "false"))
+        self.notion_token = environ.get("NOTION_TOKEN")
+        self.notion_db_id = environ.get("NOTION_DB_ID")
+        self.notion_outbox_db = environ.get("NOTION_OUTBOX_DB", "/tmp/anki-card-generator/notion_outbox.sqlite3")
+        self.notion_rate_per_sec = float(environ.get("NOTION_RATE_PER_SEC", "3"))
+        self.notion_max_attempts = int(environ.get("NOTION_MAX_ATTEMPTS", "8"))
+        self.notion_flush_timeout = float(environ.get("NOTION_FLUSH_TIMEOUT", "8"))
+        self.lexicon_path = environ.get("LEXICON_PATH", "")
+        self.lexicon_rating_ranks = [int(rank) for rank in environ.get("LEXICON_RATING_RANKS", "1000,3000,8000,20000").split(",")]
+        self.known_words_file = environ.get("KNOWN_WORDS_FILE", "")
+        self.prewarm_min_word_length = int(environ.get("PREWARM_MIN_WORD_LENGTH", "4"))
+        self.prewarm_skip_rank = int(environ.get("PREWARM_SKIP_RANK", "3000"))
+        self.prewarm_queue_size = int(environ.get("PREWARM_QUEUE_SIZE", "2000"))
+        self.prewarm_concurrency = max(1, int(environ.get("PREWARM_CONCURRENCY", "2")))
+        self.prewarm_reserve = float(environ.get("PREWARM_RESERVE", "0.5"))
+        self.idempotency_ttl = float(environ.get("IDEMPOTENCY_TTL", "600"))
+        self.idempotency_max_bytes = int(environ.get("IDEMPOTENCY_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.idempotency_derive_key = parse_bool(environ.get("IDEMPOTENCY_DERIVE_KEY", "true"))
+        self.job_store = environ.get("JOB_STORE", "memory")
+        self.job_store_db = environ.get("JOB_STORE_DB", "/tmp/anki-card-generator/jobs.sqlite3")
+        self.job_concurrency = max(1, int(environ.get("JOB_CONCURRENCY", "4")))
+        self.job_max_pending = int(environ.get("JOB_MAX_PENDING", "1000"))
+        self.job_lease = max(1.0, float(environ.get("JOB_LEASE", "60")))
+        self.job_webhook_attempts = max(1, int(environ.get("JOB_WEBHOOK_ATTEMPTS", "3")))
+        self.job_webhook_timeout = float(environ.get("JOB_WEBHOOK_TIMEOUT", "10"))
+        self.request_log = parse_bool(environ.get("REQUEST_LOG", "true"))
+        self.warmup = parse_bool(environ.get("WARMUP", "true"))
+
+SETTINGS = Settings(os.environ)
+
 # GeminiのアプトプットのJSONスキーマ定義
 class WordAnalysis(BaseModel):
     contextual_translation: str = Field(description="[日本語必須] この場面での文章の意訳（日本語の感覚でどのような意味か、ニュアンスを大切に）")
+    # ストリーミング時に例文音声を早く開始できるよう、例文は前方に配置（出力順はフィールド順に従う）
+    example_sentence: str = Field(description="[英語+日本語] 単語を使った今日から使える簡単な例文「英語文（日本語訳）」形式")
     precise_translation: str = Field(description="[日本語必須] 単語の意味を正確に捉えた、文章の正確な日本語訳")
     frequency_rating: int = Field(description="単語の日常会話での出現頻度、英会話学習における単語の重要度を点数化", ge=1, le=5)
     ipa: str = Field(description="単語の発音記号（アメリカ英語）")
     part_of_speech: str = Field(description="[ENGLISH ONLY] 文章中での品詞（noun, verb, adjective, adverb, etc.）")
     english_definition: str = Field(description="[ENGLISH ONLY] できるだけ最小限に短く、中学・高校英語レベルでの簡潔な定義")
     japanese_meaning: str = Field(description="[日本語必須] この特定の文脈における単語の最も適切な日本語訳と簡潔な説明")
-    example_sentence: str = Field(description="[英語+日本語] 単語を使った今日から使える簡単な例文「英語文（日本語訳）」形式")
     core_meaning: Optional[str] = Field(description="[日本語必須] 単語の核となる意味や語源的説明。別の文脈での意味も含む")
     antonyms: List[str] = Field(description="[ENGLISH ONLY] 中学・高校英語レベルでの対義語のリスト（重要度順）")
     synonyms: List[str] = Field(description="[ENGLISH ONLY] 中学・高校英語レベルでの類義語のリスト（最も近い意味順）") 
@@ -45,140 +148,1939 @@ class WordAnalysis(BaseModel):
     terminology: Optional[str] = Field(description="[日本語必須] IT、プログラミング、マーケティングでの専門用語になっているかどうか")
     explanation: str = Field(description="[日本語必須] 英単語・英文の説明の最終説明＆総括。")
 
-# シングルトンパターンでGemini APIクライアントを初期化
-class GeminiClient:
+# シングルトンパターンでGemini APIクライアントを初期化
+class GeminiClient:
+    _instance = None
+    _model = None
+    _lock = threading.Lock()
+    
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:  # 二重チェックロック
+                    if SETTINGS.gemini_client == "stub":
+                        # オフライン動作確認用のスタブクライアント
+                        from stubs import StubGeminiClient
+                        cls._instance = StubGeminiClient()
+                    else:
+                        # SDKの読み込みは重いため、最初に使う時（またはウォームアップ時）まで遅らせる
+                        from google import genai
+                        cls._instance = genai.Client(api_key=SETTINGS.gemini_api_key)
+                    cls._model = SETTINGS.gemini_model
+        return cls._instance, cls._model
+
+def generate_unique_file_name(word):
+    return f"{word}-{uuid.uuid4().hex[:6]}"
+
+# サイズ上限付きのLRUキャッシュ（スレッドセーフ）
+class LRUCache:
+    def __init__(self, max_size: int, sizeof=None) -> None:
+        self.max_size = max_size
+        self._sizeof = sizeof or (lambda value: 1)
+        self._data: "OrderedDict[str, Any]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: str, value: Any) -> None:
+        size = self._sizeof(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._data:
+                self._size -= self._sizeof(self._data.pop(key))
+            self._data[key] = value
+            self._size += size
+            # 上限を超えたら古いものから追い出す
+            while self._size > self.max_size:
+                _, evicted = self._data.popitem(last=False)
+                self._size -= self._sizeof(evicted)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if key in self._data:
+                self._size -= self._sizeof(self._data.pop(key))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+# スレッドプール実行器（イベントループからのブロッキング処理用）
+executor = ThreadPoolExecutor(max_workers=10)
+
+# 専用スレッドで常駐する長寿命のイベントループ
+class EventLoopThread:
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        # SQLiteやファイルI/Oなどのブロッキング処理は共通のスレッドプールで実行
+        self.loop.set_default_executor(executor)
+        self._thread = threading.Thread(target=self.loop.run_forever, name="anki-event-loop", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:  # 二重チェックロック
+                    cls._instance = cls()
+        return cls._instance
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        return self.submit(coro).result()
+
+# ステージごとの同時実行数の上限
+_stage_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+def stage_limit(stage):
+    # イベントループのスレッドからのみ呼ばれるためロックは不要
+    if stage not in _stage_semaphores:
+        _stage_semaphores[stage] = asyncio.Semaphore(SETTINGS.stage_concurrency[stage])
+    return _stage_semaphores[stage]
+
+# イベントループ上で共有する非同期HTTPクライアント（コネクションプール）
+class AsyncHTTPClient:
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        # イベントループのスレッドからのみ呼ばれるためロックは不要
+        if cls._instance is None:
+            import httpx
+            cls._instance = httpx.AsyncClient(
+                timeout=httpx.Timeout(30.0),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            )
+        return cls._instance
+
+# 同じキーの同時実行を1回にまとめる（後続の呼び出しは先行の結果を共有）
+class AsyncSingleFlight:
+    def __init__(self) -> None:
+        self._calls: Dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fn, *args) -> Any:
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn(*args)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 待機者がいない場合に未取得の例外として警告が出ないようにする
+            future.exception()
+            raise
+        finally:
+            self._calls.pop(key, None)
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._calls
+
+    # 同じキーの呼び出しが実行中ならその結果を待つ（実行中でない場合・失敗した場合はNone）
+    async def join(self, key: str) -> Any:
+        future = self._calls.get(key)
+        if future is None:
+            return None
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            return None
+
+def normalize_tts_text(text):
+    return " ".join(text.split())
+
+def audio_cache_key(text, lang, engine) -> str:
+    key_source = json.dumps([normalize_tts_text(text), lang, engine], ensure_ascii=False)
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+# 合成済みMP3のキャッシュ（バイト数上限のメモリLRU + バイト数上限のディスク）
+class AudioCache:
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, cache_dir: Optional[str], max_bytes: int, disk_max_bytes: int) -> None:
+        self._memory = LRUCache(max_bytes, sizeof=len)
+        self._cache_dir = cache_dir
+        self._disk_max_bytes = disk_max_bytes
+        # ディスク上のファイルの索引（最後に使った順。最初に使う時にディレクトリから作る）
+        self._disk_index: Optional["OrderedDict[str, int]"] = None
+        self._disk_bytes = 0
+        self._disk_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "disk_evictions": 0}
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:  # 二重チェックロック
+                    cls._instance = cls(SETTINGS.audio_cache_dir or None, SETTINGS.audio_cache_max_bytes, SETTINGS.audio_disk_max_bytes)
+        return cls._instance
+
+    # 既存のファイルを更新時刻の古い順に並べる（ロックを取って呼ぶ）
+    def _load_disk_index(self) -> "OrderedDict[str, int]":
+        if self._disk_index is None:
+            entries = []
+            try:
+                with os.scandir(self._cache_dir) as it:
+                    for entry in it:
+                        if entry.name.endswith(".mp3"):
+                            stat = entry.stat()
+                            entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+            except FileNotFoundError:
+                pass
+            entries.sort()
+            self._disk_index = OrderedDict((key, size) for _, key, size in entries)
+            self._disk_bytes = sum(self._disk_index.values())
+        return self._disk_index
+
+    # 読んだファイルを最近使ったものとして扱う（更新時刻も進めて、再起動後の順序に残す）
+    def _touch(self, key: str) -> None:
+        with self._disk_lock:
+            index = self._load_disk_index()
+            if key in index:
+                index.move_to_end(key)
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+
+    # 書き込んだファイルを索引に加え、上限を超えた分を最後に使ったのが古いものから消す
+    # （/tmp はメモリ上のファイルシステムのため、上限がないとインスタンスのメモリを使い切る）
+    def _track(self, key: str, size: int) -> None:
+        evicted = []
+        with self._disk_lock:
+            index = self._load_disk_index()
+            self._disk_bytes += size - index.pop(key, 0)
+            index[key] = size
+            while self._disk_bytes > self._disk_max_bytes and index:
+                evicted_key, evicted_size = index.popitem(last=False)
+                self._disk_bytes -= evicted_size
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            try:
+                os.remove(self._path(evicted_key))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Audio cache eviction error: {str(e)}")
+            self.record("disk_evictions")
+
+    def record(self, name: str) -> None:
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._cache_dir, f"{key}.mp3")
+
+    def get(self, key: str) -> Optional[bytes]:
+        audio_bytes = self._memory.get(key)
+        if audio_bytes is not None:
+            self.record("memory_hits")
+            return audio_bytes
+
+        if self._cache_dir:
+            try:
+                with open(self._path(key), "rb") as f:
+                    audio_bytes = f.read()
+            except FileNotFoundError:
+                audio_bytes = None
+            except OSError as e:
+                print(f"Audio cache read error: {str(e)}")
+                audio_bytes = None
+
+        if audio_bytes is None:
+            self.record("misses")
+            return None
+
+        self.record("disk_hits")
+        self._touch(key)
+        self._memory.set(key, audio_bytes)
+        return audio_bytes
+
+    def set(self, key: str, audio_bytes: bytes) -> None:
+        self._memory.set(key, audio_bytes)
+        if not self._cache_dir:
+            return
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            # 書きかけのファイルを読まないように一時ファイル経由で置き換え
+            tmp_path = f"{self._path(key)}.{uuid.uuid4().hex[:6]}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(audio_bytes)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f"Audio cache write error: {str(e)}")
+            return
+        self._track(key, len(audio_bytes))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["hits"] = stats["memory_hits"] + stats["disk_hits"]
+        stats["memory_entries"] = len(self._memory)
+        with self._disk_lock:
+            stats["disk_bytes"] = self._disk_bytes
+        return stats
+
+# 参照モードで返す音声の一時保管（IDで短時間だけ取得可能）
+class AudioStore:
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, ttl: float, max_bytes: int) -> None:
+        self._ttl = ttl
+        self._entries = LRUCache(max_bytes, sizeof=lambda entry: len(entry[0]))
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:  # 二重チェックロック
+                    cls._instance = cls(SETTINGS.audio_ref_ttl, SETTINGS.audio_ref_max_bytes)
+        return cls._instance
+
+    def put(self, audio_bytes: bytes) -> str:
+        audio_id = uuid.uuid4().hex
+        self._entries.set(audio_id, (audio_bytes, time.monotonic() + self._ttl))
+        return audio_id
+
+    def get(self, audio_id: str) -> Optional[bytes]:
+        entry = self._entries.get(audio_id)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def pop(self, audio_id: str) -> Optional[bytes]:
+        audio_bytes = self.get(audio_id)
+        self._entries.delete(audio_id)
+        return audio_bytes
+
+_tts_flight = AsyncSingleFlight()
+# 同じキャッシュキーの分析（通常のリクエスト・事前分析）
+_analysis_flight = AsyncSingleFlight()
+
+def _decode_gtts_response(tts, text):
+    for line in text.splitlines():
+        if "jQ1olc" in line:
+            audio_search = re.search(r'jQ1olc","\[\\"(.*)\\"]', line)
+            if audio_search:
+                return base64.b64decode(audio_search.group(1).encode("ascii"))
+    # リクエストは成功したが音声データが含まれていない
+    from gtts.tts import gTTSError
+    raise gTTSError(tts=tts)
+
+# 音声合成エンジンの共通インターフェース（どのエンジンもMP3のバイト列を返す）
+class TTSBackend(ABC):
+    _instance = None
+    _lock = threading.Lock()
+    # キャッシュキーに使うエンジン名（声やモデルを変えたら別のキャッシュになるようにする）
+    name = ""
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:  # 二重チェックロック
+                    if SETTINGS.tts_engine == "stub":
+                        # オフライン動作確認・ベンチマーク用のスタブ
+                        from stubs import StubTTS
+                        cls._instance = StubTTS()
+                    elif SETTINGS.tts_engine in TTS_BACKENDS:
+                        cls._instance = TTS_BACKENDS[SETTINGS.tts_engine]()
+                    else:
+                        raise ValueError(f"TTS_ENGINE must be one of {', '.join([*TTS_BACKENDS, 'stub'])}")
+        return cls._instance
+
+    @abstractmethod
+    async def synthesize(self, text: str, lang: str) -> bytes:
+        ...
+
+    # 起動時のウォームアップで呼ばれる
+    async def warm_up(self) -> None:
+        pass
+
+# gTTSを使用したMP3合成（分割されたチャンクを共有プールで並列取得）
+class GTTSBackend(TTSBackend):
+    name = "gtts"
+    # チャンクのリクエストを作るgTTSの内部API（_prepare_requests）の動作を確認した版。それ以外の版では公開APIで合成する
+    parallel_versions = ("2.5.",)
+
+    def __init__(self) -> None:
+        self._parallel: Optional[bool] = None
+
+    def _supports_parallel(self) -> bool:
+        if self._parallel is None:
+            import gtts
+            self._parallel = gtts.__version__.startswith(self.parallel_versions) and callable(getattr(gtts.gTTS, "_prepare_requests", None))
+            if not self._parallel:
+                print(f"gTTS {gtts.__version__} is not a tested version, synthesizing chunks sequentially with write_to_fp")
+        return self._parallel
+
+    # 公開API（チャンクを順に取得する同期処理）をスレッドで実行する
+    @staticmethod
+    def _write_to_bytes(tts) -> bytes:
+        buffer = BytesIO()
+        tts.write_to_fp(buffer)
+        return buffer.getvalue()
+
+    async def synthesize(self, text, lang):
+        from gtts import gTTS
+        tts = gTTS(text, lang=lang)
+        if not self._supports_parallel():
+            return await asyncio.get_running_loop().run_in_executor(None, self._write_to_bytes, tts)
+        client = AsyncHTTPClient.get_instance()
+
+        async def fetch(prepared):
+            response = await client.request(prepared.method, prepared.url, headers=dict(prepared.headers), content=prepared.body)
+            response.raise_for_status()
+            return _decode_gtts_response(tts, response.text)
+
+        parts = await asyncio.gather(*(fetch(prepared) for prepared in tts._prepare_requests()))
+        return b"".join(parts)
+
+    async def warm_up(self):
+        AsyncHTTPClient.get_instance()
+        import gtts  # noqa: F401
+
+# ローカルのエンジン（espeak-ng / piper）で音声を作り、ffmpegでMP3に変換する（ネットワーク不要）
+class LocalTTSBackend(TTSBackend):
+    def __init__(self) -> None:
+        self.engine = SETTINGS.tts_local_engine
+        if self.engine == "espeak-ng":
+            self.name = f"espeak-ng:{SETTINGS.tts_local_voice}"
+        elif self.engine == "piper":
+            if not SETTINGS.tts_piper_model:
+                raise ValueError("TTS_PIPER_MODEL is required for TTS_LOCAL_ENGINE=piper")
+            self.name = f"piper:{os.path.basename(SETTINGS.tts_piper_model)}"
+            self.sample_rate = self._piper_sample_rate(SETTINGS.tts_piper_model)
+        else:
+            raise ValueError("TTS_LOCAL_ENGINE must be espeak-ng or piper")
+        for command in (self.engine, SETTINGS.tts_ffmpeg):
+            if shutil.which(command) is None:
+                raise RuntimeError(f"{command} is not installed")
+
+    # piperのモデル設定（<model>.json）から出力のサンプリングレートを読む
+    @staticmethod
+    def _piper_sample_rate(model_path: str) -> int:
+        try:
+            with open(f"{model_path}.json", encoding="utf-8") as f:
+                return int(json.load(f)["audio"]["sample_rate"])
+        except (OSError, KeyError, ValueError, TypeError):
+            return 22050
+
+    async def _run(self, args, stdin: bytes) -> bytes:
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate(stdin)
+        if process.returncode != 0:
+            raise RuntimeError(f"{args[0]} failed: {stderr.decode('utf-8', 'replace').strip()}")
+        return stdout
+
+    async def synthesize(self, text, lang):
+        # 言語は声（TTS_LOCAL_VOICE）またはモデル（TTS_PIPER_MODEL）で決まる
+        if self.engine == "espeak-ng":
+            audio = await self._run(["espeak-ng", "-v", SETTINGS.tts_local_voice, "--stdout", "--stdin"], text.encode("utf-8"))
+            input_format = []
+        else:
+            # piperは16bitモノラルの生PCMを標準出力に書く
+            audio = await self._run(["piper", "--model", SETTINGS.tts_piper_model, "--output_raw"], text.encode("utf-8"))
+            input_format = ["-f", "s16le", "-ar", str(self.sample_rate), "-ac", "1"]
+        return await self._run(
+            [SETTINGS.tts_ffmpeg, "-hide_banner", "-loglevel", "error", *input_format, "-i", "pipe:0",
+             "-codec:a", "libmp3lame", "-b:a", SETTINGS.tts_mp3_bitrate, "-f", "mp3", "pipe:1"],
+            audio,
+        )
+
+# 何も合成しないエンジン（テスト用。ベンチマークの TTS_ENGINE=stub は遅延を足してこれを使う）。文字数に応じた長さの無音MP3を返す
+class NullTTSBackend(TTSBackend):
+    name = "null"
+    # MPEG-1 Layer III 128kbps 44.1kHz の無音フレーム（約26ms）
+    silent_frame = b"\xff\xfb\x90\x64" + bytes(413)
+
+    async def synthesize(self, text, lang):
+        return self.silent_frame * max(1, len(text) // 4)
+
+TTS_BACKENDS = {"gtts": GTTSBackend, "local": LocalTTSBackend, "null": NullTTSBackend}
+
+async def _load_or_synthesize(key, text, lang):
+    loop = asyncio.get_running_loop()
+    cache = AudioCache.get_instance()
+    audio_bytes = await loop.run_in_executor(None, cache.get, key)
+    if audio_bytes is None:
+        count_outcome("audio_cache_misses")
+        async with stage_limit("tts"):
+            audio_bytes = await TTSBackend.get_instance().synthesize(text, lang)
+        await loop.run_in_executor(None, cache.set, key, audio_bytes)
+    else:
+        count_outcome("audio_cache_hits")
+    return audio_bytes
+
+# キャッシュ + 同時実行の重複排除つき音声合成
+async def synthesize_speech(text, lang='en'):
+    key = audio_cache_key(text, lang, TTSBackend.get_instance().name)
+    return await _tts_flight.do(key, _load_or_synthesize, key, normalize_tts_text(text), lang)
+
+# 音声生成（埋め込み名だけはカードごと）
+async def generate_audio_clip_async(sentence, unique_file_name):
+    audio_embed = f"![[{unique_file_name}.mp3]]"
+    
+    # Base64エンコード
+    audio_base64 = base64.b64encode(await synthesize_speech(sentence)).decode('utf-8')
+    
+    return audio_base64, audio_embed
+
+def generate_audio_clip(sentence, unique_file_name):
+    return EventLoopThread.get_instance().run(generate_audio_clip_async(sentence, unique_file_name))
+
+# 各フィールドの生成ルール（プロファイルで選ばれたフィールドだけをシステム指示に含める）
+FIELD_GUIDELINES = {
+    "contextual_translation": "[日本語必須] この場面での文章の意訳（日本語の感覚でどのような意味か、ニュアンスを大切に）",
+    "example_sentence": "[英語+日本語] 対象単語を使った簡単な例文。「英語文（日本語訳）」形式厳守",
+    "precise_translation": "[日本語必須] 対象単語の意味を正確に捉えた、文章の正確な日本語訳",
+    "frequency_rating": "[数字] 1(ほとんど使われない)〜5(非常によく使われる)の整数で表す。対象単語の日常会話、海外ドラマ、アニメでの使用頻度、英会話学習における単語の重要度を点数化。",
+    "ipa": "[IPA] 対象単語のアメリカ英語発音記号",
+    "part_of_speech": "[ENGLISH ONLY] 文章中での品詞（noun, verb, adjective, adverb, etc.）",
+    "english_definition": "[ENGLISH ONLY] 30語以内の中学・高校英語レベルでの簡潔な英英定義",
+    "japanese_meaning": "[日本語必須] この特定の文脈における単語の最も適切な日本語訳と簡潔な説明",
+    "core_meaning": "[日本語必須] 単語の核となる意味や語源的説明、別の文脈での意味も含む",
+    "antonyms": "[ENGLISH ONLY] 中学・高校英語レベルでの対義語リスト（重要度順）。（できるだけ中学レベルの単語で）",
+    "synonyms": "[ENGLISH ONLY] 中学・高校英語レベルでの類義語リスト（最も近い意味順）。（できるだけ中学レベルの単語で）",
+    "slang": "[英語+日本語] 文中に含まれるスラング表現の説明。「英語（日本語説明）」形式",
+    "idioms": "[英語+日本語] 文中に含まれる文中に含まれる熟語・連語・群動詞・慣用句の説明。熟語の判定は緩くて問題ないです。特別な単語の組み合わせパターンがあれば解説してください。「英語（日本語説明）」形式",
+    "japanese_usage": "[日本語必須] 日本でのカタカナ英語や商品名としての馴染み",
+    "memory_aids": "[日本語必須] 単語を効果的に覚えるためのコツや関連付け方法",
+    "terminology": "[日本語必須] IT、プログラミング、マーケティングでの専門用語としての使われ方",
+    "explanation": "[日本語必須] 英単語・英文の最終説明と総括",
+}
+
+# 全カード共通の静的なシステム指示（プロファイル・モデルごとに1回だけコンテキストキャッシュへ登録）
+SYSTEM_INSTRUCTION_TEMPLATE = textwrap.dedent("""
+    <role>
+    あなたは英語と日本語のバイリンガルで、英語学習者にとって最高の説明者です。
+    あなたの重要な役割は、指定された言語（日本語または英語）で各項目を回答することです。
+    各フィールドの言語指定を絶対に守ってください。
+    </role>
+
+    <task>
+    ユーザーが指定するセリフ英文中の対象単語について詳細に分析し、指定のJSON形式で回答してください。
+    </task>
+
+    <audience>
+    20〜30代歳男性の日本人。高校英語レベルは80%くらいの理解度だが英語での会話はかなり辿々しい。
+    イマージョンラーニング（3年目）で英語学習中。日本のアニメや海外ドラマを英語音声・字幕で視聴しながら学習中。
+    プログラミング、ビジネス、テクノロジー関連の用語には比較的馴染みがある。
+    </audience>
+
+    <importance>
+    教育的価値の高い説明を提供し、特に対象単語の意味、使い方、ニュアンスを明確に伝えてください。
+    説明は簡潔に、中学・高校レベルの理解しやすい言葉を使用してください。
+    対象者のプログラミングやマーケティングの知識を活かした例や説明があれば、それも取り入れてください。
+    </importance>
+
+    <field_language_rules>
+    各フィールドには厳格な言語指定があります：
+    - [日本語必須]: このフィールドは必ず日本語のみで記入してください。英語は一切使用禁止です。
+    - [ENGLISH ONLY]: このフィールドは必ず英語のみで記入してください。日本語は一切使用禁止です。
+    - [英語+日本語]: このフィールドは指定された形式（「英語文（日本語訳）」など）に厳密に従ってください。
+
+    言語指定違反は回答全体の品質を著しく低下させるため、最優先事項として扱ってください。
+    </field_language_rules>
+
+    <field_guidelines>
+    {field_guidelines}
+    </field_guidelines>
+
+    <empty_string_and_empty_array_rules>
+    該当する情報がない場合は、以下のルールを厳守してください：
+    - Optional[str]型フィールド: 空文字列""を使用
+    - List[str]型フィールド: 空配列[]を使用
+    これは出力JSONの処理のために非常に重要です。
+    </empty_string_and_empty_array_rules>
+
+    <language_validation>
+    回答を提出する前に、以下を確認してください：
+    1. [日本語必須] フィールドに英単語や英文が含まれていないか
+    2. [ENGLISH ONLY] フィールドに日本語が含まれていないか
+    3. [英語+日本語] フィールドが指定形式に従っているか
+    4. 空値ルールが正しく適用されているか
+
+    全ての言語指定を守ることで、英語学習者にとって最高の学習リソースを提供できます。
+    </language_validation>
+
+    <output_constraints>
+    - すべてのフィールドは指定された要件を満たし、形式を厳守します。
+    - 特に言語指定に関しては、絶対に違反しないでください：
+    - [日本語必須] のフィールドには日本語のみを使用し、英語は一切含めないでください。
+    - [ENGLISH ONLY] のフィールドには英語のみを使用し、日本語は一切含めないでください。
+    - [英語+日本語] のフィールドは指定された形式（「英語文（日本語訳）」など）に厳密に従ってください。
+    - 理解を助けるようなわかりやすい情報がない場合は、無理に項目を埋めようとせず、下記のルールに従って、回答なしの意思を示してください：
+    - 文字列型のオプショナルフィールドは必ず空文字列""を使用
+    - 配列型のフィールドで項目がない場合は必ず空配列[]を使用
+    - 言語指定違反は回答全体の品質を著しく低下させるため、特に注意してください。
+    </output_constraints>
+    """)
+
+def build_system_instruction(fields):
+    field_guidelines = "\n".join(f"- {name}: {FIELD_GUIDELINES[name]}" for name in fields)
+    return SYSTEM_INSTRUCTION_TEMPLATE.replace("{field_guidelines}", field_guidelines)
+
+SYSTEM_INSTRUCTION = build_system_instruction(WordAnalysis.model_fields)
+
+# リクエストごとに変わる部分だけのプロンプト
+def create_prompt(sentence, word, tag):
+    prompt = f"""
+        <input>
+        {f'『{tag}』を視聴していた時に登場した、' if tag != "Other" else ''}セリフ英文「{sentence}」
+        対象単語「{word}」
+        </input>
+        """
+    return textwrap.dedent(prompt)
+
+# 同じセリフ英文の複数の単語を1回で分析するプロンプト
+def create_multi_word_prompt(sentence, words, tag):
+    target_words = "\n".join(f"対象単語「{word}」" for word in words)
+    # 複数行の対象単語を差し込むとインデントが揃わなくなるため、先にテンプレートをdedentしてから埋め込む
+    prompt = textwrap.dedent("""
+        <input>
+        {context}セリフ英文「{sentence}」
+        {target_words}
+        </input>
+        """)
+    return prompt.format(
+        context=f'『{tag}』を視聴していた時に登場した、' if tag != "Other" else '',
+        sentence=sentence,
+        target_words=target_words,
+    )
+
+# 文全体に対するフィールド（複数単語の分析では1回だけ生成して各カードで共有する）
+SENTENCE_LEVEL_FIELDS = ("contextual_translation", "slang", "idioms")
+
+MULTI_WORD_INSTRUCTION = textwrap.dedent("""
+    <multiple_target_words>
+    対象単語が複数指定された場合、文全体に関するフィールド（{sentence_fields}）はトップレベルに1回だけ回答してください。
+    それ以外のフィールドは words 配列に対象単語の指定順で1件ずつ回答し、各要素の word には対象単語をそのまま記入してください。
+    </multiple_target_words>
+    """)
+
+# 分析プロファイル（Geminiに生成させるフィールドの組み合わせ）
+ANALYSIS_PROFILES = {
+    "full": tuple(WordAnalysis.model_fields),
+    # ios_shortcut_only/schema.json・AnkiCardDesignLite で使うフィールド
+    "lite": ("contextual_translation", "example_sentence", "ipa", "part_of_speech", "english_definition", "japanese_meaning"),
+}
+
+class AnalysisProfile:
+    _instances: Dict[Tuple[Tuple[str, ...], bool], "AnalysisProfile"] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, fields: Tuple[str, ...], multi: bool = False) -> None:
+        self.fields = fields
+        self.multi = multi
+        if fields == ANALYSIS_PROFILES["full"]:
+            self.key = "full"
+            self.schema = WordAnalysis
+        else:
+            # 選ばれたフィールドだけを持つレスポンススキーマ（不要なフィールドは生成させない）
+            self.key = hashlib.sha256(",".join(fields).encode("utf-8")).hexdigest()[:12]
+            self.schema = create_model(
+                f"WordAnalysis_{self.key}",
+                **{name: (WordAnalysis.model_fields[name].annotation, WordAnalysis.model_fields[name]) for name in fields},
+            )
+        self.system_instruction = build_system_instruction(fields)
+        if multi:
+            # 文全体のフィールドはトップレベルに1つ、単語ごとのフィールドは words 配列の要素に持たせる
+            self.shared_fields = tuple(name for name in fields if name in SENTENCE_LEVEL_FIELDS)
+            word_model = create_model(
+                f"WordItem_{self.key}",
+                word=(str, Field(description="対象単語（指定された表記のまま）")),
+                **{name: (WordAnalysis.model_fields[name].annotation, WordAnalysis.model_fields[name]) for name in fields if name not in self.shared_fields},
+            )
+            self.schema = create_model(
+                f"MultiWordAnalysis_{self.key}",
+                **{name: (WordAnalysis.model_fields[name].annotation, WordAnalysis.model_fields[name]) for name in self.shared_fields},
+                words=(List[word_model], Field(description="対象単語ごとの分析（指定順）")),
+            )
+            self.key = f"{self.key}-multi"
+            self.system_instruction += MULTI_WORD_INSTRUCTION.replace("{sentence_fields}", ", ".join(self.shared_fields) or "なし")
+        self.config = {
+            'response_mime_type': 'application/json',
+            'response_schema': self.schema,
+            'system_instruction': self.system_instruction,
+        }
+
+    @classmethod
+    def get(cls, profile=None, fields=None):
+        # fieldsだけ指定された場合はcustomとして扱う
+        if profile is None:
+            profile = "full" if fields is None else "custom"
+        if profile == "custom":
+            if not isinstance(fields, list) or not fields:
+                raise HTTPException(400, "fields must be a non-empty list for profile 'custom'")
+            unknown = [name for name in fields if name not in WordAnalysis.model_fields]
+            if unknown:
+                raise HTTPException(400, f"Unknown fields: {', '.join(map(str, unknown))}")
+            # スキーマのフィールド順（例文を早く出す順序）にそろえる
+            fields = tuple(name for name in WordAnalysis.model_fields if name in fields)
+        elif profile in ANALYSIS_PROFILES:
+            fields = ANALYSIS_PROFILES[profile]
+        else:
+            raise HTTPException(400, f"profile must be one of {', '.join([*ANALYSIS_PROFILES, 'custom'])}")
+        return cls._instance_for(fields)
+
+    @classmethod
+    def _instance_for(cls, fields, multi=False):
+        if (fields, multi) not in cls._instances:
+            with cls._lock:
+                if (fields, multi) not in cls._instances:  # 二重チェックロック
+                    cls._instances[(fields, multi)] = cls(fields, multi)
+        return cls._instances[(fields, multi)]
+
+    # 同じフィールドで複数の単語をまとめて分析するプロファイル
+    def for_words(self):
+        return self._instance_for(self.fields, True)
+
+    # 指定したフィールドを生成しないプロファイル（辞書で埋まるフィールドを省く）
+    def without(self, names):
+        fields = tuple(name for name in self.fields if name not in names)
+        return self if fields == self.fields else self._instance_for(fields)
+
+FULL_PROFILE = AnalysisProfile.get("full")
+GEMINI_CONFIG = FULL_PROFILE.config
+
+# システム指示のコンテキストキャッシュ（モデルごとに1回登録し、期限前に作り直す）
+class SystemInstructionCache:
+    # (モデル, プロファイル) ごとのキャッシュ。カスタム・複数単語・辞書で省いたフィールドの組み合わせごとに増えるため、
+    # GEMINI_CONTEXT_CACHE_MAX_ENTRIES を超えたら最も使われていないものから削除する
+    _entries: "OrderedDict[str, Tuple[Optional[str], float]]" = OrderedDict()
+    _locks: Dict[str, asyncio.Lock] = {}
+
+    @classmethod
+    async def get_config(cls, gemini_client, gemini_model, profile=None) -> Dict[str, Any]:
+        profile = profile or FULL_PROFILE
+        if not SETTINGS.gemini_context_cache:
+            return profile.config
+
+        # イベントループのスレッドからのみ呼ばれるためロックの生成は競合しない
+        entry_key = f"{gemini_model}:{profile.key}"
+        lock = cls._locks.setdefault(entry_key, asyncio.Lock())
+        async with lock:
+            cache_name, expires_at = cls._entries.get(entry_key, (None, 0.0))
+            if time.monotonic() >= expires_at:
+                cache_name, expires_at = await cls._register(gemini_client, gemini_model, profile)
+                cls._entries[entry_key] = (cache_name, expires_at)
+                await cls._evict(gemini_client)
+            cls._entries.move_to_end(entry_key)
+
+        if cache_name is None:
+            return profile.config
+        return {
+            'response_mime_type': 'application/json',
+            'response_schema': profile.schema,
+            'cached_content': cache_name,
+        }
+
+    @classmethod
+    async def _register(cls, gemini_client, gemini_model, profile) -> Tuple[Optional[str], float]:
+        ttl = SETTINGS.gemini_context_cache_ttl
+        try:
+            cached = await gemini_client.aio.caches.create(
+                model=gemini_model,
+                config={
+                    'display_name': f"anki-card-generator-{prompt_template_hash(profile)}",
+                    'system_instruction': profile.system_instruction,
+                    'ttl': f"{ttl}s",
+                },
+            )
+            # 期限切れ直前のキャッシュを使わないよう少し早めに作り直す
+            return cached.name, time.monotonic() + ttl * 0.9
+        except Exception as e:
+            # キャッシュ非対応のモデル・プラン（最小トークン数未満など）では毎回システム指示を送る
+            print(f"Context cache unavailable for {gemini_model}, falling back to system_instruction: {str(e)}")
+            return None, time.monotonic() + ttl
+
+    @classmethod
+    async def _evict(cls, gemini_client) -> None:
+        while len(cls._entries) > SETTINGS.gemini_context_cache_max_entries:
+            entry_key, (cache_name, _) = cls._entries.popitem(last=False)
+            lock = cls._locks.get(entry_key)
+            if lock is not None and not lock.locked():
+                del cls._locks[entry_key]
+            if cache_name is None:
+                continue
+            # サーバー側のキャッシュもTTLを待たずに消す（失敗しても期限切れで消える）
+            try:
+                await gemini_client.aio.caches.delete(name=cache_name)
+            except Exception as e:
+                print(f"Context cache delete error for {cache_name}: {str(e)}")
+
+    # キャッシュを指定した呼び出しが、サーバー側で期限切れ・削除されたキャッシュのために失敗したか
+    @staticmethod
+    def is_stale(config, error) -> bool:
+        if "cached_content" not in config:
+            return False
+        code = getattr(error, "code", None)
+        return code == 404 or (code in (400, 403) and "cache" in str(error).lower())
+
+    # 使えなくなったキャッシュを捨て（次の呼び出しで作り直す）、システム指示を送る設定を返す
+    @classmethod
+    def invalidate(cls, gemini_model, profile, error) -> Dict[str, Any]:
+        print(f"Context cache for {gemini_model} is no longer available, retrying with system_instruction: {str(error)}")
+        cls._entries.pop(f"{gemini_model}:{profile.key}", None)
+        return profile.config
+
+# 事前分析など低優先度の処理の印（Geminiの実行枠を通常のリクエストに譲る）
+_background_priority: ContextVar[bool] = ContextVar("background_priority", default=False)
+
+# リクエストごとのトークン使用量（コンテキスト変数で子タスクにも引き継がれる）
+_request_usage: ContextVar[Optional[Dict[str, int]]] = ContextVar("request_usage", default=None)
+
+# プロセス全体の累計トークン使用量
+class TokenUsage:
+    _lock = threading.Lock()
+    totals = {"requests": 0, "input_tokens": 0, "output_tokens": 0, "cached_tokens": 0}
+
+    @classmethod
+    def record(cls, usage_metadata) -> None:
+        if usage_metadata is None:
+            return
+        usage = {
+            "input_tokens": usage_metadata.prompt_token_count or 0,
+            "output_tokens": usage_metadata.candidates_token_count or 0,
+            "cached_tokens": usage_metadata.cached_content_token_count or 0,
+        }
+        request_usage = _request_usage.get()
+        if request_usage is not None:
+            for key, value in usage.items():
+                request_usage[key] = request_usage.get(key, 0) + value
+        with cls._lock:
+            cls.totals["requests"] += 1
+            for key, value in usage.items():
+                cls.totals[key] += value
+
+    @classmethod
+    def snapshot(cls) -> Dict[str, int]:
+        with cls._lock:
+            return dict(cls.totals)
+
+# ステージごとの所要時間ヒストグラム（プロセス内で累積し、/metrics で公開）
+class StageMetrics:
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    _lock = threading.Lock()
+    _histograms: Dict[str, Dict[str, Any]] = {}
+
+    @classmethod
+    def observe(cls, stage: str, seconds: float) -> None:
+        with cls._lock:
+            histogram = cls._histograms.get(stage)
+            if histogram is None:
+                histogram = {"count": 0, "sum": 0.0, "max": 0.0, "counts": [0] * (len(cls.buckets) + 1)}
+                cls._histograms[stage] = histogram
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+            histogram["counts"][bisect_left(cls.buckets, seconds)] += 1
+
+    @classmethod
+    def reset(cls) -> None:
+        with cls._lock:
+            cls._histograms = {}
+
+    # バケットの上限値から分位点を見積もる（最後のバケットは最大値）
+    @classmethod
+    def _quantile(cls, histogram: Dict[str, Any], q: float) -> float:
+        target = q * histogram["count"]
+        cumulative = 0
+        for index, count in enumerate(histogram["counts"]):
+            cumulative += count
+            if cumulative >= target and count:
+                return cls.buckets[index] if index < len(cls.buckets) else histogram["max"]
+        return histogram["max"]
+
+    @classmethod
+    def snapshot(cls) -> Dict[str, Dict[str, Any]]:
+        with cls._lock:
+            histograms = {stage: {**h, "counts": list(h["counts"])} for stage, h in cls._histograms.items()}
+        stages = {}
+        for stage, histogram in sorted(histograms.items()):
+            cumulative = 0
+            buckets = []
+            for bound, count in zip([*map(str, cls.buckets), "+Inf"], histogram["counts"]):
+                cumulative += count
+                buckets.append([bound, cumulative])
+            stages[stage] = {
+                "count": histogram["count"],
+                "sum": round(histogram["sum"], 6),
+                "mean": round(histogram["sum"] / histogram["count"], 6),
+                "max": round(histogram["max"], 6),
+                "p50": cls._quantile(histogram, 0.5),
+                "p95": cls._quantile(histogram, 0.95),
+                "p99": cls._quantile(histogram, 0.99),
+                "buckets": buckets,
+            }
+        return stages
+
+    # Prometheusのテキスト形式
+    @classmethod
+    def prometheus(cls) -> str:
+        lines = [
+            "# HELP anki_card_stage_seconds Time spent in each card pipeline stage",
+            "# TYPE anki_card_stage_seconds histogram",
+        ]
+        for stage, stats in cls.snapshot().items():
+            for bound, cumulative in stats["buckets"]:
+                lines.append(f'anki_card_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'anki_card_stage_seconds_sum{{stage="{stage}"}} {stats["sum"]}')
+            lines.append(f'anki_card_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        return "\n".join(lines) + "\n"
+
+# 1リクエスト分のステージ計測（Server-Timingヘッダーと構造化ログに出力）
+class RequestTrace:
+    def __init__(self, request_id: Optional[str] = None) -> None:
+        self.request_id = request_id or uuid.uuid4().hex
+        self.started_at = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+        self.fields: Dict[str, Any] = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        StageMetrics.observe(stage, seconds)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def count(self, name: str) -> None:
+        self.fields[name] = self.fields.get(name, 0) + 1
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def server_timing(self) -> str:
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.timings.items()]
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+    # 1リクエストにつき1行のJSONログ（Cloud Loggingで構造化ログとして扱われる）
+    def log(self, status: int, **fields) -> None:
+        total = self.elapsed()
+        StageMetrics.observe("total", total)
+        if not SETTINGS.request_log:
+            return
+        entry = {
+            "severity": "INFO" if status < 500 else "ERROR",
+            "message": "card request",
+            "request_id": self.request_id,
+            "status": status,
+            "total_ms": round(total * 1000, 1),
+            "timings_ms": {stage: round(seconds * 1000, 1) for stage, seconds in self.timings.items()},
+            **self.fields,
+            **fields,
+        }
+        print(json.dumps(entry, ensure_ascii=False), flush=True)
+
+# 処理中のリクエストの計測（コンテキスト変数で子タスクにも引き継がれる）
+_request_trace: ContextVar[Optional[RequestTrace]] = ContextVar("request_trace", default=None)
+
+@contextmanager
+def traced(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = _request_trace.get()
+        if trace is not None:
+            trace.add(stage, time.perf_counter() - start)
+        else:
+            StageMetrics.observe(stage, time.perf_counter() - start)
+
+def annotate(**fields) -> None:
+    trace = _request_trace.get()
+    if trace is not None:
+        trace.fields.update(fields)
+
+def count_outcome(name: str) -> None:
+    trace = _request_trace.get()
+    if trace is not None:
+        trace.count(name)
+
+# Gemini APIのエラーが指定する再試行までの待ち時間（RetryInfo または Retry-After）
+def _gemini_retry_delay(error) -> Optional[float]:
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        for detail in details.get("error", {}).get("details", []) or []:
+            retry_delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+            if isinstance(retry_delay, str) and retry_delay.endswith("s"):
+                try:
+                    return float(retry_delay[:-1])
+                except ValueError:
+                    pass
+    response = getattr(error, "response", None)
+    retry_after = getattr(response, "headers", {}).get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return None
+
+# 接続の失敗・読み取りのタイムアウト・切断など、HTTPのステータスを受け取る前の通信エラーか（google-genaiはhttpxで通信する）
+def _is_transport_error(error) -> bool:
+    if isinstance(error, ConnectionError):
+        return True
+    try:
+        import httpx
+    except ImportError:
+        return False
+    return isinstance(error, httpx.TransportError)
+
+# Gemini呼び出しのスケジューラ（RPM/TPMの流量制御・AIMDによる同時実行数の調整・リトライ）
+class GeminiScheduler:
+    _instance = None
+    retryable_codes = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, rpm: float, tpm: float, max_concurrency: int) -> None:
+        self._rpm = TokenBucket(rpm / 60, rpm) if rpm > 0 else None
+        self._tpm = TokenBucket(tpm / 60, tpm) if tpm > 0 else None
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.background_waiting = 0
+        self._condition = asyncio.Condition()
+        self._last_decrease = 0.0
+        self.stats = {"requests": 0, "attempts": 0, "retries": 0, "throttled": 0, "timeouts": 0, "transport_errors": 0, "failures": 0}
+
+    @classmethod
+    def get_instance(cls):
+        # イベントループのスレッドからのみ呼ばれるためロックは不要
+        if cls._instance is None:
+            cls._instance = cls(SETTINGS.gemini_rpm, SETTINGS.gemini_tpm, SETTINGS.stage_concurrency["gemini"])
+        return cls._instance
+
+    # 流量制御のトークンと実行枠を確保する（待っている間は待ち行列の長さに数える）
+    async def _admit(self, estimated_tokens: int) -> None:
+        background = _background_priority.get()
+        self.queue_depth += 1
+        self.background_waiting += background
+        try:
+            waits = [bucket.reserve(tokens) for bucket, tokens in [(self._rpm, 1), (self._tpm, estimated_tokens)] if bucket is not None]
+            if waits and max(waits) > 0:
+                await asyncio.sleep(max(waits))
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.in_flight < self._slots(background))
+                self.in_flight += 1
+        finally:
+            self.queue_depth -= 1
+            self.background_waiting -= background
+
+    # 実行枠の数（低優先度の処理は通常のリクエストが待っていない間だけ、上限の一部を使う）
+    def _slots(self, background: bool) -> int:
+        if not background:
+            return int(self.limit)
+        if self.queue_depth > self.background_waiting:
+            return 0
+        return max(1, int(self.limit * (1 - SETTINGS.prewarm_reserve)))
+
+    # 通常のリクエストの待ちがなく、実行枠と流量の上限に reserve の割合以上の余裕があるか（事前分析用）
+    def has_headroom(self) -> bool:
+        if self.in_flight >= self._slots(True):
+            return False
+        reserve = SETTINGS.prewarm_reserve
+        return all(bucket.available() >= bucket.capacity * reserve for bucket in (self._rpm, self._tpm) if bucket is not None)
+
+    # AIMD: 成功するたびに少しずつ増やし、429では半分に減らす
+    async def _release(self, outcome: str) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            if outcome == "ok":
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            elif outcome == "throttled":
+                # 同じ混雑で続けて半減しないよう、直前の減少から少し間を空ける
+                now = time.monotonic()
+                if now - self._last_decrease > 1.0:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._last_decrease = now
+            self._condition.notify_all()
+
+    # 見積もりと実際のトークン数の差をTPMのバケットで精算する
+    def _settle_tokens(self, estimated_tokens: int, usage_metadata) -> None:
+        if self._tpm is None or usage_metadata is None:
+            return
+        actual = usage_metadata.total_token_count or (usage_metadata.prompt_token_count or 0) + (usage_metadata.candidates_token_count or 0)
+        if actual > estimated_tokens:
+            self._tpm.reserve(actual - estimated_tokens)
+        else:
+            self._tpm.release(estimated_tokens - actual)
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        retry_delay = _gemini_retry_delay(error)
+        if retry_delay is not None:
+            return retry_delay + random.uniform(0, 1)
+        # ジッター付き指数バックオフ（上限の半分 + ランダムな残り半分）
+        ceiling = min(SETTINGS.gemini_retry_max, SETTINGS.gemini_retry_base * 2 ** (attempt - 1))
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    # attemptは (結果, usage_metadata) を返すコルーチン関数。リトライのたびに呼び直す
+    async def run(self, attempt_fn, estimated_tokens: int) -> Any:
+        self.stats["requests"] += 1
+        deadline = time.monotonic() + SETTINGS.gemini_deadline
+        attempt = 0
+        while True:
+            attempt += 1
+            with traced("gemini_queue"):
+                await self._admit(estimated_tokens)
+            self.stats["attempts"] += 1
+            outcome = "error"
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                result, usage_metadata = await asyncio.wait_for(attempt_fn(), timeout=min(SETTINGS.gemini_attempt_timeout, remaining))
+                outcome = "ok"
+                self._settle_tokens(estimated_tokens, usage_metadata)
+                return result
+            except Exception as e:
+                timed_out = isinstance(e, asyncio.TimeoutError)
+                transport_error = not timed_out and _is_transport_error(e)
+                code = 408 if timed_out else getattr(e, "code", None)
+                if code == 429:
+                    outcome = "throttled"
+                    self.stats["throttled"] += 1
+                if timed_out:
+                    self.stats["timeouts"] += 1
+                if transport_error:
+                    self.stats["transport_errors"] += 1
+                delay = self._backoff(attempt, e)
+                retryable = transport_error or code in self.retryable_codes
+                if not retryable or attempt >= SETTINGS.gemini_max_attempts or time.monotonic() + delay >= deadline:
+                    self.stats["failures"] += 1
+                    if code == 429:
+                        raise HTTPException(429, "Gemini API rate limit exceeded. Please retry later.") from e
+                    if timed_out:
+                        raise HTTPException(504, "Gemini API timed out") from e
+                    if transport_error:
+                        raise HTTPException(502, f"Gemini API connection failed: {type(e).__name__}") from e
+                    raise
+                self.stats["retries"] += 1
+                count_outcome("gemini_retries")
+                print(f"Gemini API error ({code or type(e).__name__}), retrying in {delay:.1f}s (attempt {attempt}/{SETTINGS.gemini_max_attempts})")
+            finally:
+                await self._release(outcome)
+            await asyncio.sleep(delay)
+
+    @classmethod
+    def snapshot(cls) -> Dict[str, Any]:
+        scheduler = cls._instance
+        if scheduler is None:
+            return {"queue_depth": 0, "in_flight": 0, "concurrency_limit": SETTINGS.stage_concurrency["gemini"]}
+        return {
+            "queue_depth": scheduler.queue_depth,
+            "in_flight": scheduler.in_flight,
+            "concurrency_limit": round(scheduler.limit, 2),
+            **scheduler.stats,
+        }
+
+    @classmethod
+    def prometheus(cls) -> str:
+        lines = []
+        for name, value in cls.snapshot().items():
+            metric_type = "gauge" if name in ("queue_depth", "in_flight", "concurrency_limit") else "counter"
+            suffix = "" if metric_type == "gauge" else "_total"
+            lines.append(f"# TYPE anki_gemini_{name}{suffix} {metric_type}")
+            lines.append(f"anki_gemini_{name}{suffix} {value}")
+        return "\n".join(lines) + "\n"
+
+# TPMの見積もり（日本語が多いため文字数の半分を入力トークンとみなし、出力は設定値）
+def estimate_request_tokens(prompt, profile) -> int:
+    return (len(profile.system_instruction) + len(prompt)) // 2 + SETTINGS.gemini_output_tokens_estimate
+
+# Gemini APIを呼び出す関数（同期版。共通のイベントループ上のスケジューラを経由する）
+def analysis_words_by_gemini(prompt):
+    return EventLoopThread.get_instance().run(analysis_words_by_gemini_async(prompt))
+
+# 遅いGemini呼び出しの複製（ヘッジ）。呼び出しが分位点から決めた待ち時間を超えたら同じ/別のモデルにも送り、先に返った有効な結果を使う
+# 複製の数はリクエスト数に対する割合（GEMINI_HEDGE_BUDGET）までに抑える。待ち時間の調整用にモデルごとの所要時間を記録する
+class GeminiHedger:
+    _instance = None
+    # 連続して複製できる上限（予算は1リクエストごとに GEMINI_HEDGE_BUDGET ずつ貯まる）
+    budget_burst = 10.0
+    # 分位点から待ち時間を決めるのに必要なサンプル数（それまでは GEMINI_HEDGE_DELAY）
+    min_samples = 20
+    window = 500
+
+    def __init__(self) -> None:
+        self._latencies: Dict[str, deque] = {}
+        self._models: Dict[str, Dict[str, int]] = {}
+        self._budget = 0.0
+        self.stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "budget_exhausted": 0, "skipped_queued": 0}
+
+    @classmethod
+    def get_instance(cls):
+        # イベントループのスレッドからのみ呼ばれるためロックは不要
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def _model_stats(self, model: str) -> Dict[str, int]:
+        if model not in self._models:
+            self._models[model] = {"calls": 0, "errors": 0, "wins": 0, "cancelled": 0}
+            self._latencies[model] = deque(maxlen=self.window)
+        return self._models[model]
+
+    def observe(self, model: str, seconds: float) -> None:
+        self._model_stats(model)
+        self._latencies[model].append(seconds)
+        StageMetrics.observe(f"gemini_model:{model}", seconds)
+
+    # 複製を送るまでの待ち時間（直近の所要時間の分位点）
+    def hedge_delay(self, model: str) -> float:
+        self._model_stats(model)
+        latencies = sorted(self._latencies[model])
+        if len(latencies) < self.min_samples:
+            return SETTINGS.gemini_hedge_delay
+        index = min(len(latencies) - 1, int(len(latencies) * SETTINGS.gemini_hedge_percentile))
+        return max(SETTINGS.gemini_hedge_min_delay, latencies[index])
+
+    # 1回のGemini呼び出し（スケジューラ経由。スキーマに合わない応答は失敗として扱う）
+    async def _call(self, client, model, prompt, profile, estimated_tokens):
+        stats = self._model_stats(model)
+        config = await SystemInstructionCache.get_config(client, model, profile)
+
+        async def generate():
+            start = time.perf_counter()
+            try:
+                response = await client.aio.models.generate_content(
+                    model=model,
+                    contents=prompt,
+                    config=config,
+                )
+            except asyncio.CancelledError:
+                # 取り消された呼び出し（ヘッジで負けた遅い方・タイムアウト）は、経過時間を所要時間の下限として記録する
+                # 記録しないと遅い呼び出しほど標本から抜け、分位点が低く偏ってヘッジが増え続ける
+                self.observe(model, time.perf_counter() - start)
+                raise
+            self.observe(model, time.perf_counter() - start)
+            return response
+
+        async def attempt():
+            nonlocal config
+            try:
+                response = await generate()
+            except Exception as e:
+                if not SystemInstructionCache.is_stale(config, e):
+                    raise
+                # サーバー側のキャッシュが消えていたら、キャッシュなしで1回だけ呼び直す
+                config = SystemInstructionCache.invalidate(model, profile, e)
+                response = await generate()
+            return response, response.usage_metadata
+
+        stats["calls"] += 1
+        try:
+            response = await GeminiScheduler.get_instance().run(attempt, estimated_tokens)
+            if response.parsed is None:
+                raise HTTPException(502, f"Gemini ({model}) returned a response that does not match the schema")
+        except asyncio.CancelledError:
+            stats["cancelled"] += 1
+            raise
+        except Exception:
+            stats["errors"] += 1
+            raise
+        TokenUsage.record(response.usage_metadata)
+        return response
+
+    async def run(self, client, model, prompt, profile, estimated_tokens):
+        if not SETTINGS.gemini_hedge:
+            return await self._call(client, model, prompt, profile, estimated_tokens)
+        
+        self.stats["requests"] += 1
+        self._budget = min(self.budget_burst, self._budget + SETTINGS.gemini_hedge_budget)
+        # 複製先のシステム指示キャッシュは、組み込みのプロファイルはウォームアップで、それ以外は複製を送るときに作る
+        hedge_model = SETTINGS.gemini_hedge_model or model
+        tasks = {asyncio.ensure_future(self._call(client, model, prompt, profile, estimated_tokens)): model}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay(model))
+            if not done:
+                # Geminiの実行枠を待っているリクエストがある間は、複製で混雑を悪化させない
+                if GeminiScheduler.get_instance().queue_depth > 0:
+                    self.stats["skipped_queued"] += 1
+                elif self._budget < 1:
+                    self.stats["budget_exhausted"] += 1
+                else:
+                    self._budget -= 1
+                    self.stats["hedged"] += 1
+                    tasks[asyncio.ensure_future(self._call(client, hedge_model, prompt, profile, estimated_tokens))] = hedge_model
+                    annotate(gemini_hedged=hedge_model)
+            
+            # 先に成功した方を使う（片方が失敗したらもう片方を待つ）
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    winner = tasks[task]
+                    self._models[winner]["wins"] += 1
+                    if len(tasks) > 1:
+                        annotate(gemini_winner=winner)
+                        if task is not next(iter(tasks)):
+                            self.stats["hedge_wins"] += 1
+                    return task.result()
+            raise error
+        finally:
+            # 負けた方（または呼び出し元のキャンセル時は両方）を取り消す
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    # 複製先のモデルのシステム指示キャッシュを起動時に作る（ヘッジの呼び出しにキャッシュ作成の往復を足さない）
+    async def warm_up(self) -> None:
+        if not SETTINGS.gemini_hedge:
+            return
+        client, model = GeminiClient.get_instance()
+        for name in ANALYSIS_PROFILES:
+            await SystemInstructionCache.get_config(client, SETTINGS.gemini_hedge_model or model, AnalysisProfile.get(name))
+
+    @classmethod
+    def snapshot(cls) -> Dict[str, Any]:
+        hedger = cls._instance
+        if hedger is None:
+            return {"enabled": SETTINGS.gemini_hedge, "models": {}}
+        models = {}
+        for model, stats in hedger._models.items():
+            latencies = sorted(hedger._latencies[model])
+            quantile = lambda q: round(latencies[min(len(latencies) - 1, int(len(latencies) * q))], 3) if latencies else None
+            models[model] = {**stats, "samples": len(latencies), "p50": quantile(0.5), "p95": quantile(0.95), "p99": quantile(0.99), "hedge_delay": round(hedger.hedge_delay(model), 3)}
+        return {"enabled": SETTINGS.gemini_hedge, **hedger.stats, "budget": round(hedger._budget, 2), "models": models}
+
+# Gemini APIで分析する（スケジューラ経由。GEMINI_HEDGE が有効なら遅い呼び出しを複製する）
+async def generate_analysis(prompt, profile, estimated_tokens):
+    gemini_client, gemini_model = GeminiClient.get_instance()
+    return await GeminiHedger.get_instance().run(gemini_client, gemini_model, prompt, profile, estimated_tokens)
+
+# Gemini APIを呼び出す関数（非同期クライアント）
+async def analysis_words_by_gemini_async(prompt, profile=None):
+    response = await generate_analysis(prompt, profile, estimate_request_tokens(prompt, profile or FULL_PROFILE))
+    response_parsed: WordAnalysis = response.parsed
+    response_dict_str = response_parsed.model_dump_json(indent=2)
+    return json.loads(response_dict_str)
+
+# 複数単語の分析結果を単語ごとの分析（単一単語と同じ形）に分ける
+def split_multi_word_analysis(response_dict, words, profile):
+    items = response_dict.get("words") or []
+    items_by_word = {str(item.get("word", "")).strip().lower(): item for item in items}
+    results = []
+    for index, word in enumerate(words):
+        item = items_by_word.get(word.lower())
+        # 原形に直されるなどして表記が変わった場合は指定順で対応づける
+        if item is None and len(items) == len(words):
+            item = items[index]
+        if item is None:
+            raise HTTPException(502, f"Gemini response is missing the analysis for '{word}'")
+        results.append({
+            name: response_dict.get(name) if name in profile.shared_fields else item.get(name)
+            for name in profile.fields
+        })
+    return results
+
+# 同じセリフ英文の複数の単語を1回のGemini呼び出しで分析する
+async def analysis_multi_words_by_gemini_async(prompt, words, profile):
+    # 出力は単語数に比例して増える
+    estimated_tokens = estimate_request_tokens(prompt, profile) + SETTINGS.gemini_output_tokens_estimate * (len(words) - 1)
+    response = await generate_analysis(prompt, profile, estimated_tokens)
+    response_dict = json.loads(response.parsed.model_dump_json())
+    return split_multi_word_analysis(response_dict, words, profile)
+
+# 生成途中のJSONオブジェクトから、値が確定したトップレベルのフィールドを順に取り出す
+class IncrementalJSONObjectParser:
+    _whitespace = " \t\n\r"
+
+    def __init__(self) -> None:
+        self._buffer = ""
+        self._pos = 0
+        self._started = False
+        self._decoder = json.JSONDecoder()
+
+    def _skip(self, pos: int, chars: str) -> int:
+        while pos < len(self._buffer) and self._buffer[pos] in chars:
+            pos += 1
+        return pos
+
+    def feed(self, text: str) -> List[Tuple[str, Any]]:
+        self._buffer += text
+        completed = []
+        while True:
+            field = self._next_field()
+            if field is None:
+                return completed
+            completed.append(field)
+
+    def _next_field(self) -> Optional[Tuple[str, Any]]:
+        buffer = self._buffer
+        pos = self._skip(self._pos, self._whitespace)
+        if not self._started:
+            if pos >= len(buffer):
+                return None
+            if buffer[pos] != "{":
+                raise ValueError("Response is not a JSON object")
+            self._started = True
+            pos += 1
+            self._pos = pos
+
+        pos = self._skip(pos, self._whitespace + ",")
+        if pos >= len(buffer) or buffer[pos] != '"':
+            return None
+        try:
+            key, pos = self._decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            return None
+
+        pos = self._skip(pos, self._whitespace)
+        if pos >= len(buffer):
+            return None
+        if buffer[pos] != ":":
+            raise ValueError("Malformed JSON object")
+        pos = self._skip(pos + 1, self._whitespace)
+        try:
+            value, end = self._decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            return None
+        # 数値などは続きが来る可能性がある（"0" の後に ".25" が届くなど）ので、区切り（, か }）が届くまで確定させない
+        if not isinstance(value, (str, list, dict)):
+            delimiter = self._skip(end, self._whitespace)
+            if delimiter >= len(buffer) or buffer[delimiter] not in ",}":
+                return None
+
+        self._pos = end
+        return key, value
+
+# Gemini APIをストリーミングで呼び出す関数（確定したフィールドから順にon_fieldへ通知）
+async def analysis_words_by_gemini_stream(prompt, on_field=None, profile=None):
+    profile = profile or FULL_PROFILE
+    gemini_client, gemini_model = GeminiClient.get_instance()
+    config = await SystemInstructionCache.get_config(gemini_client, gemini_model, profile)
+
+    # リトライ時は途中まで受け取ったチャンクを捨てて最初から読み直す
+    async def stream():
+        parser = IncrementalJSONObjectParser()
+        chunks = []
+        usage_metadata = None
+        async for chunk in await gemini_client.aio.models.generate_content_stream(
+            model=gemini_model,
+            contents=prompt,
+            config=config,
+        ):
+            # 使用量は最後のチャンクに累計値が入る
+            usage_metadata = chunk.usage_metadata or usage_metadata
+            text = chunk.text or ""
+            chunks.append(text)
+            if on_field is None or parser is None:
+                continue
+            try:
+                for key, value in parser.feed(text):
+                    on_field(key, value)
+            except ValueError as e:
+                # 途中経過が読めなくても、最終的な検証は組み立て後のJSONで行う
+                print(f"Incremental JSON parse error: {str(e)}")
+                parser = None
+        return (chunks, usage_metadata), usage_metadata
+
+    async def attempt():
+        nonlocal config
+        try:
+            return await stream()
+        except Exception as e:
+            if not SystemInstructionCache.is_stale(config, e):
+                raise
+            # サーバー側のキャッシュが消えていたら、キャッシュなしで1回だけ呼び直す（応答の前に失敗するためフィールドは通知されていない）
+            config = SystemInstructionCache.invalidate(gemini_model, profile, e)
+            return await stream()
+    
+    chunks, usage_metadata = await GeminiScheduler.get_instance().run(attempt, estimate_request_tokens(prompt, profile))
+    TokenUsage.record(usage_metadata)
+
+    # 最終的なバリデーションは組み立て後のオブジェクト全体に対して実行
+    response_parsed = profile.schema.model_validate_json("".join(chunks))
+    response_dict_str = response_parsed.model_dump_json(indent=2)
+    return json.loads(response_dict_str)
+
+# プロンプトのテンプレート部分のハッシュ（プロンプト変更時にキャッシュを自動で無効化する）
+def prompt_template_hash(profile=None) -> str:
+    template = (profile or FULL_PROFILE).system_instruction + create_prompt("{sentence}", "{word}", "{tag}")
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()[:16]
+
+def analysis_cache_key(sentence, word, tag, model, profile=None) -> str:
+    # 字幕由来のセリフと手動キャプチャで空白・改行の違いがあっても同じキーにする
+    sentence = " ".join(sentence.split())
+    key_source = json.dumps([sentence, word, tag, model, prompt_template_hash(profile)], ensure_ascii=False)
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+# Gemini分析結果の2層キャッシュ（メモリLRU + SQLite）
+class AnalysisCache:
+    _instance = None
+    _lock = threading.Lock()
+
+    # 何回書き込むごとにSQLiteの件数上限を確認するか
+    prune_interval = 100
+
+    def __init__(self, db_path: Optional[str], max_entries: int, max_rows: int) -> None:
+        self._memory = LRUCache(max_entries)
+        self._db_path = db_path
+        self._max_rows = max_rows
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "writes": 0, "pruned": 0}
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:  # 二重チェックロック
+                    cls._instance = cls(SETTINGS.analysis_cache_db or None, SETTINGS.analysis_cache_size, SETTINGS.analysis_cache_max_rows)
+        return cls._instance
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        if self._db_path is None:
+            return None
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self._db_path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self._db_path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS analysis (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at TEXT NOT NULL)")
+            self._conn.commit()
+            self._prune(self._conn)
+        return self._conn
+
+    # 件数上限を超えた分を古く書き込んだものから消す（/tmp はメモリ上のため、上限がないとインスタンスのメモリを使い切る）
+    def _prune(self, conn: sqlite3.Connection) -> None:
+        cursor = conn.execute(
+            "DELETE FROM analysis WHERE rowid <= (SELECT rowid FROM analysis ORDER BY rowid DESC LIMIT 1 OFFSET ?)",
+            (self._max_rows,),
+        )
+        conn.commit()
+        if cursor.rowcount > 0:
+            with self._stats_lock:
+                self.stats["pruned"] += cursor.rowcount
+
+    def record(self, name: str) -> None:
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._memory.get(key)
+        if value is not None:
+            self.record("memory_hits")
+            return json.loads(value)
+
+        try:
+            with self._db_lock:
+                conn = self._connection()
+                row = conn.execute("SELECT value FROM analysis WHERE key = ?", (key,)).fetchone() if conn else None
+        except sqlite3.Error as e:
+            print(f"Analysis cache read error: {str(e)}")
+            row = None
+
+        if row is None:
+            self.record("misses")
+            return None
+
+        self.record("disk_hits")
+        self._memory.set(key, row[0])
+        return json.loads(row[0])
+
+    def set(self, key: str, response_dict: Dict[str, Any]) -> None:
+        value = json.dumps(response_dict, ensure_ascii=False)
+        self._memory.set(key, value)
+        try:
+            with self._db_lock:
+                conn = self._connection()
+                if conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO analysis (key, value, created_at) VALUES (?, ?, ?)",
+                        (key, value, datetime.now().isoformat()),
+                    )
+                    conn.commit()
+                    if (self.stats["writes"] + 1) % self.prune_interval == 0:
+                        self._prune(conn)
+        except sqlite3.Error as e:
+            print(f"Analysis cache write error: {str(e)}")
+        self.record("writes")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["hits"] = stats["memory_hits"] + stats["disk_hits"]
+        stats["memory_entries"] = len(self._memory)
+        return stats
+
+# 単語の頻度順位・発音記号・見出し語のローカル辞書（ソート済みのバイナリ索引をmmapで読み、インスタンスごとに1回だけ開く）
+# 索引の形式: ヘッダ（マジック + 件数）、各レコードの位置（uint32）、「単語\x1f見出し語\x1f順位\x1f発音記号\n」のレコード（単語のバイト順）
+class Lexicon:
+    _instance = None
+    _loaded = False
+    _lock = threading.Lock()
+    magic = b"ANKILEX1"
+    _header = struct.Struct("<8sI")
+    _offset = struct.Struct("<I")
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = self._header.unpack_from(self._map, 0)
+        if magic != self.magic:
+            raise ValueError(f"Not a lexicon index: {path}")
+
+    @classmethod
+    def get_instance(cls) -> Optional["Lexicon"]:
+        if not cls._loaded:
+            with cls._lock:
+                if not cls._loaded:  # 二重チェックロック
+                    if SETTINGS.lexicon_path:
+                        try:
+                            cls._instance = cls(SETTINGS.lexicon_path)
+                        except (OSError, ValueError, struct.error) as e:
+                            # 辞書がなくても全フィールドをGeminiで生成して動き続ける
+                            print(f"Lexicon unavailable, falling back to Gemini: {str(e)}")
+                    cls._loaded = True
+        return cls._instance
+
+    def _record(self, index: int) -> List[bytes]:
+        start = self._offset.unpack_from(self._map, self._header.size + index * self._offset.size)[0]
+        end = self._map.find(b"\n", start)
+        return self._map[start:end].split(b"\x1f")
+
+    def _find(self, key: bytes) -> Optional[List[bytes]]:
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            record = self._record(mid)
+            if record[0] < key:
+                low = mid + 1
+            elif record[0] > key:
+                high = mid
+            else:
+                return record
+        return None
+
+    def lookup(self, word: str) -> Optional[Dict[str, Any]]:
+        key = word.strip().lower()
+        record = self._find(key.encode("utf-8"))
+        if record is None:
+            return None
+        _, lemma, rank, ipa = [value.decode("utf-8") for value in record]
+        rank = int(rank) if rank else None
+        # 活用形は見出し語の順位も見る（頻度は語族の単位で判定する）
+        if lemma and lemma != key:
+            lemma_record = self._find(lemma.encode("utf-8"))
+            if lemma_record is not None and lemma_record[2]:
+                lemma_rank = int(lemma_record[2])
+                rank = lemma_rank if rank is None else min(rank, lemma_rank)
+        return {"lemma": lemma or key, "rank": rank, "ipa": ipa}
+
+    # (単語, 順位, 発音記号, 見出し語) の並びから索引ファイルを作る
+    @classmethod
+    def build(cls, rows, path: str) -> int:
+        entries: Dict[bytes, Tuple[str, str, str]] = {}
+        for word, rank, ipa, lemma in rows:
+            key = word.strip().lower()
+            values = (lemma.strip().lower(), str(rank).strip(), ipa.strip())
+            if not key or any(char in "\x1f\n" for char in key + "".join(values)):
+                continue
+            # 同じ単語が複数ある場合は順位の高い（数字の小さい）方を残す
+            previous = entries.get(key.encode("utf-8"))
+            if previous is None or (values[1] and (not previous[1] or int(values[1]) < int(previous[1]))):
+                entries[key.encode("utf-8")] = values
+        
+        records = [b"\x1f".join([key, *(value.encode("utf-8") for value in values)]) + b"\n" for key, values in sorted(entries.items())]
+        position = cls._header.size + cls._offset.size * len(records)
+        offsets = []
+        for record in records:
+            offsets.append(position)
+            position += len(record)
+        
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cls._header.pack(cls.magic, len(records)))
+            f.write(b"".join(cls._offset.pack(offset) for offset in offsets))
+            f.writelines(records)
+        os.replace(tmp_path, path)
+        return len(records)
+
+# 頻度順位から5段階のレーティングへ（LEXICON_RATING_RANKS の各順位以内で 5, 4, 3, 2、それ以外は 1）
+def frequency_rating_from_rank(rank: int) -> int:
+    return max(1, 5 - bisect_left(SETTINGS.lexicon_rating_ranks, rank))
+
+# 辞書から決まるフィールド（プロファイルで生成するものだけ）。辞書にない単語は空
+def lexicon_fields(word, profile) -> Dict[str, Any]:
+    lexicon = Lexicon.get_instance()
+    entry = lexicon.lookup(word) if lexicon is not None else None
+    if entry is None:
+        return {}
+    values = {}
+    if entry["rank"] is not None:
+        values["frequency_rating"] = frequency_rating_from_rank(entry["rank"])
+    if entry["ipa"]:
+        values["ipa"] = entry["ipa"]
+    return {name: value for name, value in values.items() if name in profile.fields}
+
+def merge_lexicon(response_dict, lexicon_values, profile) -> Dict[str, Any]:
+    if not lexicon_values:
+        return response_dict
+    return {name: lexicon_values[name] if name in lexicon_values else response_dict.get(name) for name in profile.fields}
+
+async def _run_analysis(prompt, on_field, profile):
+    if on_field is not None:
+        return await analysis_words_by_gemini_stream(prompt, on_field, profile)
+    return await analysis_words_by_gemini_async(prompt, profile)
+
+# キャッシュを考慮した単語分析（on_fieldを渡すとストリーミングで分析）
+async def analyze_word(sentence, word, tag, use_cache=True, on_field=None, profile=None):
+    profile = profile or FULL_PROFILE
+    # 辞書にある単語は頻度・発音記号を辞書から決め、Geminiには生成させない
+    lexicon_values = lexicon_fields(word, profile)
+    gemini_profile = profile.without(lexicon_values)
+    response_dict = await _analyze_word_cached(sentence, word, tag, use_cache, on_field, gemini_profile) if gemini_profile.fields else {}
+    annotate(profile=profile.key, lexicon=sorted(lexicon_values))
+    return merge_lexicon(response_dict, lexicon_values, profile)
+
+async def _analyze_word_cached(sentence, word, tag, use_cache, on_field, profile):
+    loop = asyncio.get_running_loop()
+    cache = AnalysisCache.get_instance()
+    _, gemini_model = GeminiClient.get_instance()
+    annotate(model=gemini_model)
+    
+    async def run():
+        with traced("prompt"):
+            prompt = create_prompt(sentence, word, tag)
+        with traced("gemini"):
+            return await _run_analysis(prompt, on_field, profile)
+    
+    if not use_cache:
+        cache.record("bypassed")
+        annotate(analysis_cache="bypassed")
+        return await run()
+
+    # ヘッジで複製先のモデルが答えた結果も、同じリクエストの結果として GEMINI_MODEL のキーで保存する
+    key = analysis_cache_key(sentence, word, tag, gemini_model, profile)
+    with traced("cache_read"):
+        response_dict = await loop.run_in_executor(None, cache.get, key)
+    if response_dict is not None:
+        annotate(analysis_cache="hit")
+        return response_dict
+
+    async def run_and_store():
+        response_dict = await run()
+        with traced("cache_write"):
+            await loop.run_in_executor(None, cache.set, key, response_dict)
+        return response_dict
+    
+    # 事前分析と通常のリクエストで同じ分析が重なったら、実行中の方の結果を共有する（Geminiを二重に呼ばない）
+    annotate(analysis_cache="coalesced" if _analysis_flight.in_flight(key) else "miss")
+    return await _analysis_flight.do(key, run_and_store)
+
+# 同じセリフ英文の複数の単語を分析（キャッシュにない単語だけを1回の呼び出しでまとめて分析）
+async def analyze_words(sentence, words, tag, use_cache=True, profile=None):
+    loop = asyncio.get_running_loop()
+    cache = AnalysisCache.get_instance()
+    _, gemini_model = GeminiClient.get_instance()
+    profile = profile or FULL_PROFILE
+    annotate(model=gemini_model, profile=profile.key, words=len(words))
+    
+    # 分析結果は単語ごとに、単一単語のリクエストと同じキーでキャッシュする（辞書で埋まるフィールドは除く）
+    lexicon_values = {word: lexicon_fields(word, profile) for word in words}
+    keys = {word: analysis_cache_key(sentence, word, tag, gemini_model, profile.without(lexicon_values[word])) for word in words}
+    results = {}
+    if use_cache:
+        with traced("cache_read"):
+            for word in words:
+                response_dict = await loop.run_in_executor(None, cache.get, keys[word])
+                if response_dict is not None:
+                    results[word] = response_dict
+        # 単一単語のリクエストや事前分析で実行中の単語は、その結果を待って使う
+        for word in words:
+            if word not in results and _analysis_flight.in_flight(keys[word]):
+                response_dict = await _analysis_flight.join(keys[word])
+                if response_dict is not None:
+                    results[word] = response_dict
+    else:
+        cache.record("bypassed")
+    
+    missing = [word for word in words if word not in results]
+    if not use_cache:
+        annotate(analysis_cache="bypassed")
+    elif not missing:
+        annotate(analysis_cache="hit")
+    else:
+        annotate(analysis_cache="miss" if len(missing) == len(words) else "partial")
+    
+    if missing:
+        # 辞書で埋まるフィールドは、まとめて分析する全単語で共通する分だけ省く
+        call_profile = profile.without(set.intersection(*(set(lexicon_values[word]) for word in missing)))
+        with traced("prompt"):
+            if len(missing) == 1:
+                prompt = create_prompt(sentence, missing[0], tag)
+            else:
+                prompt = create_multi_word_prompt(sentence, missing, tag)
+        with traced("gemini"):
+            if not call_profile.fields:
+                analyzed = [{} for _ in missing]
+            elif len(missing) == 1:
+                analyzed = [await analysis_words_by_gemini_async(prompt, call_profile)]
+            else:
+                analyzed = await analysis_multi_words_by_gemini_async(prompt, missing, call_profile.for_words())
+        results.update(zip(missing, analyzed))
+        if use_cache:
+            with traced("cache_write"):
+                for word, response_dict in zip(missing, analyzed):
+                    await loop.run_in_executor(None, cache.set, keys[word], response_dict)
+    
+    annotate(lexicon=sum(1 for word in words if lexicon_values[word]))
+    return [merge_lexicon(results[word], lexicon_values[word], profile) for word in words]
+
+# 1組の分析と音声を作ってキャッシュに載せる（後のカード生成はキャッシュから即座に返る）
+async def prewarm_card(sentence, word, tag, profile=None):
+    response_dict = await analyze_word(sentence, word, tag, True, None, profile)
+    await synthesize_speech(sentence)
+    example_sentence = response_dict.get("example_sentence", "")
+    if example_sentence:
+        await synthesize_speech(extract_example_english(example_sentence))
+
+# 字幕から選んだ (セリフ, 単語) の事前分析キュー（Geminiに余裕があるときだけ低優先度で実行）
+class PrewarmQueue:
     _instance = None
-    _model = None
     _lock = threading.Lock()
-    
+
+    def __init__(self, max_size: int, concurrency: int, known_words) -> None:
+        self._max_size = max_size
+        self._concurrency = concurrency
+        self.known_words = known_words
+        self._jobs = deque()
+        self._keys = set()
+        self._jobs_lock = threading.Lock()
+        self._workers = 0
+        self.stats = {"queued": 0, "completed": 0, "failed": 0, "dropped": 0}
+
     @classmethod
     def get_instance(cls):
         if cls._instance is None:
             with cls._lock:
                 if cls._instance is None:  # 二重チェックロック
-                    gemini_api_key = os.environ.get("GEMINI_API_KEY", "your-gemini-api-key-here")
-                    cls._instance = genai.Client(api_key=gemini_api_key)
-                    cls._model = os.environ.get("GEMINI_MODEL", "gemini-2.0-flash")
-        return cls._instance, cls._model
+                    from subtitles import load_known_words
+                    cls._instance = cls(SETTINGS.prewarm_queue_size, SETTINGS.prewarm_concurrency, load_known_words(SETTINGS.known_words_file))
+        return cls._instance
 
-def generate_unique_file_name(word):
-    return f"{word}-{uuid.uuid4().hex[:6]}"
+    def add(self, jobs) -> Dict[str, int]:
+        queued = dropped = 0
+        with self._jobs_lock:
+            for sentence, word, tag, profile in jobs:
+                key = (sentence, word.lower(), tag, profile.key)
+                if key in self._keys:
+                    continue
+                if len(self._jobs) >= self._max_size:
+                    dropped += 1
+                    continue
+                self._jobs.append((sentence, word, tag, profile))
+                self._keys.add(key)
+                queued += 1
+            self.stats["queued"] += queued
+            self.stats["dropped"] += dropped
+            start = max(0, min(self._concurrency - self._workers, len(self._jobs)))
+            self._workers += start
+        for _ in range(start):
+            EventLoopThread.get_instance().submit(self._work())
+        return {"queued": queued, "dropped": dropped}
 
-# gTTSを使用した音声生成（インメモリ処理）
-def generate_audio_clip(sentence, unique_file_name):
-    audio_embed = f"![[{unique_file_name}.mp3]]"
-    
-    # インメモリでMP3を生成
-    mp3_fp = BytesIO()
-    tts = gTTS(sentence, lang='en')
-    tts.write_to_fp(mp3_fp)
-    mp3_fp.seek(0)
-    
-    # Base64エンコード
-    audio_base64 = base64.b64encode(mp3_fp.read()).decode('utf-8')
-    
-    return audio_base64, audio_embed
+    def _pop(self):
+        with self._jobs_lock:
+            if not self._jobs:
+                self._workers -= 1
+                return None
+            sentence, word, tag, profile = job = self._jobs.popleft()
+            self._keys.discard((sentence, word.lower(), tag, profile.key))
+            return job
 
-def create_prompt(sentence, word, tag):
-    prompt = f"""
-        <role>
-        あなたは英語と日本語のバイリンガルで、英語学習者にとって最高の説明者です。
-        あなたの重要な役割は、指定された言語（日本語または英語）で各項目を回答することです。
-        各フィールドの言語指定を絶対に守ってください。
-        </role>
-
-        <task>
-        {f'『{tag}』を視聴していた時に登場した、' if tag != "Other" else ''}セリフ英文「{sentence}」中の単語「{word}」について詳細に分析し、次のJSON形式で回答してください。
-        </task>
-
-        <audience>
-        20〜30代歳男性の日本人。高校英語レベルは80%くらいの理解度だが英語での会話はかなり辿々しい。
-        イマージョンラーニング（3年目）で英語学習中。日本のアニメや海外ドラマを英語音声・字幕で視聴しながら学習中。
-        プログラミング、ビジネス、テクノロジー関連の用語には比較的馴染みがある。
-        </audience>
-
-        <importance>
-        教育的価値の高い説明を提供し、特に「{word}」の意味、使い方、ニュアンスを明確に伝えてください。
-        説明は簡潔に、中学・高校レベルの理解しやすい言葉を使用してください。
-        対象者のプログラミングやマーケティングの知識を活かした例や説明があれば、それも取り入れてください。
-        </importance>
-
-        <field_language_rules>
-        各フィールドには厳格な言語指定があります：
-        - [日本語必須]: このフィールドは必ず日本語のみで記入してください。英語は一切使用禁止です。
-        - [ENGLISH ONLY]: このフィールドは必ず英語のみで記入してください。日本語は一切使用禁止です。
-        - [英語+日本語]: このフィールドは指定された形式（「英語文（日本語訳）」など）に厳密に従ってください。
-
-        言語指定違反は回答全体の品質を著しく低下させるため、最優先事項として扱ってください。
-        </field_language_rules>
-
-        <field_guidelines>
-        - contextual_translation: [日本語必須] この場面での文章の意訳（日本語の感覚でどのような意味か、ニュアンスを大切に）
-        - precise_translation: [日本語必須] 単語「{word}」の意味を正確に捉えた、文章の正確な日本語訳
-        - frequency_rating: [数字] 1(ほとんど使われない)〜5(非常によく使われる)の整数で表す。単語「{word}」の日常会話、海外ドラマ、アニメでの使用頻度、英会話学習における単語の重要度を点数化。
-        - ipa: [IPA] 単語「{word}」のアメリカ英語発音記号
-        - part_of_speech: [ENGLISH ONLY] 文章中での品詞（noun, verb, adjective, adverb, etc.）
-        - english_definition: [ENGLISH ONLY] 30語以内の中学・高校英語レベルでの簡潔な英英定義
-        - japanese_meaning: [日本語必須] この特定の文脈における単語の最も適切な日本語訳と簡潔な説明
-        - example_sentence: [英語+日本語] 「{word}」を使った簡単な例文。「英語文（日本語訳）」形式厳守
-        - core_meaning: [日本語必須] 単語の核となる意味や語源的説明、別の文脈での意味も含む
-        - antonyms: [ENGLISH ONLY] 中学・高校英語レベルでの対義語リスト（重要度順）。（できるだけ中学レベルの単語で）
-        - synonyms: [ENGLISH ONLY] 中学・高校英語レベルでの類義語リスト（最も近い意味順）。（できるだけ中学レベルの単語で）
-        - slang: [英語+日本語] 文中に含まれるスラング表現の説明。「英語（日本語説明）」形式
-        - idioms: [英語+日本語] 文中に含まれる文中に含まれる熟語・連語・群動詞・慣用句の説明。熟語の判定は緩くて問題ないです。特別な単語の組み合わせパターンがあれば解説してください。「英語（日本語説明）」形式
-        - japanese_usage: [日本語必須] 日本でのカタカナ英語や商品名としての馴染み
-        - memory_aids: [日本語必須] 単語を効果的に覚えるためのコツや関連付け方法
-        - terminology: [日本語必須] IT、プログラミング、マーケティングでの専門用語としての使われ方
-        - explanation: [日本語必須] 英単語・英文の最終説明と総括
-        </field_guidelines>
-
-        <empty_string_and_empty_array_rules>
-        該当する情報がない場合は、以下のルールを厳守してください：
-        - Optional[str]型フィールド: 空文字列""を使用
-        - List[str]型フィールド: 空配列[]を使用
-        これは出力JSONの処理のために非常に重要です。
-        </empty_string_and_empty_array_rules>
-
-        <language_validation>
-        回答を提出する前に、以下を確認してください：
-        1. [日本語必須] フィールドに英単語や英文が含まれていないか
-        2. [ENGLISH ONLY] フィールドに日本語が含まれていないか
-        3. [英語+日本語] フィールドが指定形式に従っているか
-        4. 空値ルールが正しく適用されているか
-
-        全ての言語指定を守ることで、英語学習者にとって最高の学習リソースを提供できます。
-        </language_validation>
-
-        <output_constraints>
-        - すべてのフィールドは指定された要件を満たし、形式を厳守します。
-        - 特に言語指定に関しては、絶対に違反しないでください：
-        - [日本語必須] のフィールドには日本語のみを使用し、英語は一切含めないでください。
-        - [ENGLISH ONLY] のフィールドには英語のみを使用し、日本語は一切含めないでください。
-        - [英語+日本語] のフィールドは指定された形式（「英語文（日本語訳）」など）に厳密に従ってください。
-        - 理解を助けるようなわかりやすい情報がない場合は、無理に項目を埋めようとせず、下記のルールに従って、回答なしの意思を示してください：
-        - 文字列型のオプショナルフィールドは必ず空文字列""を使用
-        - 配列型のフィールドで項目がない場合は必ず空配列[]を使用
-        - 言語指定違反は回答全体の品質を著しく低下させるため、特に注意してください。
-        </output_constraints>
-        """
-    return textwrap.dedent(prompt)
+    def _record(self, name: str) -> None:
+        with self._jobs_lock:
+            self.stats[name] += 1
 
-# Gemini APIを呼び出す関数
-def analysis_words_by_gemini(prompt):
-    gemini_client, gemini_model = GeminiClient.get_instance()
-    
-    response = gemini_client.models.generate_content(
-        model=gemini_model,
-        contents=prompt,
-        config={
-            'response_mime_type': 'application/json',
-            'response_schema': WordAnalysis,
-        },
-    )
+    async def _work(self) -> None:
+        _background_priority.set(True)
+        scheduler = GeminiScheduler.get_instance()
+        while True:
+            # 通常のリクエストを優先し、Geminiの実行枠と流量に余裕ができるまで待つ
+            while not scheduler.has_headroom():
+                await asyncio.sleep(0.5)
+            job = self._pop()
+            if job is None:
+                return
+            try:
+                with traced("prewarm"):
+                    await prewarm_card(*job)
+                self._record("completed")
+            except Exception as e:
+                self._record("failed")
+                print(f"Prewarm error for '{job[1]}': {str(e)}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._jobs_lock:
+            return {"pending": len(self._jobs), "workers": self._workers, "known_words": len(self.known_words), **self.stats}
+
+# ローカル辞書で頻度順位が PREWARM_SKIP_RANK 以内の単語（辞書がない場合は判定しない）
+def is_frequent_word(word) -> bool:
+    lexicon = Lexicon.get_instance()
+    entry = lexicon.lookup(word) if lexicon is not None else None
+    return entry is not None and entry["rank"] is not None and entry["rank"] <= SETTINGS.prewarm_skip_rank
+
+# 字幕ファイル（.srt / .vtt）から既知語以外の単語を選び、事前分析のキューに積む
+def prewarm_subtitles(text, tag, profile=None, known_words=None):
+    from subtitles import COMMON_WORDS, candidate_words, parse_subtitles
     
-    response_parsed: WordAnalysis = response.parsed
-    response_dict_str = response_parsed.model_dump_json(indent=2)
-    return json.loads(response_dict_str)
+    queue = PrewarmQueue.get_instance()
+    # 既知語リストがなくても、よく使う単語はGeminiに送らない（RPM/TPMを使い切らないように）
+    known = COMMON_WORDS | queue.known_words | {word.lower() for word in known_words or [] if isinstance(word, str)}
+    profile = profile or FULL_PROFILE
+    sentences = parse_subtitles(text)
+    jobs = [
+        (sentence, word, tag, profile)
+        for sentence in sentences
+        for word in candidate_words(sentence, known, SETTINGS.prewarm_min_word_length)
+        if not is_frequent_word(word)
+    ]
+    return {"sentences": len(sentences), "candidates": len(jobs), **queue.add(jobs)}
+
+# 「英語文（日本語訳）」形式の例文から英語部分を抽出
+def extract_example_english(example_sentence):
+    if "（" in example_sentence and "）" in example_sentence:
+        return example_sentence.split("（", 1)[0]
+    return example_sentence
 
 # データのフォーマット
 def create_formatted_data(sentence, word, unique_file_name, response_dict, ex_audio_base64, ex_audio_embed):
@@ -190,9 +2092,9 @@ def create_formatted_data(sentence, word, unique_file_name, response_dict, ex_au
     image_embed = f"![[{unique_file_name}.jpeg]]"
     highlighted_sentence = sentence.replace(word, f"=={word}==")
     
-    # レーティングを星に
-    rating_num = response_dict["frequency_rating"]
-    rating_star = "★" * rating_num
+    # レーティングを星に（プロファイルで生成しなかった場合は空）
+    rating_num = response_dict.get("frequency_rating")
+    rating_star = "★" * rating_num if isinstance(rating_num, int) else ""
 
     # ターゲットデッキ決定
     if rating_num in [5, "5"]:
@@ -205,7 +2107,7 @@ def create_formatted_data(sentence, word, unique_file_name, response_dict, ex_au
         target_deck = "Immersion"
     
     # 例文内の単語をBold 全体をItalic
-    example_sentence = response_dict["example_sentence"]
+    example_sentence = response_dict.get("example_sentence", "")
     
     if "（" in example_sentence and "）" in example_sentence:
         ex_sentence_english, ex_sentence_japanese = example_sentence.split("（", 1)
@@ -219,8 +2121,8 @@ def create_formatted_data(sentence, word, unique_file_name, response_dict, ex_au
     formatted_ex_english_audio = f"*{ex_sentence_english.replace(word, f'**{word}**')}* {ex_audio_embed}"
     
     # 類義語、対義語
-    synonyms_str = ", ".join(response_dict["synonyms"]) if response_dict["synonyms"] else ""
-    antonyms_str = ", ".join(response_dict["antonyms"]) if response_dict["antonyms"] else ""
+    synonyms_str = ", ".join(response_dict.get("synonyms") or [])
+    antonyms_str = ", ".join(response_dict.get("antonyms") or [])
     
     # 結果辞書
     result = {
@@ -241,6 +2143,8 @@ def create_formatted_data(sentence, word, unique_file_name, response_dict, ex_au
         "ex_audio_embed": ex_audio_embed,
         "synonyms_str": synonyms_str,
         "antonyms_str": antonyms_str,
+        # カードの Japanese 欄（正確な訳を生成しないプロファイルでは文脈に沿った訳で埋める）
+        "japanese_translation": response_dict.get("precise_translation") or response_dict.get("contextual_translation") or "",
     }
     
     # response_dictの内容をマージ
@@ -253,57 +2157,41 @@ def create_anki_template(json_data, word, tag, audio_embed):
         TARGET DECK: {json_data.get("target_deck", "Immersion")}
         START
         Immersion
-        Image: {json_data.get("image_embed", None)}
-        Sentence: {json_data.get("highlighted_sentence", None)}
-        NaturalJapanese: {json_data.get("contextual_translation", None)}
-        Japanese: {json_data.get("precise_translation", None)}
+        Image: {json_data.get("image_embed", "")}
+        Sentence: {json_data.get("highlighted_sentence", "")}
+        NaturalJapanese: {json_data.get("contextual_translation", "")}
+        Japanese: {json_data.get("japanese_translation", "")}
         Word: {word}
-        IPA: {json_data.get("ipa", None)}
-        PartOfSpeech: {json_data.get("part_of_speech", None)}
-        Definition: {json_data.get("english_definition", None)}
-        Synonyms: {json_data.get("synonyms_str", None)}
-        Antonyms: {json_data.get("antonyms_str", None)}
-        JapaneseMeaning: {json_data.get("japanese_meaning", None)}
-        ExampleSentence: {json_data.get("ex_sentence_english", None)}
-        ExSentenceJapanese: {json_data.get("ex_sentence_japanese", None)}
-        Core: {json_data.get("core_meaning", None)}
-        MemoryAids: {json_data.get("memory_aids", None)}
-        JapaneseUsage: {json_data.get("japanese_usage", None)}
-        Terminology: {json_data.get("terminology", None)}
-        Idioms: {json_data.get("idioms", None)}
-        Slang: {json_data.get("slang", None)}
-        Rating: {json_data.get("rating_star", None)}
-        Explanation: {json_data.get("explanation", None)}
+        IPA: {json_data.get("ipa", "")}
+        PartOfSpeech: {json_data.get("part_of_speech", "")}
+        Definition: {json_data.get("english_definition", "")}
+        Synonyms: {json_data.get("synonyms_str", "")}
+        Antonyms: {json_data.get("antonyms_str", "")}
+        JapaneseMeaning: {json_data.get("japanese_meaning", "")}
+        ExampleSentence: {json_data.get("ex_sentence_english", "")}
+        ExSentenceJapanese: {json_data.get("ex_sentence_japanese", "")}
+        Core: {json_data.get("core_meaning", "")}
+        MemoryAids: {json_data.get("memory_aids", "")}
+        JapaneseUsage: {json_data.get("japanese_usage", "")}
+        Terminology: {json_data.get("terminology", "")}
+        Idioms: {json_data.get("idioms", "")}
+        Slang: {json_data.get("slang", "")}
+        Rating: {json_data.get("rating_star", "")}
+        Explanation: {json_data.get("explanation", "")}
         Voice: {audio_embed}
-        ObsidianLink: {json_data.get("obsidian_uri", None)}
-        PlayPhraseMe: {json_data.get("playphrase_me_url", None)}
+        ObsidianLink: {json_data.get("obsidian_uri", "")}
+        PlayPhraseMe: {json_data.get("playphrase_me_url", "")}
         Tags: {tag}
         END
         """
     
     return textwrap.dedent(anki_template)
 
-# Notionへの保存（非同期処理）
-def save_to_notion(json_data, sentence, word, tag):
-    NOTION_TOKEN = os.environ.get("NOTION_TOKEN")
-    NOTION_DB_ID = os.environ.get("NOTION_DB_ID")
-
-    # 環境変数の必須チェック
-    if not NOTION_TOKEN or not NOTION_DB_ID:
-        print("Warning: NOTION_TOKEN or NOTION_DB_ID not set. Skipping Notion save.")
-        return None
-    
-    url = "https://api.notion.com/v1/pages/"
-    headers = {
-        'Content-Type': 'application/json',
-        'Notion-Version': '2022-02-22',
-        'Authorization': f'Bearer {NOTION_TOKEN}',
-    }
-    
-    # ペイロードの構築
+# Notionページ作成用ペイロードの構築
+def build_notion_payload(json_data, sentence, word, tag, database_id):
     payload = {
         "parent": {
-            "database_id": NOTION_DB_ID
+            "database_id": database_id
         },
         "properties": {
             "Sentence": {
@@ -477,92 +2365,1196 @@ def save_to_notion(json_data, sentence, word, tag):
         }
     }
     
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        if response.status_code != 200:
+    # プロファイルで生成しなかった項目は空のselectにする（空文字の選択肢は作れないため）
+    for prop in payload["properties"].values():
+        if "select" in prop and not prop["select"]["name"]:
+            prop["select"] = None
+    
+    return payload
+
+# Notionへの保存（送信待ちキューに積み、専用ワーカーが後から送信する）
+def save_to_notion(json_data, sentence, word, tag):
+    NOTION_TOKEN = SETTINGS.notion_token
+    NOTION_DB_ID = SETTINGS.notion_db_id
+
+    # 環境変数の必須チェック
+    if not NOTION_TOKEN or not NOTION_DB_ID:
+        print("Warning: NOTION_TOKEN or NOTION_DB_ID not set. Skipping Notion save.")
+        return None
+    
+    payload = build_notion_payload(json_data, sentence, word, tag, NOTION_DB_ID)
+    return NotionOutbox.get_instance().enqueue(json_data.get('job_id', ''), payload)
+
+# トークンバケットによる流量制御（スレッドセーフ）
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    # トークンを予約し、使えるようになるまでの待ち時間（秒）を返す
+    def reserve(self, tokens: float = 1) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self, tokens: float = 1) -> None:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    # 予約しすぎた分を返す
+    def release(self, tokens: float) -> None:
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + tokens)
+
+    # 現在使えるトークン数（予約はしない）
+    def available(self) -> float:
+        with self._lock:
+            return min(self.capacity, self._tokens + (time.monotonic() - self._updated_at) * self.rate)
+
+# Notionへの書き込みキュー（SQLiteに永続化し、単一ワーカーが順に送信）
+class NotionOutbox:
+    _instance = None
+    _lock = threading.Lock()
+    url = "https://api.notion.com/v1/pages/"
+    # 送信中（sending）として確保しておく秒数。送信中に落ちたエントリはこれを過ぎると再び送信対象になる（送信のタイムアウトは30秒）
+    claim_lease = 120.0
+
+    def __init__(self, db_path: str, rate_per_sec: float, max_attempts: int) -> None:
+        self._db_path = db_path
+        self._max_attempts = max_attempts
+        self._bucket = TokenBucket(rate_per_sec, max(1.0, rate_per_sec))
+        self._db_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._session: Optional["requests.Session"] = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:  # 二重チェックロック
+                    cls._instance = cls(SETTINGS.notion_outbox_db, SETTINGS.notion_rate_per_sec, SETTINGS.notion_max_attempts)
+                    atexit.register(cls._instance.flush)
+        return cls._instance
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self._db_path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self._db_path, check_same_thread=False)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at TEXT NOT NULL
+                )
+            """)
+            self._conn.commit()
+        return self._conn
+
+    def _execute(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        with self._db_lock:
+            conn = self._connection()
+            rows = conn.execute(sql, params).fetchall()
+            conn.commit()
+            return rows
+
+    def enqueue(self, job_id: str, payload: Dict[str, Any]) -> None:
+        self._execute(
+            "INSERT INTO outbox (job_id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+            (job_id, json.dumps(payload, ensure_ascii=False), time.time(), datetime.now().isoformat()),
+        )
+        self.start()
+        self._wake.set()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._stop.clear()
+                self._worker = threading.Thread(target=self._run, name="notion-outbox", daemon=True)
+                self._worker.start()
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+        return {status: count for status, count in rows}
+
+    # 送信期限の来たエントリを1件確保する（ワーカー・flush・replay・別プロセスが同じエントリを二重に送らないよう、
+    # 読み取った状態のままの場合だけsendingに更新する。確保できたエントリがなければNone）
+    def _claim_next(self) -> Optional[Tuple[int, str, int]]:
+        while True:
+            now = time.time()
+            rows = self._execute(
+                "SELECT id, status, next_attempt_at FROM outbox WHERE status IN ('pending', 'sending') AND next_attempt_at <= ? ORDER BY id LIMIT 1",
+                (now,),
+            )
+            if not rows:
+                return None
+            entry_id, status, next_attempt_at = rows[0]
+            claimed = self._execute(
+                "UPDATE outbox SET status = 'sending', next_attempt_at = ? WHERE id = ? AND status = ? AND next_attempt_at = ? RETURNING id, payload, attempts",
+                (now + self.claim_lease, entry_id, status, next_attempt_at),
+            )
+            if claimed:
+                return claimed[0]
+            # 他の送信者が先に確保したので次のエントリを探す
+
+    def _seconds_until_next(self) -> Optional[float]:
+        rows = self._execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status IN ('pending', 'sending')")
+        if not rows or rows[0][0] is None:
+            return None
+        return max(0.0, rows[0][0] - time.time())
+
+    def _get_session(self) -> "requests.Session":
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2)
+            self._session.mount("https://", adapter)
+        return self._session
+
+    def _backoff(self, attempts: int, retry_after: Optional[str] = None) -> float:
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return min(300.0, 2 ** attempts) + random.uniform(0, 1)
+
+    def _mark_retry(self, entry_id: int, attempts: int, error: str, retry_after: Optional[str] = None) -> None:
+        if attempts >= self._max_attempts:
+            self._execute("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?", (attempts, error, entry_id))
+            print(f"Notion outbox: giving up on entry {entry_id}: {error}")
+            return
+        next_attempt_at = time.time() + self._backoff(attempts, retry_after)
+        self._execute(
+            "UPDATE outbox SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            (attempts, next_attempt_at, error, entry_id),
+        )
+
+    # 送信期限の来たエントリを1件送信する（送信したらTrue）
+    def process_one(self) -> bool:
+        entry = self._claim_next()
+        if entry is None:
+            return False
+        entry_id, payload, attempts = entry
+        
+        import requests
+        headers = {
+            'Content-Type': 'application/json',
+            'Notion-Version': '2022-02-22',
+            'Authorization': f'Bearer {SETTINGS.notion_token}',
+        }
+        
+        self._bucket.acquire()
+        try:
+            response = self._get_session().post(self.url, headers=headers, data=payload.encode("utf-8"), timeout=30)
+        except requests.exceptions.RequestException as e:
+            print(f"Notion API request error: {str(e)}")
+            self._mark_retry(entry_id, attempts + 1, str(e))
+            return True
+        
+        if response.status_code == 200:
+            self._execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+        elif response.status_code == 429 or response.status_code >= 500:
+            print(f"Notion API error ({response.status_code}), will retry: {response.text}")
+            self._mark_retry(entry_id, attempts + 1, response.text, response.headers.get("Retry-After"))
+        else:
+            # リトライしても成功しないエラーはfailedとして残し、replayで再送できるようにする
             print(f"Notion API error: {response.text}")
-        return response.json() if response.status_code == 200 else None
+            self._execute("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?", (attempts + 1, response.text, entry_id))
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                if self.process_one():
+                    continue
+                wait = self._seconds_until_next()
+            except Exception as e:
+                print(f"Notion outbox worker error: {str(e)}")
+                wait = 5.0
+            self._wake.wait(timeout=60.0 if wait is None else min(wait, 60.0))
+            self._wake.clear()
+
+    def _stop_worker(self, timeout: float) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._worker is not None and self._worker is not threading.current_thread():
+            self._worker.join(timeout=max(0.0, timeout))
+
+    # 送信期限の来ているエントリを送り切る（シャットダウン時に呼ばれる）
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        if timeout is None:
+            timeout = SETTINGS.notion_flush_timeout
+        deadline = time.monotonic() + timeout
+        # シャットダウン中は新しいスレッドを作れないため、ワーカーを止めて呼び出し元で送信する
+        self._stop_worker(timeout)
+        while time.monotonic() < deadline:
+            if not self.process_one():
+                return True
+        return False
+
+    # 失敗扱いになったエントリを送信待ちに戻す
+    def requeue_failed(self) -> int:
+        rows = self._execute(
+            "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ? WHERE status = 'failed' RETURNING id",
+            (time.time(),),
+        )
+        return len(rows)
+
+    # 未送信のエントリをその場ですべて送信する（リプレイコマンド用）
+    def replay(self, include_failed: bool = True) -> Dict[str, int]:
+        self._stop_worker(timeout=30.0)
+        if include_failed:
+            self.requeue_failed()
+        self._execute("UPDATE outbox SET next_attempt_at = ? WHERE status = 'pending'", (time.time(),))
+        sent = 0
+        while self.process_one():
+            sent += 1
+        return {"attempted": sent, **self.counts()}
+
+# SIGTERMで終了する場合（gunicornを使わないfunctions-frameworkやCloud Functionsなど）はatexitが呼ばれないため、
+# シグナルを受けた時点で送信待ちを送り切ってから、元のハンドラ（なければ既定の動作）に処理を戻す
+# 送り切れなかったエントリはキューに残り、次の起動時のワーカーか notion-replay で送信される
+_previous_sigterm_handler = None
+
+def _flush_notion_on_sigterm(signum, frame) -> None:
+    outbox = NotionOutbox._instance
+    if outbox is not None:
+        # シグナルを受けたスレッドがSQLiteのロックを持っている場合に固まらないよう、別スレッドで送って待つ
+        flusher = threading.Thread(target=outbox.flush, name="notion-outbox-flush", daemon=True)
+        flusher.start()
+        flusher.join(timeout=SETTINGS.notion_flush_timeout + 1.0)
+    previous = _previous_sigterm_handler
+    if callable(previous):
+        previous(signum, frame)
+    elif previous != signal.SIG_IGN:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+def install_sigterm_flush() -> None:
+    global _previous_sigterm_handler
+    # シグナルハンドラはメインスレッドでしか登録できない
+    if threading.current_thread() is not threading.main_thread():
+        return
+    previous = signal.getsignal(signal.SIGTERM)
+    if previous is _flush_notion_on_sigterm:
+        return
+    _previous_sigterm_handler = previous
+    signal.signal(signal.SIGTERM, _flush_notion_on_sigterm)
+
+if SETTINGS.use_notion:
+    install_sigterm_flush()
+
+# 音声の返し方（inline: Base64をJSONに埋め込む / reference: GET /audio/{id} で取得 / multipart: MP3をパートとして同梱）
+AUDIO_MODES = ("inline", "reference", "multipart")
+
+def attach_audio(result_dict, prefix, audio_bytes, audio_mode):
+    if audio_bytes is None:
+        result_dict.pop(f"{prefix}_base64", None)
+        return
+    if audio_mode == "inline":
+        result_dict[f"{prefix}_base64"] = base64.b64encode(audio_bytes).decode('utf-8')
+        return
+    result_dict.pop(f"{prefix}_base64", None)
+    audio_id = AudioStore.get_instance().put(audio_bytes)
+    result_dict[f"{prefix}_id"] = audio_id
+    result_dict[f"{prefix}_url"] = f"/audio/{audio_id}"
+
+# このリクエストのトークン使用量とステージ計測を開始
+def start_request_trace(trace=None):
+    token_usage = {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0}
+    _request_usage.set(token_usage)
+    trace = trace or RequestTrace()
+    trace.fields["token_usage"] = token_usage
+    _request_trace.set(trace)
+    return trace, token_usage
+
+async def _timed_speech(stage, text):
+    with traced(stage):
+        return await synthesize_speech(text)
+
+# 分析結果と音声からカードを組み立てる（Notionへの保存もここで行う）
+async def finish_card(sentence, word, tag, response_dict, audio_bytes, ex_audio_bytes, audio_mode="inline", token_usage=None):
+    # ユニークなファイル名の生成
+    unique_file_name = generate_unique_file_name(word)
+    audio_embed = f"![[{unique_file_name}.mp3]]"
+    ex_audio_embed = f"![[{unique_file_name}_example.mp3]]" if ex_audio_bytes is not None else ""
+    
+    # データフォーマット
+    with traced("format"):
+        formatted_data = create_formatted_data(sentence, word, unique_file_name, response_dict, None, ex_audio_embed)
+        
+        # Ankiテンプレート作成
+        anki_template = create_anki_template(formatted_data, word, tag, audio_embed)
+
+    # USE_NOTION環境変数でNotionへの保存を制御
+    use_notion = SETTINGS.use_notion
+    if use_notion:
+        # Notionへの保存は送信キューに積むだけで、レスポンスを待たせない
+        with traced("notion_enqueue"):
+            await asyncio.get_running_loop().run_in_executor(None, save_to_notion, formatted_data, sentence, word, tag)
+    
+    # 最終的なレスポンスデータの準備（コピーせずにそのまま使う）
+    result_dict = formatted_data
+    result_dict["sentence"] = sentence
+    result_dict["word"] = word
+    result_dict['tag'] = tag
+    result_dict["unique_file_name"] = unique_file_name
+    result_dict["audio_embed"] = audio_embed
+    result_dict["anki_template"] = anki_template
+    if token_usage is not None:
+        result_dict["token_usage"] = token_usage
+    attach_audio(result_dict, "audio", audio_bytes, audio_mode)
+    attach_audio(result_dict, "ex_audio", ex_audio_bytes, audio_mode)
+    
+    return result_dict
+
+# 1枚分のカード生成パイプライン
+async def generate_card_async(sentence, word, tag, use_cache=True, audio_mode="inline", profile=None, trace=None):
+    trace, token_usage = start_request_trace(trace)
+    
+    # GEMINI_STREAMING環境変数でストリーミング分析を制御
+    use_streaming = SETTINGS.gemini_streaming
+    
+    ex_audio_tasks = {}
+    
+    # 例文音声を生成（ストリーミング時は例文フィールドが確定した時点で開始）
+    def start_example_audio(example_sentence):
+        if example_sentence not in ex_audio_tasks:
+            ex_audio_tasks[example_sentence] = asyncio.ensure_future(
+                _timed_speech("tts_example", extract_example_english(example_sentence))
+            )
+        return ex_audio_tasks[example_sentence]
+    
+    def on_field(key, value):
+        if key == "example_sentence" and isinstance(value, str):
+            start_example_audio(value)
+    
+    # API呼び出し（キャッシュ経由）と音声生成を並列実行
+    audio_task = asyncio.ensure_future(_timed_speech("tts_sentence", sentence))
+    try:
+        response_dict = await analyze_word(sentence, word, tag, use_cache, on_field if use_streaming else None, profile)
+        audio_bytes = await audio_task
+        
+        # 例文音声の取得（検証後の例文と異なる場合は作り直す。例文を生成しないプロファイルでは省略）
+        example_sentence = response_dict.get("example_sentence", "")
+        ex_audio_bytes = await start_example_audio(example_sentence) if example_sentence else None
+    finally:
+        # 失敗時に取り残されたタスクを片付ける
+        for task in [audio_task, *ex_audio_tasks.values()]:
+            if not task.done():
+                task.cancel()
+    
+    return await finish_card(sentence, word, tag, response_dict, audio_bytes, ex_audio_bytes, audio_mode, token_usage)
+
+def generate_card(sentence, word, tag, use_cache=True, audio_mode="inline", profile=None, trace=None):
+    return EventLoopThread.get_instance().run(generate_card_async(sentence, word, tag, use_cache, audio_mode, profile, trace))
+
+# 同じセリフ英文の複数の単語からカードを生成（分析とセリフ音声は1回だけ）
+async def generate_cards_async(sentence, words, tag, use_cache=True, audio_mode="inline", profile=None, trace=None):
+    trace, token_usage = start_request_trace(trace)
+    
+    async def example_audio(response_dict):
+        example_sentence = response_dict.get("example_sentence", "")
+        if not example_sentence:
+            return None
+        return await _timed_speech("tts_example", extract_example_english(example_sentence))
+    
+    # セリフ音声は分析と並列に1回だけ生成し、例文音声は単語ごとに並列で生成する
+    audio_task = asyncio.ensure_future(_timed_speech("tts_sentence", sentence))
+    ex_audio_tasks = []
+    try:
+        response_dicts = await analyze_words(sentence, words, tag, use_cache, profile)
+        ex_audio_tasks = [asyncio.ensure_future(example_audio(response_dict)) for response_dict in response_dicts]
+        audio_bytes, *ex_audio_list = await asyncio.gather(audio_task, *ex_audio_tasks)
+    finally:
+        # 1つでも失敗したら（gatherは残りを取り消さない）、エラーを返すリクエストのために音声合成を続けないよう取り消す
+        for task in [audio_task, *ex_audio_tasks]:
+            if not task.done():
+                task.cancel()
+    
+    cards = []
+    for word, response_dict, ex_audio_bytes in zip(words, response_dicts, ex_audio_list):
+        cards.append(await finish_card(sentence, word, tag, response_dict, audio_bytes, ex_audio_bytes, audio_mode))
+    return {"sentence": sentence, "tag": tag, "cards": cards, "token_usage": token_usage}
+
+def generate_cards(sentence, words, tag, use_cache=True, audio_mode="inline", profile=None, trace=None):
+    return EventLoopThread.get_instance().run(generate_cards_async(sentence, words, tag, use_cache, audio_mode, profile, trace))
+
+# JSONレスポンス（クライアントが対応していればgzip圧縮）
+def json_response(request, data, status=200):
+    response = jsonify(data)
+    response.status_code = status
+    return compress_response(request, response)
+
+def compress_response(request, response):
+    body = response.get_data()
+    if response.mimetype == "application/json" and "gzip" in request.accept_encodings and len(body) >= 1024:
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+# カードJSONとMP3をパートに分けたmultipartレスポンス
+def multipart_response(result_dict):
+    store = AudioStore.get_instance()
+    audio_parts = []
+    for prefix, file_name in [("audio", result_dict["unique_file_name"]), ("ex_audio", f"{result_dict['unique_file_name']}_example")]:
+        if f"{prefix}_id" not in result_dict:
+            continue
+        audio_bytes = store.pop(result_dict.pop(f"{prefix}_id"))
+        result_dict.pop(f"{prefix}_url", None)
+        # 保持期限切れや容量超過で追い出された音声はパートを付けない（カードJSONだけ返す）
+        if audio_bytes is None:
+            print(f"Audio for {prefix} is no longer available: {file_name}")
+            continue
+        result_dict[f"{prefix}_part"] = prefix
+        audio_parts.append((prefix, f"{file_name}.mp3", audio_bytes))
+    
+    boundary = uuid.uuid4().hex
+    body = BytesIO()
+    body.write(f"--{boundary}\r\nContent-Type: application/json; charset=utf-8\r\nContent-Disposition: inline; name=\"card\"\r\n\r\n".encode("utf-8"))
+    body.write(json.dumps(result_dict, ensure_ascii=False).encode("utf-8"))
+    for name, file_name, audio_bytes in audio_parts:
+        body.write(f"\r\n--{boundary}\r\nContent-Type: audio/mpeg\r\nContent-Disposition: attachment; name=\"{name}\"; filename=\"{file_name}\"\r\n\r\n".encode("utf-8"))
+        body.write(audio_bytes)
+    body.write(f"\r\n--{boundary}--\r\n".encode("utf-8"))
+    return Response(body.getvalue(), status=200, mimetype=f"multipart/mixed; boundary={boundary}")
+
+# 同じリクエストの再送（iOSショートカットがタイムアウトで再試行した場合など）を1回の生成にまとめる
+# 実行中の同じキーは結果を待って共有し、完了した結果はIDEMPOTENCY_TTLの間そのまま返す（job_id・ファイル名も同じ。Notionにも二重に登録しない）
+class IdempotencyStore:
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, ttl: float, max_bytes: int) -> None:
+        self.ttl = ttl
+        # (期限, リクエストの指紋, ステータス, Content-Type, 本文)
+        self._results = LRUCache(max_bytes, sizeof=lambda entry: len(entry[4]))
+        self._in_flight: Dict[str, Tuple[str, Future]] = {}
+        self._state_lock = threading.Lock()
+        self.stats = {"computed": 0, "replayed": 0, "coalesced": 0}
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:  # 二重チェックロック
+                    cls._instance = cls(SETTINGS.idempotency_ttl, SETTINGS.idempotency_max_bytes)
+        return cls._instance
+
+    # computeはレスポンスを返す関数。結果ごとに新しいResponseを作って返す（スレッド間でResponseを共有しない）
+    def run(self, key: str, fingerprint: str, compute) -> Tuple[Response, str]:
+        with self._state_lock:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] < time.time():
+                self._results.delete(key)
+                entry = None
+            if entry is not None:
+                outcome = "replayed"
+                result = entry[1:]
+            elif key in self._in_flight:
+                outcome = "coalesced"
+                result_fingerprint, future = self._in_flight[key]
+            else:
+                outcome = "computed"
+                future = Future()
+                self._in_flight[key] = (fingerprint, future)
+            self.stats[outcome] += 1
+        
+        if outcome == "coalesced":
+            if result_fingerprint != fingerprint:
+                raise HTTPException(422, "Idempotency-Key was already used for a different request")
+            result = future.result()
+        elif outcome == "computed":
+            try:
+                response = compute()
+                result = (fingerprint, response.status_code, response.content_type, response.get_data())
+            except BaseException as e:
+                # 失敗は保存せず、待っていた同じリクエストにだけ同じエラーを返す（再送時は作り直す）
+                with self._state_lock:
+                    self._in_flight.pop(key, None)
+                future.set_exception(e)
+                raise
+            with self._state_lock:
+                self._in_flight.pop(key, None)
+                if self.ttl > 0 and result[1] == 200:
+                    self._results.set(key, (time.time() + self.ttl, *result))
+            future.set_result(result)
+        
+        result_fingerprint, status, content_type, body = result
+        if result_fingerprint != fingerprint:
+            raise HTTPException(422, "Idempotency-Key was already used for a different request")
+        return Response(body, status=status, content_type=content_type), outcome
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._state_lock:
+            return {**self.stats, "in_flight": len(self._in_flight), "entries": len(self._results)}
+
+# Idempotency-Keyヘッダー（なければリクエスト本文から導く）と、キーの使い回しを検出するための本文の指紋
+def idempotency_key(request, request_dict) -> Tuple[Optional[str], str]:
+    fingerprint = hashlib.sha256(
+        json.dumps([request.path.rstrip("/"), request_dict], sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+    header_key = request.headers.get("Idempotency-Key", "").strip()
+    if header_key:
+        return f"key:{header_key}", fingerprint
+    # no_cacheは作り直しの指定のため、本文からは導かない
+    if SETTINGS.idempotency_derive_key and not request_dict.get("no_cache", False):
+        return f"body:{fingerprint}", fingerprint
+    return None, fingerprint
+
+# バッチ入力（JSON配列 または NDJSON）の読み込み
+def parse_batch_items(request):
+    if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                items.append({"_parse_error": f"Invalid JSON line: {e.msg}"})
+        return items
+    
+    request_dict = request.get_json(silent=True)
+    if isinstance(request_dict, list):
+        return request_dict
+    if isinstance(request_dict, dict) and isinstance(request_dict.get("items"), list):
+        return request_dict["items"]
+    return None
+
+# 複数単語の指定（words）の検証（重複は1つにまとめる）
+def parse_words(words):
+    if not isinstance(words, list) or not words or not all(isinstance(word, str) and word.strip() for word in words):
+        raise HTTPException(400, "words must be a non-empty list of strings")
+    words = list(dict.fromkeys(word.strip() for word in words))
+    if len(words) > SETTINGS.max_words_per_request:
+        raise HTTPException(400, f"words accepts at most {SETTINGS.max_words_per_request} entries")
+    return words
+
+# バッチ内の1件を処理（失敗はアイテム単位のエラーとして返す）
+async def process_batch_item(index, item, limit):
+    request_id = item.get("request_id") if isinstance(item, dict) else None
+    trace = RequestTrace(str(request_id) if request_id is not None else None)
+    status = 500
+    try:
+        if not isinstance(item, dict):
+            raise HTTPException(400, "Item must be a JSON object")
+        if "_parse_error" in item:
+            raise HTTPException(400, item["_parse_error"])
+        if not all(key in item for key in ['sentence', 'tag']) or not ('word' in item or 'words' in item):
+            raise HTTPException(400, "Missing required fields")
+        audio_mode = item.get('audio_mode', 'inline')
+        if audio_mode not in ("inline", "reference"):
+            raise HTTPException(400, "audio_mode must be 'inline' or 'reference' in batch mode")
+        profile = AnalysisProfile.get(item.get('profile'), item.get('fields'))
+        
+        words = parse_words(item['words']) if 'words' in item else None
+        
+        async with limit:
+            if words is not None:
+                result_dict = await generate_cards_async(item['sentence'], words, item['tag'], not item.get('no_cache', False), audio_mode, profile, trace)
+            else:
+                result_dict = await generate_card_async(item['sentence'], item['word'], item['tag'], not item.get('no_cache', False), audio_mode, profile, trace)
+        result_dict["index"] = index
+        if request_id is not None:
+            result_dict["request_id"] = request_id
+        status = 200
+        return result_dict
+    except HTTPException as e:
+        status = e.status_code
+        return {"index": index, "request_id": request_id, "error": e.detail, "status": e.status_code}
     except Exception as e:
-        print(f"Notion API request error: {str(e)}")
-        return None
+        return {"index": index, "request_id": request_id, "error": str(e), "status": 500}
+    finally:
+        trace.log(status, batch_index=index)
 
-# スレッドプール実行器
-executor = ThreadPoolExecutor(max_workers=10)
+# 完成したカードから順にNDJSONで1行ずつ返す
+def stream_batch_results(items):
+    runtime = EventLoopThread.get_instance()
+    limit = asyncio.Semaphore(SETTINGS.batch_concurrency)
+    futures = [runtime.submit(process_batch_item(index, item, limit)) for index, item in enumerate(items)]
+    for future in as_completed(futures):
+        yield json.dumps(future.result(), ensure_ascii=False) + "\n"
+
+# 完成したカードから順に.apkgへ書き出して返す（音声はパッケージに同梱するためJSONに埋め込んで受け取る）
+def stream_batch_apkg(items):
+    from apkg import stream_apkg
+    
+    runtime = EventLoopThread.get_instance()
+    limit = asyncio.Semaphore(SETTINGS.batch_concurrency)
+    futures = [
+        runtime.submit(process_batch_item(index, {**item, "audio_mode": "inline"} if isinstance(item, dict) else item, limit))
+        for index, item in enumerate(items)
+    ]
+    
+    def completed_cards():
+        for future in as_completed(futures):
+            result = future.result()
+            if "error" in result:
+                # 失敗したアイテムはパッケージに含めない
+                print(f"apkg export skipped item {result['index']}: {result['error']}")
+                continue
+            yield from result.get("cards", [result])
+    
+    return stream_apkg(completed_cards())
+
+# バッチの結果をNDJSONで返す（?format=apkg の場合はAnkiに直接取り込めるパッケージとして返す）
+def batch_response(request, items):
+    if request.args.get("format") == "apkg":
+        return Response(stream_batch_apkg(items), status=200, mimetype="application/apkg", headers={
+            "Content-Disposition": 'attachment; filename="anki-cards.apkg"',
+        })
+    return Response(stream_batch_results(items), status=200, mimetype="application/x-ndjson")
+
+# 非同期ジョブの状態の保存先（JOB_STORE で切り替え。どちらも1台のマシン内で完結する）
+class JobStore(ABC):
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:  # 二重チェックロック
+                    if SETTINGS.job_store not in JOB_STORES:
+                        raise ValueError(f"JOB_STORE must be one of {', '.join(JOB_STORES)}")
+                    cls._instance = JOB_STORES[SETTINGS.job_store]()
+        return cls._instance
+
+    # ジョブを丸ごと保存する（作成・更新とも。保存後に呼び出し元がジョブを変更しても影響しない）
+    @abstractmethod
+    def put(self, job: Dict[str, Any]) -> None:
+        ...
+
+    # 保存済みのジョブのコピーを返す
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    # 完了していないジョブのうち、実行中のプロセスが確保の期限（lease_until）を延長しなくなったものを確保して返す
+    # 同じストアを共有する複数のワーカーが同時に呼んでも、1つのジョブは1つのワーカーにだけ返す
+    @abstractmethod
+    def claim_stale(self, lease_until: float) -> List[Dict[str, Any]]:
+        ...
+
+    # 実行中のジョブの確保の期限を延ばす
+    @abstractmethod
+    def renew(self, job_ids: List[str], lease_until: float) -> None:
+        ...
+
+    # 指定時刻より前に完了したジョブを消す
+    @abstractmethod
+    def purge(self, before: float) -> int:
+        ...
+
+# プロセスのメモリに保存（再起動で消える）
+class MemoryJobStore(JobStore):
+    def __init__(self) -> None:
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._jobs_lock = threading.Lock()
+
+    # 実行中のジョブや返したジョブと中身を共有しないよう、出し入れのたびにコピーする
+    def put(self, job: Dict[str, Any]) -> None:
+        with self._jobs_lock:
+            self._jobs[job["job_id"]] = copy.deepcopy(job)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._jobs_lock:
+            job = self._jobs.get(job_id)
+            return copy.deepcopy(job) if job is not None else None
+
+    def claim_stale(self, lease_until: float) -> List[Dict[str, Any]]:
+        now = time.time()
+        with self._jobs_lock:
+            claimed = []
+            for job in self._jobs.values():
+                if job["status"] in ("queued", "running") and job.get("lease_until", 0.0) < now:
+                    job["lease_until"] = lease_until
+                    claimed.append(copy.deepcopy(job))
+            return claimed
+
+    def renew(self, job_ids: List[str], lease_until: float) -> None:
+        with self._jobs_lock:
+            for job_id in job_ids:
+                if job_id in self._jobs:
+                    self._jobs[job_id]["lease_until"] = lease_until
+
+    def purge(self, before: float) -> int:
+        with self._jobs_lock:
+            expired = [job_id for job_id, job in self._jobs.items() if job["status"] in ("succeeded", "failed") and job["updated_at"] < before]
+            for job_id in expired:
+                del self._jobs[job_id]
+        return len(expired)
+
+# SQLiteに保存（再起動しても、完了していないジョブを続きから実行できる）
+class SQLiteJobStore(JobStore):
+    def __init__(self) -> None:
+        self._db_path = SETTINGS.job_store_db
+        self._db_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _execute(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        with self._db_lock:
+            if self._conn is None:
+                os.makedirs(os.path.dirname(self._db_path) or ".", exist_ok=True)
+                self._conn = sqlite3.connect(self._db_path, check_same_thread=False)
+                self._conn.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, status TEXT NOT NULL, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+                # 確保の期限の列がない古いデータベースには追加する（期限0のジョブは起動時にやり直す）
+                columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+                if "lease_until" not in columns:
+                    self._conn.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL NOT NULL DEFAULT 0")
+                self._conn.commit()
+            rows = self._conn.execute(sql, params).fetchall()
+            self._conn.commit()
+            return rows
+
+    def put(self, job: Dict[str, Any]) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO jobs (job_id, status, data, updated_at, lease_until) VALUES (?, ?, ?, ?, ?)",
+            (job["job_id"], job["status"], json.dumps(job, ensure_ascii=False), job["updated_at"], job.get("lease_until", 0.0)),
+        )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    # 期限の判定と更新を1つのUPDATEで行うため、他のワーカーと同じジョブを確保することはない
+    def claim_stale(self, lease_until: float) -> List[Dict[str, Any]]:
+        rows = self._execute(
+            "UPDATE jobs SET lease_until = ? WHERE status IN ('queued', 'running') AND lease_until < ? RETURNING data",
+            (lease_until, time.time()),
+        )
+        jobs = [json.loads(row[0]) for row in rows]
+        for job in jobs:
+            job["lease_until"] = lease_until
+        return jobs
+
+    def renew(self, job_ids: List[str], lease_until: float) -> None:
+        if not job_ids:
+            return
+        self._execute(
+            f"UPDATE jobs SET lease_until = ? WHERE job_id IN ({', '.join('?' * len(job_ids))})",
+            (lease_until, *job_ids),
+        )
+
+    def purge(self, before: float) -> int:
+        rows = self._execute("DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND updated_at < ? RETURNING job_id", (before,))
+        return len(rows)
+
+JOB_STORES = {"memory": MemoryJobStore, "sqlite": SQLiteJobStore}
+
+# クライアントに返すジョブの内容（入力とその指紋は返さない）
+def public_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    view = {key: value for key, value in job.items() if key not in ("request", "fingerprint", "updated_at", "lease_until")}
+    view["status_url"] = f"/jobs/{job['job_id']}"
+    return view
+
+# ジョブとして受け付けるリクエストの検証（実行前に400を返す）
+def parse_job_request(request_dict):
+    if not isinstance(request_dict, dict):
+        raise HTTPException(400, "Job request must be a JSON object")
+    if not all(key in request_dict for key in ['sentence', 'tag']) or not ('word' in request_dict or 'words' in request_dict):
+        raise HTTPException(400, "Missing required fields")
+    if request_dict.get('audio_mode', 'inline') not in ("inline", "reference"):
+        raise HTTPException(400, "audio_mode must be 'inline' or 'reference' for jobs")
+    if 'words' in request_dict:
+        parse_words(request_dict['words'])
+    AnalysisProfile.get(request_dict.get('profile'), request_dict.get('fields'))
+    webhook_url = request_dict.get('webhook_url')
+    if webhook_url is not None and (not isinstance(webhook_url, str) or not webhook_url.startswith(("https://", "http://"))):
+        raise HTTPException(400, "webhook_url must be an http(s) URL")
+
+# 受け付けたジョブを既存のパイプラインで実行し、状態を保存する（完了時はwebhookにも通知）
+class JobRunner:
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, store: JobStore, concurrency: int, max_pending: int) -> None:
+        self.store = store
+        self._max_pending = max_pending
+        self._limit = asyncio.Semaphore(concurrency)
+        self._submit_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = 0
+        # このプロセスで実行中（待機中を含む）のジョブ。確保の期限を定期的に延ばす
+        self._active: Dict[str, Dict[str, Any]] = {}
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:  # 二重チェックロック
+                    cls._instance = cls(JobStore.get_instance(), SETTINGS.job_concurrency, SETTINGS.job_max_pending)
+                    cls._instance.recover()
+        return cls._instance
+
+    # 再起動前に完了しなかったジョブを最初からやり直す
+    # ワーカーごとに呼ばれるため、実行中のワーカーが確保の期限を延ばしているジョブには手を付けない
+    def recover(self) -> int:
+        jobs = self.store.claim_stale(time.time() + SETTINGS.job_lease)
+        for job in jobs:
+            job.update(status="queued", started_at=None, updated_at=time.time())
+            self.store.put(job)
+            self._start(job)
+        return len(jobs)
+
+    # 保持期限（IDEMPOTENCY_TTL）を過ぎた完了済みのジョブか
+    @staticmethod
+    def _expired(job: Dict[str, Any]) -> bool:
+        return job["status"] in ("succeeded", "failed") and job["updated_at"] < time.time() - SETTINGS.idempotency_ttl
+
+    # 保持期限内のジョブ（期限切れはまだ消えていなくても返さない）
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self.store.get(job_id)
+        return None if job is None or self._expired(job) else job
+
+    # ジョブを受け付ける（同じキーのジョブがあればそれを返す。2つ目の値は新しく作ったかどうか）
+    # 失敗したジョブは返さずに作り直す（429・504などの一時的なエラーを同じ送信の再試行でやり直せるように）
+    def submit(self, request_dict, key, fingerprint) -> Tuple[Dict[str, Any], bool]:
+        job_id = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32] if key else uuid.uuid4().hex
+        with self._submit_lock:
+            self.store.purge(time.time() - SETTINGS.idempotency_ttl)
+            existing = self.get(job_id) if key else None
+            if existing is not None:
+                if existing["fingerprint"] != fingerprint:
+                    raise HTTPException(422, "Idempotency-Key was already used for a different request")
+                if existing["status"] != "failed":
+                    return existing, False
+            if self.snapshot()["pending"] >= self._max_pending:
+                raise HTTPException(503, "Too many pending jobs")
+            job = {
+                "job_id": job_id,
+                "status": "queued",
+                "request": request_dict,
+                "fingerprint": fingerprint,
+                "created_at": datetime.now().isoformat(),
+                "started_at": None,
+                "finished_at": None,
+                "updated_at": time.time(),
+                "lease_until": time.time() + SETTINGS.job_lease,
+            }
+            self.store.put(job)
+            # 返すのは実行前の状態のコピー（実行中のジョブはイベントループのスレッドが書き換える）
+            snapshot = copy.deepcopy(job)
+            self._start(job)
+        return snapshot, True
+
+    def _start(self, job) -> None:
+        with self._pending_lock:
+            self._pending += 1
+        EventLoopThread.get_instance().submit(self._run(job))
+
+    # 実行中のジョブの確保の期限を JOB_LEASE の1/3ごとに延ばす（プロセスが落ちると延長が止まり、他のワーカーがやり直す）
+    async def _renew_leases(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._active:
+            await asyncio.sleep(SETTINGS.job_lease / 3)
+            lease_until = time.time() + SETTINGS.job_lease
+            for job in list(self._active.values()):
+                job["lease_until"] = lease_until
+            try:
+                await loop.run_in_executor(None, self.store.renew, list(self._active), lease_until)
+            except Exception as e:
+                print(f"Job lease renewal error: {str(e)}")
+
+    async def _run(self, job) -> None:
+        loop = asyncio.get_running_loop()
+        self._active[job["job_id"]] = job
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.ensure_future(self._renew_leases())
+        try:
+            async with self._limit:
+                job.update(status="running", started_at=datetime.now().isoformat(), updated_at=time.time())
+                await loop.run_in_executor(None, self.store.put, job)
+                # 同時実行数はジョブ単位で制限済みのため、アイテム単位では制限しない
+                result = await process_batch_item(0, {**job["request"], "request_id": job["job_id"]}, nullcontext())
+            result.pop("index", None)
+            result.pop("request_id", None)
+            if "error" in result:
+                job.update(status="failed", error=result["error"], status_code=result["status"])
+            else:
+                job.update(status="succeeded", result=result, status_code=200)
+        except Exception as e:
+            job.update(status="failed", error=str(e), status_code=500)
+        finally:
+            self._active.pop(job["job_id"], None)
+            with self._pending_lock:
+                self._pending -= 1
+        
+        job.update(finished_at=datetime.now().isoformat(), updated_at=time.time())
+        try:
+            await loop.run_in_executor(None, self.store.put, job)
+        except Exception as e:
+            print(f"Job store write error for {job['job_id']}: {str(e)}")
+        if job["request"].get("webhook_url"):
+            await self._notify(job)
+
+    # 完了したジョブをwebhookへPOSTする（429・5xx・通信エラーはリトライ）
+    async def _notify(self, job) -> None:
+        import httpx
+        client = AsyncHTTPClient.get_instance()
+        payload = public_job(job)
+        error = None
+        for attempt in range(1, SETTINGS.job_webhook_attempts + 1):
+            try:
+                response = await client.post(job["request"]["webhook_url"], json=payload, timeout=SETTINGS.job_webhook_timeout)
+                if response.status_code < 300:
+                    error = None
+                    break
+                error = f"HTTP {response.status_code}"
+                if response.status_code < 500 and response.status_code != 429:
+                    break
+            except httpx.HTTPError as e:
+                error = str(e) or type(e).__name__
+            if attempt < SETTINGS.job_webhook_attempts:
+                await asyncio.sleep(min(30.0, 2 ** attempt) + random.uniform(0, 1))
+        
+        if error is not None:
+            print(f"Job webhook error for {job['job_id']}: {error}")
+        job["webhook"] = {"status": "failed" if error else "delivered", "attempts": attempt, "error": error}
+        job["updated_at"] = time.time()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.store.put, job)
+        except Exception as e:
+            print(f"Job store write error for {job['job_id']}: {str(e)}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._pending_lock:
+            return {"pending": self._pending, "store": SETTINGS.job_store}
 
 @functions_framework.http
 def main_function(request):
+    ensure_warm_up()
     try:
+        # キャッシュ統計
+        if request.method == "GET" and request.path.rstrip("/").endswith("/cache/stats"):
+            return jsonify({
+                "analysis": AnalysisCache.get_instance().snapshot(),
+                "audio": AudioCache.get_instance().snapshot(),
+                "gemini_tokens": TokenUsage.snapshot(),
+                "idempotency": IdempotencyStore.get_instance().snapshot(),
+                "jobs": JobRunner.get_instance().snapshot(),
+            }), 200
+        
+        # ステージごとの所要時間ヒストグラム
+        if request.method == "GET" and request.path.rstrip("/").endswith("/metrics"):
+            if request.args.get("format") == "prometheus":
+                return Response(StageMetrics.prometheus() + GeminiScheduler.prometheus(), status=200, mimetype="text/plain; version=0.0.4")
+            return jsonify({
+                "stages": StageMetrics.snapshot(),
+                "gemini_tokens": TokenUsage.snapshot(),
+                "gemini_scheduler": GeminiScheduler.snapshot(),
+                "gemini_hedging": GeminiHedger.snapshot(),
+            }), 200
+        
+        # 字幕ファイルからの事前分析（GETでキューの状況）
+        if request.path.rstrip("/").endswith("/prewarm"):
+            if request.method == "GET":
+                return jsonify(PrewarmQueue.get_instance().snapshot()), 200
+            if request.is_json:
+                request_dict = request.get_json()
+                subtitles = request_dict.get("subtitles")
+                tag = request_dict.get("tag", "Other")
+                known_words = request_dict.get("known_words")
+                profile = AnalysisProfile.get(request_dict.get("profile"), request_dict.get("fields"))
+            else:
+                # .srt / .vtt をそのまま送る場合はタグなどをクエリで指定
+                subtitles = request.get_data(as_text=True)
+                tag = request.args.get("tag", "Other")
+                known_words = None
+                profile = AnalysisProfile.get(request.args.get("profile"))
+            if not isinstance(subtitles, str) or not subtitles.strip():
+                return jsonify({'error': 'Missing subtitles'}), 400
+            if known_words is not None and not isinstance(known_words, list):
+                return jsonify({'error': 'known_words must be a list'}), 400
+            return jsonify(prewarm_subtitles(subtitles, tag, profile, known_words)), 202
+        
+        # 非同期ジョブの受け付け（すぐに202とジョブIDを返し、結果は GET /jobs/{id} またはwebhookで受け取る）
+        if request.method == "POST" and request.path.rstrip("/").endswith("/jobs"):
+            if not request.is_json:
+                return jsonify({'error': 'Unsupported Media Type'}), 415
+            request_dict = request.get_json()
+            parse_job_request(request_dict)
+            # 送信の再試行で同じジョブを二重に作らない
+            key, fingerprint = idempotency_key(request, request_dict)
+            job, created = JobRunner.get_instance().submit(request_dict, key, fingerprint)
+            response = jsonify(public_job(job))
+            response.status_code = 202
+            response.headers["Location"] = f"/jobs/{job['job_id']}"
+            if not created:
+                response.headers["Idempotent-Replayed"] = "true"
+            return response
+        
+        # 非同期ジョブの状態と結果
+        if request.method == "GET" and "/jobs/" in request.path:
+            job = JobRunner.get_instance().get(request.path.rstrip("/").rsplit("/", 1)[-1])
+            if job is None:
+                return jsonify({'error': 'Job not found or expired'}), 404
+            return json_response(request, public_job(job))
+        
+        # 参照モードで返した音声の取得
+        if request.method == "GET" and "/audio/" in request.path:
+            audio_bytes = AudioStore.get_instance().get(request.path.rstrip("/").rsplit("/", 1)[-1])
+            if audio_bytes is None:
+                return jsonify({'error': 'Audio not found or expired'}), 404
+            return Response(audio_bytes, status=200, mimetype="audio/mpeg")
+        
+        # バッチモード（JSON配列 / NDJSON）
+        if request.mimetype in ("application/x-ndjson", "application/jsonl") or (request.is_json and request.path.rstrip("/").endswith("/batch")):
+            items = parse_batch_items(request)
+            if items is None:
+                return jsonify({'error': 'Batch request must be a JSON array or NDJSON'}), 400
+            return batch_response(request, items)
+        
         # リクエストのチェック
         if not request.is_json:
             return jsonify({'error': 'Unsupported Media Type'}), 415
         
         request_dict = request.get_json()
         
+        # JSON配列はバッチとして扱う
+        if isinstance(request_dict, list):
+            return batch_response(request, request_dict)
+        
         # 必須フィールドの確認
-        if not all(key in request_dict for key in ['sentence', 'word', 'tag']):
+        if not all(key in request_dict for key in ['sentence', 'tag']) or not ('word' in request_dict or 'words' in request_dict):
             return jsonify({'error': 'Missing required fields'}), 400
         
-        sentence = request_dict['sentence']
-        word = request_dict['word']
-        tag = request_dict['tag']
+        audio_mode = request_dict.get('audio_mode', 'inline')
+        if audio_mode not in AUDIO_MODES:
+            return jsonify({'error': f"audio_mode must be one of {', '.join(AUDIO_MODES)}"}), 400
         
-        # ユニークなファイル名の生成
-        unique_file_name = generate_unique_file_name(word)
+        # wordsを指定した場合は同じセリフ英文の単語ごとにカードを返す
+        words = parse_words(request_dict['words']) if 'words' in request_dict else None
+        if words is not None and audio_mode == "multipart":
+            return jsonify({'error': "audio_mode 'multipart' is not supported with words"}), 400
         
-        # プロンプトの作成
-        prompt = create_prompt(sentence, word, tag)
+        profile = AnalysisProfile.get(request_dict.get('profile'), request_dict.get('fields'))
         
-        # ThreadPoolExecutorを使用した並列処理
-        with ThreadPoolExecutor() as executor:
-            # API呼び出しと音声生成を並列実行
-            future_gemini = executor.submit(analysis_words_by_gemini, prompt)
-            future_audio = executor.submit(generate_audio_clip, sentence, unique_file_name)
-            
-            # 結果の取得
-            response_dict = future_gemini.result()
-            audio_base64, audio_embed = future_audio.result()
-            
-            # 例文を抽出
-            example_sentence = response_dict.get("example_sentence", "")
-            if "（" in example_sentence and "）" in example_sentence:
-                ex_sentence_english = example_sentence.split("（", 1)[0]
-            else:
-                ex_sentence_english = example_sentence
-                
-            # 例文音声を生成
-            future_ex_audio = executor.submit(generate_audio_clip, ex_sentence_english, f"{unique_file_name}_example")
-            ex_audio_base64, ex_audio_embed = future_ex_audio.result()
+        trace = RequestTrace(request.headers.get("X-Request-ID"))
+        status = 500
+        idempotency = None
         
-        # データフォーマット
-        formatted_data = create_formatted_data(sentence, word, unique_file_name, response_dict, ex_audio_base64, ex_audio_embed)
+        def compute():
+            if words is not None:
+                result_dict = generate_cards(request_dict['sentence'], words, request_dict['tag'], not request_dict.get('no_cache', False), audio_mode, profile, trace)
+            else:
+                result_dict = generate_card(request_dict['sentence'], request_dict['word'], request_dict['tag'], not request_dict.get('no_cache', False), audio_mode, profile, trace)
+            
+            # レスポンス作成（gzip圧縮は再送時にも送り手に合わせて行う）
+            with trace.stage("serialize"):
+                if audio_mode == "multipart":
+                    return multipart_response(result_dict)
+                return jsonify(result_dict)
         
-        # Ankiテンプレート作成
-        anki_template = create_anki_template(formatted_data, word, tag, audio_embed)
-
-        # USE_NOTION環境変数でNotionへの保存を制御
-        use_notion = bool(strtobool(os.environ.get("USE_NOTION", "false")))
-        if use_notion:
-            # Notionへの保存を別スレッドで実行（バックグラウンド処理）
-            threading.Thread(
-                target=save_to_notion,
-                args=(formatted_data, sentence, word, tag),
-                daemon=True
-            ).start()
-        
-        # 最終的なレスポンスデータの準備
-        result_dict = formatted_data.copy()
-        result_dict["sentence"] = sentence
-        result_dict["word"] = word
-        result_dict['tag'] = tag
-        result_dict["unique_file_name"] = unique_file_name
-        result_dict["audio_base64"] = audio_base64
-        result_dict["audio_embed"] = audio_embed
-        result_dict["anki_template"] = anki_template
-        
-        # レスポンス返却
-        return jsonify(result_dict), 200
+        try:
+            # 同じリクエストの再送は、実行中なら結果を共有し、完了済みなら保存した結果を返す
+            key, fingerprint = idempotency_key(request, request_dict)
+            if key is None:
+                response = compute()
+            else:
+                response, idempotency = IdempotencyStore.get_instance().run(key, fingerprint, compute)
+                if idempotency != "computed":
+                    response.headers["Idempotent-Replayed"] = "true"
+            
+            # レスポンス返却
+            response = compress_response(request, response)
+            status = response.status_code
+            response.headers["Server-Timing"] = trace.server_timing()
+            response.headers["X-Request-ID"] = trace.request_id
+            return response
+        except HTTPException as e:
+            status = e.status_code
+            raise
+        finally:
+            trace.log(status, path=request.path, audio_mode=audio_mode, idempotency=idempotency)
         
     except HTTPException as e:
         return jsonify({'error': e.detail}), e.status_code
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+# 起動直後にバックグラウンドで重いSDKの読み込みとクライアントの生成を済ませる（最初のリクエストを待たせない）
+async def _warm_up_async():
+    await TTSBackend.get_instance().warm_up()
+    await GeminiHedger.get_instance().warm_up()
+
+def warm_up():
+    try:
+        GeminiClient.get_instance()
+        Lexicon.get_instance()
+        EventLoopThread.get_instance().run(_warm_up_async())
+        # SQLiteに残った未完了のジョブを再開する
+        if SETTINGS.job_store == "sqlite":
+            JobRunner.get_instance()
+        if SETTINGS.use_notion:
+            outbox = NotionOutbox.get_instance()
+            outbox._get_session()
+            # 前回のプロセスが送り切れなかったエントリを送る
+            outbox.start()
+    except Exception as e:
+        print(f"Warm-up error: {str(e)}")
+
+# ウォームアップはリクエストを処理するプロセスで行う
+# gunicornはマスターでこのモジュールを読み込んでからフォークするため、読み込み時に始めると
+# イベントループのスレッドがないシングルトンをワーカーが引き継いでしまう
+_warm_up_pid: Optional[int] = None
+_warm_up_lock = threading.Lock()
+
+def ensure_warm_up() -> None:
+    global _warm_up_pid
+    if not SETTINGS.warmup or _warm_up_pid == os.getpid():
+        return
+    with _warm_up_lock:
+        if _warm_up_pid != os.getpid():  # 二重チェックロック
+            _warm_up_pid = os.getpid()
+            threading.Thread(target=warm_up, name="anki-warm-up", daemon=True).start()
+
+# スレッド・イベントループ・接続を持つシングルトン（フォーク後の子プロセスでは作り直す）
+FORK_RESET_SINGLETONS = (
+    EventLoopThread, GeminiClient, AsyncHTTPClient, AudioCache, AudioStore, TTSBackend, GeminiScheduler, GeminiHedger,
+    AnalysisCache, PrewarmQueue, NotionOutbox, IdempotencyStore, JobStore, JobRunner,
+)
+
+def _reset_after_fork() -> None:
+    global executor, _warm_up_lock, _warm_up_pid
+    # 親のスレッドはフォーク先に存在しないため、ロックもスレッドプールも新しくする
+    executor = ThreadPoolExecutor(max_workers=10)
+    for cls in FORK_RESET_SINGLETONS:
+        cls._instance = None
+        if "_lock" in cls.__dict__:
+            cls._lock = threading.Lock()
+    for cls in (StageMetrics, TokenUsage, Lexicon, AnalysisProfile):
+        cls._lock = threading.Lock()
+    GeminiClient._model = None
+    _stage_semaphores.clear()
+    SystemInstructionCache._locks.clear()
+    # 親のイベントループに結び付いた実行中の音声合成は子では完了しない
+    _tts_flight._calls.clear()
+    _analysis_flight._calls.clear()
+    _warm_up_lock = threading.Lock()
+    _warm_up_pid = None
+    # ここではウォームアップしない（multiprocessingやサブプロセスの起動など、サーバーのワーカー以外のフォークでも呼ばれる）
+    # ワーカーは最初のリクエストで ensure_warm_up() からウォームアップする
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import typing
+import uuid
+from types import SimpleNamespace
+
+from google.genai import types
+from pydantic import BaseModel
+
+from main import NullTTSBackend
+
+# オフライン動作確認用のスタブ（Gemini は GEMINI_CLIENT=stub で有効、TTS・Notion はベンチマークから差し替え）
+# 実際のAPIと同じ呼び出し方で、スキーマに沿ったダミーのJSONとトークン使用量を返す
+
+# 遅延にばらつきを加える（STUB_LATENCY_JITTER は遅延に対する割合）
+def jittered(latency: float) -> float:
+    jitter = float(os.environ.get("STUB_LATENCY_JITTER", "0"))
+    return max(0.0, latency * (1 + random.uniform(-jitter, jitter)))
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+def _extract(pattern: str, text: str, default: str) -> str:
+    match = re.search(pattern, text)
+    return match.group(1) if match else default
+
+# スキーマの型に合わせたダミー値を作る（words は複数単語の分析で単語ごとの要素になる）
+def stub_value(name: str, annotation, word: str, sentence: str, words=None):
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+    if origin is typing.Union:
+        non_none = [arg for arg in args if arg is not type(None)]
+        return stub_value(name, non_none[0], word, sentence, words) if non_none else None
+    if origin in (list, typing.List):
+        if name == "words" and words:
+            return [stub_value(name, args[0], target, sentence) for target in words]
+        return [stub_value(name, args[0], word, sentence)] if args else []
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return build_stub_object(annotation, word, sentence)
+    if annotation is int:
+        return 3
+    if annotation is bool:
+        return False
+    if name == "example_sentence":
+        return f"I use {word} every day.（毎日{word}を使います。）"
+    if name == "word":
+        return word
+    return f"{name}: {word}"
+
+def build_stub_object(schema, word: str, sentence: str, words=None) -> dict:
+    return {
+        name: stub_value(name, field.annotation, word, sentence, words)
+        for name, field in schema.model_fields.items()
+    }
+
+class _StubResponse:
+    def __init__(self, text: str, usage_metadata, schema=None) -> None:
+        self.text = text
+        self.usage_metadata = usage_metadata
+        self.parsed = schema.model_validate_json(text) if schema is not None else None
+
+class _StubCaches:
+    def __init__(self, client) -> None:
+        self._client = client
+
+    async def create(self, *, model, config=None):
+        config = config or {}
+        name = f"cachedContents/stub-{uuid.uuid4().hex[:12]}"
+        self._client.cached_tokens[name] = estimate_tokens(config.get("system_instruction", ""))
+        return SimpleNamespace(name=name, model=model)
+
+    async def delete(self, *, name, config=None):
+        self._client.cached_tokens.pop(name, None)
+
+class _StubAsyncModels:
+    def __init__(self, client) -> None:
+        self._client = client
+
+    async def generate_content(self, *, model, contents, config=None):
+        await asyncio.sleep(jittered(self._client.latency))
+        self._client.check_cache(config)
+        text, usage = self._client.render(contents, config)
+        return _StubResponse(text, usage, (config or {}).get("response_schema"))
+
+    async def generate_content_stream(self, *, model, contents, config=None):
+        self._client.check_cache(config)
+        text, usage = self._client.render(contents, config)
+        chunk_size = self._client.chunk_size
+        chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+        per_chunk = jittered(self._client.latency) / max(1, len(chunks))
+
+        async def stream():
+            for index, chunk in enumerate(chunks):
+                await asyncio.sleep(per_chunk)
+                # 使用量は最後のチャンクにだけ入る
+                yield _StubResponse(chunk, usage if index == len(chunks) - 1 else None)
+
+        return stream()
+
+class _StubModels:
+    def __init__(self, client) -> None:
+        self._client = client
+
+    def generate_content(self, *, model, contents, config=None):
+        time.sleep(jittered(self._client.latency))
+        self._client.check_cache(config)
+        text, usage = self._client.render(contents, config)
+        return _StubResponse(text, usage, (config or {}).get("response_schema"))
+
+class StubGeminiClient:
+    def __init__(self, latency: float = None, chunk_size: int = 48) -> None:
+        if latency is None:
+            latency = float(os.environ.get("STUB_GEMINI_LATENCY", "0"))
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.cached_tokens = {}
+        self.models = _StubModels(self)
+        self.aio = SimpleNamespace(models=_StubAsyncModels(self), caches=_StubCaches(self))
+
+    # 期限切れ・削除されたコンテキストキャッシュを指定すると、実際のAPIと同じく404を返す
+    def check_cache(self, config) -> None:
+        cache_name = (config or {}).get("cached_content")
+        if cache_name is not None and cache_name not in self.cached_tokens:
+            import httpx
+            from google.genai import errors
+            raise errors.ClientError(404, httpx.Response(404, json={
+                "error": {"code": 404, "message": "CachedContent not found (or permission denied)", "status": "NOT_FOUND"},
+            }))
+
+    def render(self, contents, config):
+        config = config or {}
+        prompt = contents if isinstance(contents, str) else json.dumps(contents, ensure_ascii=False, default=str)
+        words = re.findall(r"対象単語「(.+?)」", prompt) or ["word"]
+        word = words[0]
+        sentence = _extract(r"セリフ英文「(.+?)」", prompt, "")
+        schema = config.get("response_schema")
+        payload = build_stub_object(schema, word, sentence, words) if schema is not None else {"text": word}
+        text = json.dumps(payload, ensure_ascii=False)
+
+        cached = self.cached_tokens.get(config.get("cached_content"), 0)
+        system_tokens = estimate_tokens(config.get("system_instruction") or "")
+        usage = types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=estimate_tokens(prompt) + system_tokens + cached,
+            candidates_token_count=estimate_tokens(text),
+            cached_content_token_count=cached or None,
+        )
+        return text, usage
+
+# gTTSの代わりに、合成にかかる時間だけ待ってから TTS_ENGINE=null と同じ無音MP3を返す
+class StubTTS(NullTTSBackend):
+    def __init__(self, latency: float = None) -> None:
+        if latency is None:
+            latency = float(os.environ.get("STUB_TTS_LATENCY", "0"))
+        self.latency = latency
+
+    async def synthesize(self, text: str, lang: str) -> bytes:
+        await asyncio.sleep(jittered(self.latency))
+        return await super().synthesize(text, lang)
+
+# Notion APIの代わりに、常に200を返すrequests.Session互換のスタブ
+class StubNotionSession:
+    def __init__(self, latency: float = None) -> None:
+        if latency is None:
+            latency = float(os.environ.get("STUB_NOTION_LATENCY", "0"))
+        self.latency = latency
+        self.posted = 0
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        time.sleep(jittered(self.latency))
+        self.posted += 1
+        return SimpleNamespace(status_code=200, text="{}", headers={})
@@ -0,0 +1,88 @@
+import re
+from typing import Iterable, List, Set
+
+# 字幕ファイル（.srt / .vtt）からセリフと分析候補の単語を取り出す
+
+TIMESTAMP_LINE = re.compile(r"^\s*(\d{1,2}:)?\d{1,2}:\d{2}[.,]\d{3}\s*-->")
+MARKUP = re.compile(r"<[^>]*>|\{[^}]*\}")
+WORD_PATTERN = re.compile(r"[A-Za-z]+(?:['’][A-Za-z]+)*")
+
+# 字幕の各キューを1つのセリフ英文にする（番号・タイムスタンプ・タグを除き、複数行は1行にまとめる）
+def parse_subtitles(text: str) -> List[str]:
+    sentences = []
+    for block in re.split(r"\r?\n\s*\r?\n", text.replace("﻿", "")):
+        lines = [line.strip() for line in block.strip().splitlines()]
+        if not lines or lines[0].startswith(("WEBVTT", "NOTE", "STYLE", "REGION")):
+            continue
+        text_lines = []
+        seen_timestamp = False
+        for line in lines:
+            if TIMESTAMP_LINE.match(line):
+                seen_timestamp = True
+                continue
+            # タイムスタンプより前の行はキュー番号・キューID
+            if seen_timestamp and line:
+                text_lines.append(MARKUP.sub("", line))
+        sentence = " ".join(" ".join(text_lines).split())
+        if sentence and (not sentences or sentences[-1] != sentence):
+            sentences.append(sentence)
+    return sentences
+
+# 既知語リストがなくても事前分析しない、会話で特によく使う単語（原形で持ち、語形変化は base_forms で照合する）
+COMMON_WORDS = frozenset("""
+about above across actually after again against ago almost alone along already also always another answer anybody anyone
+anything anyway anywhere around away baby back be because become been before begin behind being believe best better
+between both bring brother build business busy call came care carry case cause change check child children city
+class clean clear close come coming could course cover dad daddy dead deal dear decide different does
+doing done door down dream dress drink drive during each early easy else end enough even ever every everybody
+everyone everything exactly face fact family father feel fight figure find fine finish first follow food for forget
+free friend from front full funny game gave get girl give goes going gone good great group guess guys hair half hand
+happen happy hard have head hear heard heart help here hey high himself hold home hope hour house however idea into
+just keep kill kind knew know last late later least leave left less life like line listen little live long look lose
+lost love made make many matter maybe mean meet mind miss moment money month more morning most mother move much
+must myself name need never news next nice night nobody none nothing number okay once only open order other over own
+party past people person phone pick place plan play please point pretty problem pull push put question quite read
+ready real really reason remember right room said same saying school second seem seen sell send sense should show
+side since sister sleep small some somebody someone something sometimes soon sorry sound speak stand start stay still
+stop story sure take talk team tell than thank thanks that their them then there these they thing think this those
+though thought through time today together told tomorrow tonight took true trust trying turn under understand until
+upon very wait walk want watch water week well went were what whatever when where whether which while white whole
+why wife will wish with without woman women wonder word work world worry would write wrong yeah year years yes
+yesterday your yourself
+""".split())
+
+def load_known_words(path: str) -> Set[str]:
+    if not path:
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.strip().lower() for line in f if line.strip() and not line.startswith("#")}
+
+# 語形変化（複数形・過去形・進行形など）を既知語と照合するための候補
+def base_forms(word: str) -> List[str]:
+    forms = [word]
+    if word.endswith(("'s", "’s")):
+        forms.append(word[:-2])
+    for suffix, replacement in [("ies", "y"), ("es", ""), ("s", ""), ("ied", "y"), ("ed", ""), ("ed", "e"), ("ing", ""), ("ing", "e"), ("er", ""), ("est", ""), ("ly", "")]:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 2:
+            stem = word[:-len(suffix)]
+            forms.append(stem + replacement)
+            # 子音を重ねる形（stopped → stop）
+            if len(stem) >= 3 and stem[-1] == stem[-2]:
+                forms.append(stem[:-1])
+    return forms
+
+# 既知語リストにない単語を、セリフ内の出現順に重複なく返す
+def candidate_words(sentence: str, known_words: Iterable[str], min_length: int = 4) -> List[str]:
+    known_words = known_words if isinstance(known_words, (set, frozenset)) else set(known_words)
+    candidates = []
+    seen = set()
+    for token in WORD_PATTERN.findall(sentence):
+        lower = token.lower()
+        # 短縮形（can't・it's など）は機能語のため対象外
+        if "'" in lower or "’" in lower or len(lower) < min_length or lower in seen:
+            continue
+        seen.add(lower)
+        if any(form in known_words for form in base_forms(lower)):
+            continue
+        candidates.append(token)
+    return candidates
@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# オフラインで動かすための環境変数（Gemini・TTSはスタブ、キャッシュとログは無効）
+OFFLINE_ENV = {
+    "GEMINI_CLIENT": "stub",
+    "TTS_ENGINE": "null",
+    "ANALYSIS_CACHE_DB": "",
+    "AUDIO_CACHE_DIR": "",
+    "REQUEST_LOG": "false",
+    "USE_NOTION": "false",
+}
+
+# テストから直接 main をインポートする場合もオフラインで動かす
+os.environ.update(OFFLINE_ENV)
+
+# main はインポート時に環境変数を読むため、設定ごとに別プロセスで実行する
+@pytest.fixture
+def run_python(tmp_path):
+    def run(code, timeout=60, **env):
+        completed = subprocess.run(
+            [sys.executable, "-c", textwrap.dedent(code)],
+            cwd=ROOT,
+            env={**os.environ, **OFFLINE_ENV, "JOB_STORE_DB": str(tmp_path / "jobs.sqlite3"), **env},
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+        assert completed.returncode == 0, completed.stderr
+        return completed.stdout
+    return run
@@ -0,0 +1,93 @@
+import base64
+import io
+import json
+import sqlite3
+import zipfile
+
+from apkg import NOTE_FIELDS, stream_apkg
+
+def read_package(data: bytes, tmp_path):
+    with zipfile.ZipFile(io.BytesIO(data)) as package:
+        media = json.loads(package.read("media"))
+        files = {name: package.read(entry) for entry, name in media.items()}
+        db_path = tmp_path / "collection.anki2"
+        db_path.write_bytes(package.read("collection.anki2"))
+    conn = sqlite3.connect(db_path)
+    notes = [dict(zip(NOTE_FIELDS, row[0].split("\x1f"))) for row in conn.execute("SELECT flds FROM notes")]
+    decks = json.loads(conn.execute("SELECT decks FROM col").fetchone()[0])
+    conn.close()
+    return files, notes, decks
+
+def test_package_bundles_sentence_and_example_audio(tmp_path):
+    card = {
+        "word": "running",
+        "tag": "Suits",
+        "sentence": "I was running late.",
+        "highlighted_sentence": "I was ==running== late.",
+        "unique_file_name": "card-1",
+        "target_deck": "English::Frequent",
+        "ex_sentence_english": "She is running a company.",
+        "audio_base64": base64.b64encode(b"sentence-mp3").decode("ascii"),
+        "ex_audio_base64": base64.b64encode(b"example-mp3").decode("ascii"),
+    }
+    files, notes, decks = read_package(b"".join(stream_apkg([card])), tmp_path)
+    assert files == {"card-1.mp3": b"sentence-mp3", "card-1_example.mp3": b"example-mp3"}
+    assert len(notes) == 1
+    note = notes[0]
+    assert note["Sentence"] == "I was <b>running</b> late."
+    assert note["Voice"] == "[sound:card-1.mp3]"
+    assert note["ExampleSentence"] == "She is running a company. [sound:card-1_example.mp3]"
+    assert "English::Frequent" in [deck["name"] for deck in decks.values()]
+
+def test_package_without_audio_has_no_media(tmp_path):
+    card = {"word": "keep", "sentence": "Keep it up.", "unique_file_name": "card-2", "ex_sentence_english": "Keep going."}
+    files, notes, _ = read_package(b"".join(stream_apkg([card])), tmp_path)
+    assert files == {}
+    assert notes[0]["Voice"] == "" and notes[0]["ExampleSentence"] == "Keep going."
+
+# バッチの.apkgには、生成したカードのセリフと例文の音声が両方入る
+def test_batch_package_contains_generated_cards(run_python, tmp_path):
+    output = run_python("""
+        import base64, sys
+        import main
+        items = [
+            {"sentence": "I was running late.", "word": "running", "tag": "Test"},
+            {"sentence": "Keep it up.", "word": "keep", "tag": "Test"},
+        ]
+        sys.stdout.write(base64.b64encode(b"".join(main.stream_batch_apkg(items))).decode("ascii"))
+    """, TTS_ENGINE="stub")
+    files, notes, _ = read_package(base64.b64decode(output), tmp_path)
+    assert sorted(note["Word"] for note in notes) == ["keep", "running"]
+    assert len(files) == 4
+    assert all(note["Voice"].startswith("[sound:") and "[sound:" in note["ExampleSentence"] for note in notes)
+
+# MP3はカードを追加するたびに書き出され、パッケージを閉じる前に届く
+def test_stream_yields_media_before_close(tmp_path):
+    def card(index, payload):
+        return {
+            "word": f"word{index}",
+            "sentence": f"Sentence {index}.",
+            "unique_file_name": f"card-{index}",
+            "audio_base64": base64.b64encode(payload).decode("ascii"),
+        }
+    first_audio = b"first-mp3-" * 100
+    second_audio = b"second-mp3-" * 100
+    produced = []
+    def cards():
+        produced.append(1)
+        yield card(1, first_audio)
+        produced.append(2)
+        yield card(2, second_audio)
+    stream = stream_apkg(cards())
+    chunks = [next(stream)]
+    assert produced == [1]
+    assert first_audio in chunks[0] and b"PK" in chunks[0]
+    chunks.append(next(stream))
+    assert produced == [1, 2]
+    assert second_audio in chunks[1] and first_audio not in chunks[1]
+    chunks.extend(stream)
+    # 最後のチャンク（コレクションと中央ディレクトリ）には音声を含まない
+    assert len(chunks) == 3 and second_audio not in chunks[2]
+    files, notes, _ = read_package(b"".join(chunks), tmp_path)
+    assert files == {"card-1.mp3": first_audio, "card-2.mp3": second_audio}
+    assert [note["Word"] for note in notes] == ["word1", "word2"]
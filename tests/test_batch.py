@@ -0,0 +1,29 @@
+import json
+
+# バッチエンドポイントを使わずにルートパスへJSON配列を送っても ?format=apkg が効く
+def test_root_json_array_honors_apkg_format(run_python):
+    output = run_python("""
+        import json
+        import flask
+        import main
+        app = flask.Flask(__name__)
+        items = [{"sentence": "I was running late.", "word": "running", "tag": "Test"}]
+        with app.test_request_context("/?format=apkg", method="POST", json=items):
+            response = main.main_function(flask.request)
+            body = b"".join(response.response)
+        print(json.dumps({"mimetype": response.mimetype, "zip": body[:2] == b"PK"}))
+    """)
+    assert json.loads(output.splitlines()[-1]) == {"mimetype": "application/apkg", "zip": True}
+
+def test_root_json_array_defaults_to_ndjson(run_python):
+    output = run_python("""
+        import flask
+        import main
+        app = flask.Flask(__name__)
+        items = [{"sentence": "I was running late.", "word": "running", "tag": "Test"}]
+        with app.test_request_context("/", method="POST", json=items):
+            response = main.main_function(flask.request)
+            lines = "".join(response.response).splitlines()
+        print(response.mimetype, len(lines))
+    """)
+    assert output.splitlines()[-1].split() == ["application/x-ndjson", "1"]
@@ -0,0 +1,90 @@
+import json
+import os
+import sqlite3
+
+from main import AnalysisCache, AudioCache, audio_cache_key
+
+def test_audio_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = AudioCache(str(tmp_path), 0, 2500)
+    for key in ("a", "b"):
+        cache.set(key, b"x" * 1000)
+    # 読んだファイルは最近使ったものとして残る
+    assert cache.get("a") == b"x" * 1000
+    cache.set("c", b"x" * 1000)
+    assert sorted(os.listdir(tmp_path)) == ["a.mp3", "c.mp3"]
+    assert cache.snapshot()["disk_bytes"] == 2000
+    assert cache.snapshot()["disk_evictions"] == 1
+
+def test_audio_disk_cache_counts_existing_files(tmp_path):
+    for key in ("old", "new"):
+        (tmp_path / f"{key}.mp3").write_bytes(b"x" * 1000)
+    os.utime(tmp_path / "old.mp3", (0, 0))
+    cache = AudioCache(str(tmp_path), 0, 2500)
+    cache.set("next", b"x" * 1000)
+    assert sorted(os.listdir(tmp_path)) == ["new.mp3", "next.mp3"]
+
+def test_analysis_cache_keeps_newest_rows(tmp_path):
+    db_path = str(tmp_path / "analysis.sqlite3")
+    cache = AnalysisCache(db_path, 0, 50)
+    for index in range(AnalysisCache.prune_interval):
+        cache.set(f"key-{index}", {"index": index})
+    with sqlite3.connect(db_path) as conn:
+        keys = [row[0] for row in conn.execute("SELECT key FROM analysis ORDER BY rowid")]
+    assert keys == [f"key-{index}" for index in range(50, 100)]
+    assert cache.get("key-99") == {"index": 99}
+    assert cache.get("key-0") is None
+
+def test_audio_cache_key_ignores_whitespace_but_not_lang_or_engine():
+    assert audio_cache_key("Keep it\n up.", "en", "gtts") == audio_cache_key("Keep it up.", "en", "gtts")
+    assert audio_cache_key("Keep it up.", "en", "gtts") != audio_cache_key("Keep it up.", "ja", "gtts")
+    assert audio_cache_key("Keep it up.", "en", "gtts") != audio_cache_key("Keep it up.", "en", "null")
+
+def test_audio_cache_reads_back_from_disk(tmp_path):
+    AudioCache(str(tmp_path), 1024, 4096).set("key", b"mp3")
+    # 別のインスタンス（再起動後）はメモリにないのでディスクから読む
+    cache = AudioCache(str(tmp_path), 1024, 4096)
+    assert cache.get("key") == b"mp3"
+    assert cache.get("key") == b"mp3"
+    assert cache.get("missing") is None
+    stats = cache.snapshot()
+    assert (stats["disk_hits"], stats["memory_hits"], stats["misses"]) == (1, 1, 1)
+
+# 同じ文の音声合成は同時に何件来ても1回だけ行い、終わった後はキャッシュから返す
+def test_identical_texts_are_synthesized_once(run_python):
+    output = run_python("""
+        import asyncio, json
+        import main
+        backend = main.TTSBackend.get_instance()
+        original = backend.synthesize
+        calls = []
+
+        async def synthesize(text, lang):
+            calls.append(text)
+            await asyncio.sleep(0.1)
+            return await original(text, lang)
+
+        backend.synthesize = synthesize
+
+        async def scenario():
+            audios = await asyncio.gather(*(main.synthesize_speech(text) for text in ["Keep it up.", "Keep it  up.", "Keep it up."]))
+            again = await main.synthesize_speech("Keep it up.")
+            return len(set(audios)) == 1 and again == audios[0]
+
+        same = main.EventLoopThread.get_instance().run(scenario())
+        print(json.dumps({"calls": calls, "same": same}))
+    """, AUDIO_CACHE_DIR="")
+    assert json.loads(output.splitlines()[-1]) == {"calls": ["Keep it up."], "same": True}
+
+# キャッシュした音声を使っても、Obsidianの埋め込み名はカードごとに異なる
+def test_cached_audio_keeps_per_card_embed_names(run_python):
+    output = run_python("""
+        import json
+        import main
+        cards = [main.generate_card("I was running late.", "running", "Test", False) for _ in range(2)]
+        print(json.dumps({
+            "names": len({card["unique_file_name"] for card in cards}),
+            "audio": len({card["audio_base64"] for card in cards}),
+            "hits": main.AudioCache.get_instance().snapshot()["memory_hits"],
+        }))
+    """)
+    assert json.loads(output.splitlines()[-1]) == {"names": 2, "audio": 1, "hits": 2}
@@ -0,0 +1,82 @@
+import json
+
+def test_lite_card_fills_japanese_from_contextual_translation(run_python):
+    output = run_python("""
+        import json
+        import main
+        card = main.generate_card("I was running late.", "running", "Test", False, "reference", main.AnalysisProfile.get("lite"))
+        fields = dict(line.split(": ", 1) for line in card["anki_template"].splitlines() if ": " in line)
+        print(json.dumps(fields))
+    """)
+    fields = json.loads(output)
+    assert fields["Japanese"] == "contextual_translation: running"
+    assert fields["NaturalJapanese"] == "contextual_translation: running"
+
+def test_full_card_uses_precise_translation(run_python):
+    output = run_python("""
+        import main
+        card = main.generate_card("I was running late.", "running", "Test", False, "reference")
+        print([line for line in card["anki_template"].splitlines() if line.startswith("Japanese:")][0])
+    """)
+    assert output.strip() == "Japanese: precise_translation: running"
+
+def test_multipart_skips_evicted_audio(run_python):
+    output = run_python("""
+        import json
+        import main
+        store = main.AudioStore.get_instance()
+        audio_id = store.put(b"mp3")
+        result = {"unique_file_name": "card", "audio_id": audio_id, "audio_url": "/audio/a", "ex_audio_id": "missing", "ex_audio_url": "/audio/b"}
+        response = main.multipart_response(result)
+        body = response.get_data()
+        print(json.dumps({"parts": body.count(b"Content-Type: audio/mpeg"), "card": result}))
+    """)
+    data = json.loads(output.splitlines()[-1])
+    assert data["parts"] == 1
+    assert data["card"] == {"unique_file_name": "card", "audio_part": "audio"}
+
+def test_multi_word_prompt_matches_single_word_layout(run_python):
+    output = run_python("""
+        import json
+        import main
+        sentence = "Keep {it} up, you're running late."
+        print(json.dumps({
+            "single": main.create_multi_word_prompt(sentence, ["running"], "Test") == main.create_prompt(sentence, "running", "Test"),
+            "multi": main.create_multi_word_prompt(sentence, ["keep up", "running"], "Other"),
+        }))
+    """)
+    result = json.loads(output)
+    assert result["single"] is True
+    assert result["multi"] == "\n<input>\nセリフ英文「Keep {it} up, you're running late.」\n対象単語「keep up」\n対象単語「running」\n</input>\n"
+
+# 複数単語のうち1つの例文音声が失敗したら、他の単語の音声合成を取り消してすぐにエラーを返す
+def test_multi_word_failure_cancels_sibling_audio(run_python):
+    output = run_python("""
+        import asyncio, json, time
+        import main
+        state = {"examples": 0, "cancelled": 0}
+
+        async def timed_speech(stage, text):
+            if stage == "tts_sentence":
+                return b"sentence"
+            state["examples"] += 1
+            if state["examples"] == 1:
+                await asyncio.sleep(0.05)
+                raise main.HTTPException(500, "TTS failed")
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                state["cancelled"] += 1
+                raise
+
+        main._timed_speech = timed_speech
+        start = time.monotonic()
+        try:
+            main.generate_cards("I was running late, keep it up.", ["running", "keep"], "Test", False)
+        except main.HTTPException as e:
+            state["status"] = e.status_code
+        time.sleep(0.1)
+        state["fast"] = time.monotonic() - start < 2
+        print(json.dumps(state))
+    """)
+    assert json.loads(output.splitlines()[-1]) == {"examples": 2, "cancelled": 1, "status": 500, "fast": True}
@@ -0,0 +1,45 @@
+import json
+
+# サーバー側でコンテキストキャッシュが消えていても、キャッシュなしで呼び直して成功し、次の呼び出しで作り直す
+def test_stale_context_cache_is_evicted_and_retried(run_python):
+    output = run_python("""
+        import json
+        import main
+        client, model = main.GeminiClient.get_instance()
+        main.generate_card("I was running late.", "running", "Test", False, "reference")
+        before = dict(main.SystemInstructionCache._entries)
+        client.cached_tokens.clear()
+        card = main.generate_card("Keep it up.", "keep", "Test", False, "reference")
+        card_after = main.generate_card("Hold on.", "hold", "Test", False, "reference")
+        after = dict(main.SystemInstructionCache._entries)
+        print(json.dumps({
+            "words": [card["word"], card_after["word"]],
+            "recreated": all(after[key][0] != before[key][0] and after[key][0] in client.cached_tokens for key in before),
+        }))
+    """)
+    assert json.loads(output.splitlines()[-1]) == {"words": ["keep", "hold"], "recreated": True}
+
+def test_stale_context_cache_is_retried_when_streaming(run_python):
+    output = run_python("""
+        import json
+        import main
+        client, _ = main.GeminiClient.get_instance()
+        main.generate_card("I was running late.", "running", "Test", False, "reference")
+        client.cached_tokens.clear()
+        card = main.generate_card("Keep it up.", "keep", "Test", False, "reference")
+        print(json.dumps(card["word"]))
+    """, GEMINI_STREAMING="true")
+    assert json.loads(output.splitlines()[-1]) == "keep"
+
+# プロファイルの組み合わせが増えても、キャッシュの数は上限までで、追い出したものはサーバーからも消す
+def test_context_cache_variants_are_capped(run_python):
+    output = run_python("""
+        import json
+        import main
+        client, _ = main.GeminiClient.get_instance()
+        fields = ["contextual_translation", "example_sentence", "ipa", "part_of_speech", "english_definition", "japanese_meaning"]
+        for size in range(1, len(fields) + 1):
+            main.generate_card("I was running late.", "running", "Test", False, "reference", main.AnalysisProfile.get(None, fields[:size]))
+        print(json.dumps({"entries": len(main.SystemInstructionCache._entries), "remote": len(client.cached_tokens)}))
+    """, GEMINI_CONTEXT_CACHE_MAX_ENTRIES="3")
+    assert json.loads(output.splitlines()[-1]) == {"entries": 3, "remote": 3}
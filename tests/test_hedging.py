@@ -0,0 +1,52 @@
+import json
+
+def test_cancelled_slow_call_is_recorded_and_hedge_cache_is_prewarmed(run_python):
+    output = run_python("""
+        import asyncio, json
+        import main
+        main.warm_up()
+        client, model = main.GeminiClient.get_instance()
+        prewarmed = sorted(key for key in main.SystemInstructionCache._entries if key.startswith("fallback-model:"))
+        original = client.aio.models.generate_content
+
+        async def generate_content(*, model, contents, config=None):
+            await asyncio.sleep(1.0 if model == main.SETTINGS.gemini_model else 0.05)
+            return await original(model=model, contents=contents, config=config)
+
+        client.aio.models.generate_content = generate_content
+        main.generate_card("I was running late.", "running", "Test", False, "reference")
+        snapshot = main.EventLoopThread.get_instance().run(asyncio.sleep(0.1, main.GeminiHedger.snapshot()))
+        print(json.dumps({"prewarmed": prewarmed, "snapshot": snapshot, "model": model}))
+    """, GEMINI_HEDGE="true", GEMINI_HEDGE_MODEL="fallback-model", GEMINI_HEDGE_DELAY="0.2", GEMINI_HEDGE_BUDGET="1")
+    result = json.loads(output)
+    assert len(result["prewarmed"]) == 2
+    models = result["snapshot"]["models"]
+    primary = models[result["model"]]
+    assert primary["cancelled"] == 1
+    # 負けた呼び出しも、取り消すまでの経過時間（ヘッジまでの待ち時間以上）が標本に入る
+    assert primary["samples"] == 1 and primary["p50"] >= 0.2
+    assert models["fallback-model"]["wins"] == 1
+
+# 複製を送らなかったリクエストでは、複製先のモデルのシステム指示キャッシュを作らない
+def test_hedge_cache_is_created_only_when_a_hedge_fires(run_python):
+    output = run_python("""
+        import asyncio, json
+        import main
+        client, model = main.GeminiClient.get_instance()
+        original = client.aio.models.generate_content
+        delay = {"primary": 0.0}
+
+        async def generate_content(*, model, contents, config=None):
+            if model == main.SETTINGS.gemini_model:
+                await asyncio.sleep(delay["primary"])
+            return await original(model=model, contents=contents, config=config)
+
+        client.aio.models.generate_content = generate_content
+        hedge_entries = lambda: [key for key in main.SystemInstructionCache._entries if key.startswith("fallback-model:")]
+        main.generate_card("I was running late.", "running", "Test", False, "reference")
+        before = len(hedge_entries())
+        delay["primary"] = 1.0
+        main.generate_card("Keep it up.", "keep", "Test", False, "reference")
+        print(json.dumps({"before": before, "after": len(hedge_entries())}))
+    """, GEMINI_HEDGE="true", GEMINI_HEDGE_MODEL="fallback-model", GEMINI_HEDGE_DELAY="0.2", GEMINI_HEDGE_BUDGET="1")
+    assert json.loads(output.splitlines()[-1]) == {"before": 0, "after": 1}
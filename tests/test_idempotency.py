@@ -0,0 +1,119 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from flask import Response
+
+from main import HTTPException, IdempotencyStore
+
+def responder(calls, body=b'{"ok": true}', status=200, wait=None):
+    def compute():
+        calls.append(1)
+        if wait is not None:
+            wait.wait(5)
+        return Response(body, status=status, content_type="application/json")
+    return compute
+
+def test_completed_result_is_replayed():
+    store = IdempotencyStore(60, 1_000_000)
+    calls = []
+    first, first_outcome = store.run("key:a", "fp", responder(calls))
+    second, second_outcome = store.run("key:a", "fp", responder(calls))
+    assert (first_outcome, second_outcome) == ("computed", "replayed")
+    assert second.get_data() == first.get_data() and second.content_type == "application/json"
+    assert len(calls) == 1
+
+# 実行中の同じリクエストは結果を待って共有する
+def test_in_flight_request_is_coalesced():
+    store = IdempotencyStore(60, 1_000_000)
+    calls = []
+    release = threading.Event()
+    with ThreadPoolExecutor(2) as executor:
+        first = executor.submit(store.run, "key:a", "fp", responder(calls, wait=release))
+        while store.snapshot()["in_flight"] == 0:
+            time.sleep(0.01)
+        second = executor.submit(store.run, "key:a", "fp", responder(calls))
+        while store.snapshot()["coalesced"] == 0:
+            time.sleep(0.01)
+        release.set()
+        outcomes = {first.result()[1], second.result()[1]}
+    assert outcomes == {"computed", "coalesced"}
+    assert len(calls) == 1
+    assert store.snapshot()["in_flight"] == 0
+
+def test_reused_key_with_different_body_is_rejected():
+    store = IdempotencyStore(60, 1_000_000)
+    store.run("key:a", "fp-1", responder([]))
+    with pytest.raises(HTTPException) as excinfo:
+        store.run("key:a", "fp-2", responder([]))
+    assert excinfo.value.status_code == 422
+
+def test_reused_key_while_in_flight_is_rejected():
+    store = IdempotencyStore(60, 1_000_000)
+    release = threading.Event()
+    with ThreadPoolExecutor(1) as executor:
+        first = executor.submit(store.run, "key:a", "fp-1", responder([], wait=release))
+        while store.snapshot()["in_flight"] == 0:
+            time.sleep(0.01)
+        with pytest.raises(HTTPException) as excinfo:
+            store.run("key:a", "fp-2", responder([]))
+        release.set()
+        assert first.result()[1] == "computed"
+    assert excinfo.value.status_code == 422
+
+# 失敗とエラー応答は保存せず、再送時に作り直す
+def test_failures_are_not_stored():
+    store = IdempotencyStore(60, 1_000_000)
+    def fail():
+        raise RuntimeError("boom")
+    with pytest.raises(RuntimeError):
+        store.run("key:a", "fp", fail)
+    calls = []
+    store.run("key:a", "fp", responder(calls, status=500))
+    _, outcome = store.run("key:a", "fp", responder(calls))
+    assert outcome == "computed"
+    assert len(calls) == 2
+
+def test_results_expire():
+    store = IdempotencyStore(-1, 1_000_000)
+    calls = []
+    store.run("key:a", "fp", responder(calls))
+    assert store.run("key:a", "fp", responder(calls))[1] == "computed"
+    assert len(calls) == 2
+
+# HTTP経由：再送にはIdempotent-Replayedヘッダーが付き、キーの使い回しは422になる
+def test_http_replay_and_conflict(run_python):
+    output = run_python("""
+        import json
+        import flask
+        import main
+        app = flask.Flask(__name__)
+        results = []
+        def send(body, key="capture-1"):
+            with app.test_request_context("/", method="POST", json=body, headers={"Idempotency-Key": key}):
+                response = main.main_function(flask.request)
+                if isinstance(response, tuple):
+                    response, status = response
+                else:
+                    status = response.status_code
+                results.append([status, response.headers.get("Idempotent-Replayed"), response.get_json()])
+        card = {"sentence": "I was running late.", "word": "running", "tag": "Test"}
+        send(card)
+        send(card)
+        send({**card, "word": "late"})
+        print(json.dumps({
+            "statuses": [result[0] for result in results],
+            "replayed": [result[1] for result in results],
+            "same": results[0][2] == results[1][2],
+            "error": results[2][2],
+            "stats": main.IdempotencyStore.get_instance().snapshot(),
+        }))
+    """)
+    result = json.loads(output.splitlines()[-1])
+    assert result["statuses"] == [200, 200, 422]
+    assert result["replayed"] == [None, "true", None]
+    assert result["same"]
+    assert "Idempotency-Key" in result["error"]["error"]
+    assert result["stats"]["computed"] == 1
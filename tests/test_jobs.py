@@ -0,0 +1,194 @@
+import json
+import threading
+import time
+
+import pytest
+
+from main import HTTPException, JobRunner, JobStore, MemoryJobStore, SQLiteJobStore, TTSBackend
+
+def wait_for_job(store, job_id, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = store.get(job_id)
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} did not finish")
+
+def test_submit_returns_snapshot_not_running_job():
+    store = MemoryJobStore()
+    runner = JobRunner(store, 1, 10)
+    job, created = runner.submit({"sentence": "I was running late.", "word": "running", "tag": "Test"}, None, "fingerprint")
+    assert created
+    finished = wait_for_job(store, job["job_id"])
+    assert finished["status"] == "succeeded"
+    # 実行中に書き換えられたジョブではなく、受け付けた時点の状態のまま
+    assert job["status"] == "queued"
+    assert "result" not in job
+
+def test_memory_store_returns_copies():
+    store = MemoryJobStore()
+    store.put({"job_id": "a", "status": "queued", "request": {"word": "x"}, "updated_at": 0.0})
+    job = store.get("a")
+    job["request"]["word"] = "changed"
+    assert store.get("a")["request"]["word"] == "x"
+
+def test_base_classes_are_abstract():
+    with pytest.raises(TypeError):
+        JobStore()
+    with pytest.raises(TypeError):
+        TTSBackend()
+
+def test_failed_job_is_requeued_on_resubmit():
+    store = MemoryJobStore()
+    runner = JobRunner(store, 1, 10)
+    request_dict = {"sentence": "I was running late.", "word": "running", "tag": "Test"}
+    # 一時的なエラーで失敗したジョブが残っている
+    job, created = runner.submit(request_dict, "body:abc", "abc")
+    failed = wait_for_job(store, job["job_id"])
+    failed.update(status="failed", error="Gemini API rate limit exceeded. Please retry later.", status_code=429)
+    store.put(failed)
+    retried, created = runner.submit(request_dict, "body:abc", "abc")
+    assert created
+    assert retried["job_id"] == job["job_id"]
+    assert retried["status"] == "queued"
+    assert wait_for_job(store, job["job_id"])["status"] == "succeeded"
+    # 成功したジョブはそのまま返す
+    replayed, created = runner.submit(request_dict, "body:abc", "abc")
+    assert not created and replayed["status"] == "succeeded"
+
+def test_expired_job_is_hidden_and_replaced(monkeypatch):
+    store = MemoryJobStore()
+    runner = JobRunner(store, 1, 10)
+    request_dict = {"sentence": "I was running late.", "word": "running", "tag": "Test"}
+    job, _ = runner.submit(request_dict, "body:old", "old")
+    wait_for_job(store, job["job_id"])
+    monkeypatch.setattr("main.SETTINGS.idempotency_ttl", 0.0)
+    time.sleep(0.01)
+    assert runner.get(job["job_id"]) is None
+    resubmitted, created = runner.submit(request_dict, "body:old", "old")
+    assert created and resubmitted["status"] == "queued"
+    wait_for_job(store, job["job_id"])
+
+def test_reused_key_with_different_body_is_rejected():
+    runner = JobRunner(MemoryJobStore(), 1, 10)
+    runner.submit({"sentence": "I was running late.", "word": "running", "tag": "Test"}, "key:k", "first")
+    with pytest.raises(HTTPException) as error:
+        runner.submit({"sentence": "Keep it up.", "word": "keep", "tag": "Test"}, "key:k", "second")
+    assert error.value.status_code == 422
+
+@pytest.fixture
+def sqlite_store_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "jobs.sqlite3")
+    monkeypatch.setattr("main.SETTINGS.job_store_db", path)
+    return path
+
+def stored_job(job_id, status, lease_until):
+    return {"job_id": job_id, "status": status, "request": {}, "fingerprint": job_id, "updated_at": time.time(), "lease_until": lease_until}
+
+# 同じデータベースを共有するワーカーが同時にやり直しても、期限切れのジョブは1つのワーカーだけが確保する
+def test_stale_jobs_are_claimed_by_one_worker(sqlite_store_path):
+    SQLiteJobStore().put(stored_job("live", "running", time.time() + 60))
+    for n in range(10):
+        SQLiteJobStore().put(stored_job(f"stale-{n}", "running", 0.0))
+    stores = [SQLiteJobStore() for _ in range(4)]
+    claimed = []
+    threads = [threading.Thread(target=lambda store=store: claimed.extend(store.claim_stale(time.time() + 60))) for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(job["job_id"] for job in claimed) == sorted(f"stale-{n}" for n in range(10))
+
+def test_recover_skips_jobs_running_in_another_worker(sqlite_store_path):
+    request_dict = {"sentence": "I was running late.", "word": "running", "tag": "Test"}
+    worker = JobRunner(SQLiteJobStore(), 1, 10)
+    running, _ = worker.submit(request_dict, None, "a")
+    store = SQLiteJobStore()
+    store.put({**stored_job("crashed", "running", 0.0), "request": request_dict})
+    sibling = JobRunner(store, 1, 10)
+    assert sibling.recover() == 1
+    assert wait_for_job(store, "crashed")["status"] == "succeeded"
+    assert wait_for_job(store, running["job_id"])["status"] == "succeeded"
+    # 確保したジョブは期限が延びているため、続けてやり直しても再び確保しない
+    assert sibling.recover() == 0
+
+def test_running_jobs_renew_their_lease(monkeypatch):
+    monkeypatch.setattr("main.SETTINGS.job_lease", 0.3)
+    store = MemoryJobStore()
+    runner = JobRunner(store, 1, 10)
+    job = stored_job("slow", "running", time.time() + 0.3)
+    runner._active["slow"] = job
+    store.put(job)
+    from main import EventLoopThread
+    future = EventLoopThread.get_instance().submit(runner._renew_leases())
+    time.sleep(0.5)
+    assert store.claim_stale(time.time() + 60) == []
+    runner._active.clear()
+    future.result(timeout=2)
+
+# HTTP経由：POST /jobs は202とLocationを返し、GET /jobs/{id} で結果を受け取る。完了するとwebhookに通知する
+def test_http_job_lifecycle_with_webhook(run_python):
+    output = run_python("""
+        import json
+        import threading
+        import time
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        import flask
+        import main
+
+        received = []
+        class Hook(BaseHTTPRequestHandler):
+            def do_POST(self):
+                received.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+                self.send_response(204)
+                self.end_headers()
+            def log_message(self, *args):
+                pass
+        server = HTTPServer(("127.0.0.1", 0), Hook)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        app = flask.Flask(__name__)
+        def call(method, path, body=None, headers=None):
+            with app.test_request_context(path, method=method, json=body, headers=headers or {}):
+                response = main.main_function(flask.request)
+                if isinstance(response, tuple):
+                    response, status = response
+                else:
+                    status = response.status_code
+                return status, response.headers, response.get_json()
+
+        card = {"sentence": "I was running late.", "word": "running", "tag": "Test", "webhook_url": f"http://127.0.0.1:{server.server_port}/hook"}
+        status, headers, job = call("POST", "/jobs", card, {"Idempotency-Key": "job-1"})
+        accepted = [status, headers["Location"], job["status"], job["status_url"], "request" in job]
+        replay_status, replay_headers, replay = call("POST", "/jobs", card, {"Idempotency-Key": "job-1"})
+        conflict_status, _, _ = call("POST", "/jobs", {**card, "word": "late"}, {"Idempotency-Key": "job-1"})
+        invalid_status, _, _ = call("POST", "/jobs", {**card, "webhook_url": "ftp://example.com"})
+
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            _, _, finished = call("GET", headers["Location"])
+            if finished.get("webhook"):
+                break
+            time.sleep(0.05)
+        missing_status, _, _ = call("GET", "/jobs/unknown")
+        print(json.dumps({
+            "accepted": accepted,
+            "job_id": job["job_id"],
+            "replay": [replay_status, replay_headers.get("Idempotent-Replayed"), replay["job_id"]],
+            "conflict": conflict_status,
+            "invalid": invalid_status,
+            "finished": [finished["status"], finished["result"]["word"], finished["webhook"]["status"]],
+            "received": [[hook["job_id"], hook["status"], hook["result"]["word"]] for hook in received],
+            "missing": missing_status,
+        }))
+    """, NO_PROXY="127.0.0.1", no_proxy="127.0.0.1")
+    result = json.loads(output.splitlines()[-1])
+    job_id = result["job_id"]
+    assert result["accepted"] == [202, f"/jobs/{job_id}", "queued", f"/jobs/{job_id}", False]
+    assert result["replay"] == [202, "true", job_id]
+    assert result["conflict"] == 422
+    assert result["invalid"] == 400
+    assert result["finished"] == ["succeeded", "running", "delivered"]
+    assert result["received"] == [[job_id, "succeeded", "running"]]
+    assert result["missing"] == 404
@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+from main import Lexicon, frequency_rating_from_rank
+
+ROWS = [
+    ("Run", "300", "/rʌn/", ""),
+    ("running", "2500", "/ˈrʌnɪŋ/", "run"),
+    ("oblivious", "", "/əˈblɪviəs/", ""),
+    ("apple", "900", "/ˈæpəl/", ""),
+    ("apple", "1200", "/ˈæp.əl/", ""),
+    ("bad\x1fword", "10", "", ""),
+]
+
+@pytest.fixture
+def lexicon_path(tmp_path):
+    path = str(tmp_path / "lexicon.idx")
+    Lexicon.build(ROWS, path)
+    return path
+
+def test_build_sorts_and_deduplicates(tmp_path):
+    path = str(tmp_path / "lexicon.idx")
+    # 区切り文字を含む行は除き、重複した単語は1件にまとめる
+    assert Lexicon.build(ROWS, path) == 4
+    lexicon = Lexicon(path)
+    assert lexicon.count == 4
+    assert [lexicon._record(index)[0] for index in range(lexicon.count)] == [b"apple", b"oblivious", b"run", b"running"]
+
+def test_lookup_is_case_insensitive(lexicon_path):
+    lexicon = Lexicon(lexicon_path)
+    assert lexicon.lookup("  RUN ") == {"lemma": "run", "rank": 300, "ipa": "/rʌn/"}
+    assert lexicon.lookup("walk") is None
+    assert lexicon.lookup("") is None
+
+# 同じ単語が複数ある場合は順位の高い方が残る
+def test_duplicate_keeps_best_rank(lexicon_path):
+    assert Lexicon(lexicon_path).lookup("apple") == {"lemma": "apple", "rank": 900, "ipa": "/ˈæpəl/"}
+
+# 活用形は見出し語の順位で頻度を判定する
+def test_inflection_uses_lemma_rank(lexicon_path):
+    assert Lexicon(lexicon_path).lookup("running") == {"lemma": "run", "rank": 300, "ipa": "/ˈrʌnɪŋ/"}
+
+def test_missing_rank_is_none(lexicon_path):
+    assert Lexicon(lexicon_path).lookup("oblivious") == {"lemma": "oblivious", "rank": None, "ipa": "/əˈblɪviəs/"}
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "not-a-lexicon.idx"
+    path.write_bytes(b"NOTALEX0" + b"\x00" * 8)
+    with pytest.raises(ValueError):
+        Lexicon(str(path))
+
+def test_rating_thresholds():
+    # デフォルトの LEXICON_RATING_RANKS は 1000,3000,8000,20000
+    assert [frequency_rating_from_rank(rank) for rank in (1, 1000, 1001, 3000, 8000, 20000, 20001)] == [5, 5, 4, 4, 3, 2, 1]
+
+# 辞書にある単語の頻度・発音記号は辞書の値になり、辞書がなければGeminiの値を使う
+def test_analysis_takes_fields_from_lexicon(run_python, lexicon_path, tmp_path):
+    code = """
+        import json
+        import main
+        async def analyze():
+            return [await main.analyze_word("I was running late.", word, "Test", False) for word in ("running", "walking")]
+        running, walking = main.EventLoopThread.get_instance().run(analyze())
+        print(json.dumps([[card["frequency_rating"], card["ipa"]] for card in (running, walking)], ensure_ascii=False))
+    """
+    with_lexicon = json.loads(run_python(code, LEXICON_PATH=lexicon_path, WARMUP="false").splitlines()[-1])
+    assert with_lexicon == [[5, "/ˈrʌnɪŋ/"], [3, "ipa: walking"]]
+    missing = run_python(code, LEXICON_PATH=str(tmp_path / "missing.idx"), WARMUP="false")
+    assert "Lexicon unavailable, falling back to Gemini" in missing
+    assert json.loads(missing.splitlines()[-1]) == [[3, "ipa: running"], [3, "ipa: walking"]]
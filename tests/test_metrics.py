@@ -0,0 +1,86 @@
+import json
+
+CARD_REQUEST = {"sentence": "I was running late.", "word": "running", "tag": "Test"}
+
+# カード生成のレスポンスにステージごとの所要時間がServer-Timingヘッダーで付く
+def test_card_response_has_server_timing(run_python):
+    output = run_python(f"""
+        import flask
+        import main
+        app = flask.Flask(__name__)
+        with app.test_request_context("/", method="POST", json={CARD_REQUEST!r}, headers={{"X-Request-ID": "req-1"}}):
+            response = main.main_function(flask.request)
+        print(response.headers["X-Request-ID"])
+        print(response.headers["Server-Timing"])
+    """)
+    request_id, server_timing = output.splitlines()[-2:]
+    assert request_id == "req-1"
+    stages = {entry.split(";")[0] for entry in server_timing.split(", ")}
+    assert {"gemini", "tts_sentence", "tts_example", "serialize", "total"} <= stages
+    assert all(";dur=" in entry for entry in server_timing.split(", "))
+
+# REQUEST_LOG=true のとき1リクエストにつき1行のJSONログを出す
+def test_request_log_is_one_json_line(run_python):
+    output = run_python(f"""
+        import flask
+        import main
+        app = flask.Flask(__name__)
+        with app.test_request_context("/", method="POST", json={CARD_REQUEST!r}, headers={{"X-Request-ID": "req-2"}}):
+            main.main_function(flask.request)
+    """, REQUEST_LOG="true")
+    entries = [json.loads(line) for line in output.splitlines() if line.startswith("{")]
+    entries = [entry for entry in entries if entry.get("message") == "card request"]
+    assert len(entries) == 1
+    entry = entries[0]
+    assert entry["request_id"] == "req-2"
+    assert entry["status"] == 200
+    assert entry["severity"] == "INFO"
+    assert entry["analysis_cache"] in ("miss", "bypassed")
+    assert "model" in entry and "token_usage" in entry
+    assert {"gemini", "tts_sentence", "tts_example"} <= set(entry["timings_ms"])
+
+# REQUEST_LOG=false のときは構造化ログを出さない
+def test_request_log_disabled(run_python):
+    output = run_python(f"""
+        import flask
+        import main
+        app = flask.Flask(__name__)
+        with app.test_request_context("/", method="POST", json={CARD_REQUEST!r}):
+            main.main_function(flask.request)
+    """)
+    assert '"card request"' not in output
+
+# /metrics はリクエストで計測したステージのヒストグラムをJSONとPrometheus形式で返す
+def test_metrics_histograms(run_python):
+    output = run_python(f"""
+        import json
+        import flask
+        import main
+        app = flask.Flask(__name__)
+        with app.test_request_context("/", method="POST", json={CARD_REQUEST!r}):
+            main.main_function(flask.request)
+        with app.test_request_context("/metrics", method="GET"):
+            response, status = main.main_function(flask.request)
+            stages = response.get_json()["stages"]
+        with app.test_request_context("/metrics?format=prometheus", method="GET"):
+            prometheus = main.main_function(flask.request).get_data(as_text=True)
+        total = stages["total"]
+        print(json.dumps({{
+            "status": status,
+            "stages": sorted(stages),
+            "count": total["count"],
+            "inf": total["buckets"][-1],
+            "quantiles": total["p50"] <= total["p95"] <= total["p99"],
+            "prometheus": [line for line in prometheus.splitlines() if 'stage="total"' in line and ("+Inf" in line or "_count" in line)],
+        }}))
+    """)
+    result = json.loads(output.splitlines()[-1])
+    assert result["status"] == 200
+    assert {"gemini", "tts_sentence", "total"} <= set(result["stages"])
+    assert result["count"] == 1
+    assert result["inf"] == ["+Inf", 1]
+    assert result["quantiles"]
+    assert result["prometheus"] == [
+        'anki_card_stage_seconds_bucket{stage="total",le="+Inf"} 1',
+        'anki_card_stage_seconds_count{stage="total"} 1',
+    ]
@@ -0,0 +1,81 @@
+import json
+
+# ワーカー・flush・replayが同じ送信キューを同時に処理しても、各エントリは1回だけ送信される
+def test_outbox_sends_each_entry_once(run_python, tmp_path):
+    output = run_python("""
+        import json, os, threading, time
+        import main
+
+        sent = []
+        class Session:
+            def post(self, url, headers, data, timeout):
+                sent.append(json.loads(data)["n"])
+                time.sleep(0.01)
+                return type("Response", (), {"status_code": 200, "text": "", "headers": {}})()
+
+        db_path = os.environ["NOTION_OUTBOX_DB"]
+        writer = main.NotionOutbox(db_path, 1000.0, 3)
+        for n in range(20):
+            writer._execute("INSERT INTO outbox (job_id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)", ("job", json.dumps({"n": n}), time.time(), "now"))
+        outboxes = [main.NotionOutbox(db_path, 1000.0, 3) for _ in range(3)]
+        for outbox in outboxes:
+            outbox._session = Session()
+        threads = [threading.Thread(target=outbox.flush, args=(10.0,)) for outbox in outboxes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(json.dumps({"sent": sorted(sent), "counts": writer.counts()}))
+    """, NOTION_OUTBOX_DB=str(tmp_path / "outbox.sqlite3"))
+    result = json.loads(output.splitlines()[-1])
+    assert result == {"sent": list(range(20)), "counts": {}}
+
+# 送信中に落ちたエントリは確保の期限を過ぎると再び送信される
+def test_outbox_reclaims_stale_sending_entry(run_python, tmp_path):
+    output = run_python("""
+        import json, os, time
+        import main
+
+        outbox = main.NotionOutbox(os.environ["NOTION_OUTBOX_DB"], 1000.0, 3)
+        outbox._execute("INSERT INTO outbox (job_id, payload, status, next_attempt_at, created_at) VALUES (?, ?, 'sending', ?, ?)", ("job", "{}", time.time() - 1, "now"))
+        print(json.dumps(outbox._claim_next()[0] == 1 and outbox._claim_next() is None))
+    """, NOTION_OUTBOX_DB=str(tmp_path / "outbox.sqlite3"))
+    assert output.strip() == "true"
+
+# atexitが呼ばれないSIGTERMでの終了でも、送信待ちを送り切ってから終了する
+def test_sigterm_flushes_pending_entries(tmp_path):
+    import os
+    import signal
+    import subprocess
+    import sys
+    import textwrap
+
+    from conftest import OFFLINE_ENV, ROOT
+
+    sent_path = tmp_path / "sent.txt"
+    code = textwrap.dedent("""
+        import json, os, signal, sys, time
+        import main
+
+        class Session:
+            def post(self, url, headers, data, timeout):
+                with open(sys.argv[1], "a") as f:
+                    f.write(json.loads(data)["n"] + "\\n")
+                return type("Response", (), {"status_code": 200, "text": "", "headers": {}})()
+
+        outbox = main.NotionOutbox.get_instance()
+        outbox._session = Session()
+        outbox._execute("INSERT INTO outbox (job_id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)", ("job", json.dumps({"n": "pending"}), time.time(), "now"))
+        os.kill(os.getpid(), signal.SIGTERM)
+        time.sleep(10)
+    """)
+    completed = subprocess.run(
+        [sys.executable, "-c", code, str(sent_path)],
+        cwd=ROOT,
+        env={**os.environ, **OFFLINE_ENV, "USE_NOTION": "true", "NOTION_OUTBOX_DB": str(tmp_path / "outbox.sqlite3")},
+        capture_output=True,
+        text=True,
+        timeout=30,
+    )
+    assert completed.returncode == -signal.SIGTERM, completed.stderr
+    assert sent_path.read_text() == "pending\n"
@@ -0,0 +1,36 @@
+import json
+
+# 接続の失敗・読み取りのタイムアウト・切断はリトライし、試行回数を使い切ったら502にする
+def test_scheduler_retries_transport_errors(run_python):
+    output = run_python("""
+        import asyncio, json
+        import httpx
+        import main
+
+        async def scenario():
+            scheduler = main.GeminiScheduler.get_instance()
+            errors = [httpx.ConnectError("refused"), httpx.ReadTimeout("slow"), httpx.RemoteProtocolError("closed")]
+
+            async def flaky():
+                if errors:
+                    raise errors.pop(0)
+                return "ok", None
+
+            async def down():
+                raise httpx.ConnectError("refused")
+
+            result = await scheduler.run(flaky, 10)
+            try:
+                await scheduler.run(down, 10)
+                status = None
+            except main.HTTPException as e:
+                status = e.status_code
+            return {"result": result, "status": status, "stats": scheduler.stats}
+
+        print(json.dumps(main.EventLoopThread.get_instance().run(scenario())))
+    """, GEMINI_MAX_ATTEMPTS="4", GEMINI_RETRY_BASE="0.01", GEMINI_RETRY_MAX="0.02")
+    result = json.loads(output.splitlines()[-1])
+    assert result["result"] == "ok"
+    assert result["status"] == 502
+    assert result["stats"]["retries"] == 6
+    assert result["stats"]["transport_errors"] == 7
@@ -0,0 +1,69 @@
+import json
+
+from benchmark import IMPORT_TIME_BUDGET_MS, measure_import_ms
+
+def test_import_does_not_load_heavy_sdks_or_start_threads(run_python):
+    output = run_python("""
+        import json, sys, threading
+        import main
+        print(json.dumps({
+            "modules": [name for name in ("google.genai", "gtts", "httpx", "requests") if name in sys.modules],
+            "threads": [thread.name for thread in threading.enumerate()],
+        }))
+    """, WARMUP="true")
+    result = json.loads(output)
+    assert result["modules"] == []
+    assert "anki-warm-up" not in result["threads"]
+    assert "anki-event-loop" not in result["threads"]
+
+def test_import_time_within_budget():
+    assert measure_import_ms() <= IMPORT_TIME_BUDGET_MS
+
+def test_first_request_starts_warm_up(run_python):
+    output = run_python("""
+        import os, time
+        import flask
+        import main
+        app = flask.Flask(__name__)
+        with app.test_request_context("/metrics", method="GET"):
+            main.main_function(flask.request)
+        deadline = time.monotonic() + 10
+        while main.EventLoopThread._instance is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+        print(main._warm_up_pid == os.getpid(), main.EventLoopThread._instance is not None)
+    """, WARMUP="true")
+    assert output.split() == ["True", "True"]
+
+# プリフォーク型のサーバー（gunicorn）と同じく、親でシングルトンを作ってからフォークしても子で生成できる
+def test_generate_card_after_fork(run_python):
+    output = run_python("""
+        import os, signal
+        import main
+        main.warm_up()
+        main.generate_card("I was running late.", "running", "Test", False, "reference")
+        pid = os.fork()
+        if pid == 0:
+            signal.alarm(20)
+            card = main.generate_card("I was running late.", "running", "Test", False, "reference")
+            os._exit(0 if card["word"] == "running" else 1)
+        _, status = os.waitpid(pid, 0)
+        print(os.waitstatus_to_exitcode(status))
+    """, WARMUP="true")
+    assert output.splitlines()[-1] == "0"
+
+# サーバーのワーカー以外のフォーク（multiprocessingなど）ではウォームアップを始めず、親の実行中の状態も引き継がない
+def test_fork_only_resets_state(run_python):
+    output = run_python("""
+        import asyncio, os, signal, threading, time
+        import main
+        main._tts_flight._calls["pending"] = asyncio.Future(loop=asyncio.new_event_loop())
+        pid = os.fork()
+        if pid == 0:
+            signal.alarm(20)
+            time.sleep(0.2)
+            started = any(thread.name == "anki-warm-up" for thread in threading.enumerate())
+            os._exit(0 if not started and main._warm_up_pid is None and not main._tts_flight._calls else 1)
+        _, status = os.waitpid(pid, 0)
+        print(os.waitstatus_to_exitcode(status))
+    """, WARMUP="true")
+    assert output.strip() == "0"
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from main import IncrementalJSONObjectParser
+
+DOCUMENT = {
+    "contextual_translation": "遅れていた \"走って\"",
+    "rating": 4,
+    "synonyms": ["dash", "rush"],
+    "nested": {"a": [1, {"b": None}]},
+    "ratio": 0.25,
+    "ok": True,
+}
+
+def feed_in_chunks(text, size):
+    parser = IncrementalJSONObjectParser()
+    fields = []
+    for start in range(0, len(text), size):
+        fields.extend(parser.feed(text[start:start + size]))
+    return parser, fields
+
+@pytest.mark.parametrize("size", [1, 3, 7, 1000])
+def test_fields_are_emitted_once_in_order(size):
+    text = json.dumps(DOCUMENT, ensure_ascii=False, indent=2)
+    parser, fields = feed_in_chunks(text, size)
+    # 最後のフィールドの値は、オブジェクトを閉じる文字が届いて確定する
+    assert fields == list(DOCUMENT.items())
+
+def test_numbers_wait_for_the_next_character():
+    parser = IncrementalJSONObjectParser()
+    assert parser.feed('{"rating": 4') == []
+    assert parser.feed("2") == []
+    assert parser.feed(".5") == []
+    assert parser.feed(' , "word": "run"') == [("rating", 42.5), ("word", "run")]
+
+def test_string_values_are_emitted_when_closed():
+    parser = IncrementalJSONObjectParser()
+    assert parser.feed('{"ipa": "/ˈrʌn') == []
+    assert parser.feed('ɪŋ/"') == [("ipa", "/ˈrʌnɪŋ/")]
+
+@pytest.mark.parametrize("text", ['["not", "an", "object"]', '{"key" 1}'])
+def test_malformed_input_raises(text):
+    with pytest.raises(ValueError):
+        IncrementalJSONObjectParser().feed(text)
+
+# ストリーミングで組み立てたカードは、通常の呼び出しと同じ分析結果になる
+def test_streaming_card_matches_regular_card(run_python):
+    code = """
+        import json
+        import main
+        card = main.generate_card("I was running late.", "running", "Test", False, "reference")
+        fields = dict(line.split(": ", 1) for line in card["anki_template"].splitlines() if ": " in line)
+        # ファイル名・リンクはカードごとに異なる
+        print(json.dumps({key: value for key, value in fields.items() if key not in ("Image", "Voice", "ObsidianLink")}))
+    """
+    regular = run_python(code, GEMINI_STREAMING="false").splitlines()[-1]
+    streamed = run_python(code, GEMINI_STREAMING="true", STUB_GEMINI_LATENCY="0.2").splitlines()[-1]
+    assert json.loads(streamed) == json.loads(regular)
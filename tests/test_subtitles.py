@@ -0,0 +1,50 @@
+import json
+
+from subtitles import COMMON_WORDS, candidate_words
+
+def test_common_words_are_skipped_without_known_words():
+    sentence = "I think that this guy would have been totally oblivious with everything."
+    assert candidate_words(sentence, COMMON_WORDS) == ["totally", "oblivious"]
+
+def test_inflected_common_words_are_skipped():
+    assert candidate_words("She was thinking about quitting, believes me.", COMMON_WORDS) == ["quitting"]
+
+def test_prewarm_skips_frequent_words_from_lexicon(run_python, tmp_path):
+    from main import Lexicon
+    lexicon_path = str(tmp_path / "lexicon.idx")
+    Lexicon.build([("totally", "1500", "", ""), ("oblivious", "20000", "", "")], lexicon_path)
+    output = run_python("""
+        import json
+        import main
+        print(json.dumps(main.prewarm_subtitles("1\\n00:00:01,000 --> 00:00:02,000\\nHe was totally oblivious.\\n", "Test")))
+    """, LEXICON_PATH=lexicon_path, WARMUP="false")
+    assert '"candidates": 1' in output
+
+# 事前分析中のセリフを通常のリクエストが受け取ったら、Geminiを呼び直さずに事前分析の結果を待つ
+def test_capture_during_prewarm_shares_the_analysis(run_python):
+    output = run_python("""
+        import asyncio, json
+        import main
+        client, _ = main.GeminiClient.get_instance()
+        original = client.aio.models.generate_content
+        calls = []
+
+        async def generate_content(*, model, contents, config=None):
+            calls.append(contents)
+            await asyncio.sleep(0.3)
+            return await original(model=model, contents=contents, config=config)
+
+        client.aio.models.generate_content = generate_content
+
+        async def scenario():
+            prewarm = asyncio.ensure_future(main.prewarm_card("I was running late.", "running", "Test"))
+            await asyncio.sleep(0.05)
+            single = await main.analyze_word("I was running late.", "running", "Test")
+            multi = await main.analyze_words("I was running late.", ["running"], "Test")
+            await prewarm
+            return single == multi[0]
+
+        same = main.EventLoopThread.get_instance().run(scenario())
+        print(json.dumps({"calls": len(calls), "same": same}))
+    """)
+    assert json.loads(output.splitlines()[-1]) == {"calls": 1, "same": True}
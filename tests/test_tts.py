@@ -0,0 +1,32 @@
+import asyncio
+
+import gtts
+import pytest
+
+from main import GTTSBackend, NullTTSBackend
+
+def test_tested_gtts_version_uses_parallel_requests():
+    assert gtts.__version__.startswith(GTTSBackend.parallel_versions)
+    assert GTTSBackend()._supports_parallel()
+
+# 内部APIの動作を確認していない版では、公開APIの write_to_fp で合成する
+@pytest.mark.parametrize("version, has_internal", [("3.0.0", True), ("2.5.4", False)])
+def test_untested_gtts_falls_back_to_write_to_fp(monkeypatch, version, has_internal):
+    monkeypatch.setattr(gtts, "__version__", version)
+    if not has_internal:
+        monkeypatch.delattr(gtts.gTTS, "_prepare_requests")
+    written = []
+
+    def write_to_fp(self, fp):
+        written.append(self.text)
+        fp.write(b"mp3")
+
+    monkeypatch.setattr(gtts.gTTS, "write_to_fp", write_to_fp)
+    backend = GTTSBackend()
+    assert asyncio.run(backend.synthesize("Keep it up.", "en")) == b"mp3"
+    assert written == ["Keep it up."]
+    assert not backend._supports_parallel()
+
+def test_null_backend_returns_silent_frames():
+    audio = asyncio.run(NullTTSBackend().synthesize("I was running late.", "en"))
+    assert audio.startswith(NullTTSBackend.silent_frame) and len(audio) % len(NullTTSBackend.silent_frame) == 0